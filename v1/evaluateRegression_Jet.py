@@ -108,16 +108,16 @@ data_input = torch.tensor(np.stack([dict_input[var] for var in dict_input], axis
 data_target = torch.tensor(np.stack([dict_target[var] for var in dict_target], axis=1), dtype=my_dtype, device=device)
 data_spec = torch.tensor(np.stack([dict_spectators[var] for var in dict_spectators], axis=1), dtype=my_dtype, device=device)
 
+# drop rows with non-finite values once, instead of per sample when collating the batches
+keep = torch.isfinite(data_input).all(dim=1) & torch.isfinite(data_target).all(dim=1) & torch.isfinite(data_spec).all(dim=1)
+print('dropped ' + str(int((~keep).sum())) + ' rows with non-finite values')
+data_input, data_target, data_spec = data_input[keep], data_target[keep], data_spec[keep]
+
 dataset = torch.utils.data.TensorDataset(data_input, data_target, data_spec)
 test_dataset = dataset
 
 
-def collate_fn(batch_):
-    batch_ = list(filter(lambda x: torch.all(torch.isfinite(torch.cat(x))), batch_))
-    return torch.utils.data.dataloader.default_collate(batch_)
-
-
-test_loader = torch.utils.data.DataLoader(test_dataset, batch_size=batch_size, shuffle=False, collate_fn=collate_fn)
+test_loader = torch.utils.data.DataLoader(test_dataset, batch_size=batch_size, shuffle=False)
 
 len_test_loader = len(test_loader)
 
@@ -36,27 +36,35 @@ class MMD(nn.Module):
 
         return
 
+    @staticmethod
+    def pairwise_sq_dist(x, y):
+        """Squared L2-distances between all rows of x and y, without building the (n, m, dim) difference tensor"""
+
+        return torch.clamp((x**2).sum(1, keepdim=True) + (y**2).sum(1) - 2 * torch.matmul(x, y.t()), min=0)
+
     @staticmethod
     def gaussian_kernel(source, target, kernel_mul=2.0, kernel_num=5, fix_sigma=None, one_sided_bandwidth=False, l2dist_out=None):
 
         n_samples = int(source.size()[0])+int(target.size()[0])
         total = torch.cat([source, target], dim=0)
 
-        total0 = total.unsqueeze(0).expand(int(total.size()[0]), int(total.size()[0]), int(total.size()[1]))
-        total1 = total.unsqueeze(1).expand(int(total.size()[0]), int(total.size()[0]), int(total.size()[1]))
-
         if type(fix_sigma) == list or (torch.is_tensor(fix_sigma) and fix_sigma.size()[0] > 1):
-            L2_distance = ((total0-total1)**2)
+            # one bandwidth per dimension: sum_d (x_d - y_d)**2 / bandwidth_d is the L2-distance of the rescaled inputs
+            bandwidth_by_dimension = fix_sigma.detach().clone() if torch.is_tensor(fix_sigma) else torch.tensor(fix_sigma, device=source.device)
+            total_scaled = total / torch.sqrt(bandwidth_by_dimension)
+            L2_distance = MMD.pairwise_sq_dist(total_scaled, total_scaled)
+            bandwidth = torch.tensor(1., device=source.device)
         else:
-            L2_distance = ((total0-total1)**2).sum(2)
+            bandwidth_by_dimension = None
+            L2_distance = MMD.pairwise_sq_dist(total, total)
+            if fix_sigma is None:
+                bandwidth = torch.sum(L2_distance.data) / (n_samples**2-n_samples)
+            else:
+                bandwidth = fix_sigma.detach().clone() if torch.is_tensor(fix_sigma) else torch.tensor(fix_sigma, device=source.device)
 
         if l2dist_out is not None:
-            globals()[l2dist_out] = (torch.sum(((total0-total1)**2).sum(2).data) / (n_samples**2-n_samples)).item()
-
-        if fix_sigma is None:
-            bandwidth = torch.sum(L2_distance.data) / (n_samples**2-n_samples)
-        else:
-            bandwidth = fix_sigma.detach().clone() if torch.is_tensor(fix_sigma) else torch.tensor(fix_sigma, device=source.device)
+            L2_distance_unscaled = MMD.pairwise_sq_dist(total, total) if bandwidth_by_dimension is not None else L2_distance
+            globals()[l2dist_out] = (torch.sum(L2_distance_unscaled.data) / (n_samples**2-n_samples)).item()
 
         if one_sided_bandwidth:
             bandwidth /= kernel_mul ** (kernel_num - 1)
@@ -64,17 +72,13 @@ class MMD(nn.Module):
             bandwidth /= kernel_mul ** (kernel_num // 2)
         bandwidth_list = [bandwidth * (kernel_mul**i) for i in range(kernel_num)]
 
-        if type(fix_sigma) == list or (torch.is_tensor(fix_sigma) and fix_sigma.size()[0] > 1):
-            kernel_val = [torch.exp(-(L2_distance / bandwidth_temp).sum(2)) for bandwidth_temp in bandwidth_list]
-        else:
-            kernel_val = [torch.exp(-L2_distance / bandwidth_temp) for bandwidth_temp in bandwidth_list]
+        kernel_val = [torch.exp(-L2_distance / bandwidth_temp) for bandwidth_temp in bandwidth_list]
 
         # some printouts that might be useful
         # print('\nMMD:')
         # print(L2_distance)
         # print(L2_distance / bandwidth_list[0])
         # print(torch.exp(-(L2_distance / bandwidth_list[0])))
-        # print(torch.exp(-(L2_distance / bandwidth_list[0]).sum(2)))
         # print('L2 distance')
         # print(torch.sum(L2_distance.data) / (n_samples**2-n_samples))
         # print('bandwidths')
@@ -103,11 +107,7 @@ class MMD(nn.Module):
 
                 n_samples = int(target.size()[0])
 
-                total = target
-
-                total0 = total.unsqueeze(0).expand(int(total.size()[0]), int(total.size()[0]), int(total.size()[1]))
-                total1 = total.unsqueeze(1).expand(int(total.size()[0]), int(total.size()[0]), int(total.size()[1]))
-                L2_distance = ((total0-total1)**2).sum(2)
+                L2_distance = MMD.pairwise_sq_dist(target, target)
 
                 self.fix_sigma_target_only = torch.sum(L2_distance.data) / (n_samples**2-n_samples)
 
@@ -120,22 +120,25 @@ class MMD(nn.Module):
 
             if self.fix_sigma_target_only_by_dimension is None:
 
-                total = torch.cat([source, target], dim=0)
+                def xy_distances(i):
+                    # (source, target) block of the squared distances in dimension i, one dimension at a time
+                    return (source[:, i].unsqueeze(1) - target[:, i].unsqueeze(0))**2
+
+                def nonzero_median(d):
+                    # mask distances that are exactly zero to avoid setting the bw to zero for one-hot-encoded dimensions
+                    return d[~(d == 0)].median()
 
-                total0 = total.unsqueeze(0).expand(int(total.size()[0]), int(total.size()[0]), int(total.size()[1]))
-                total1 = total.unsqueeze(1).expand(int(total.size()[0]), int(total.size()[0]), int(total.size()[1]))
-                L2_distances = (total0-total1)**2
+                ndimensions = source.size()[1]
 
                 if type(self.calculate_fix_sigma_for_each_dimension_with_target_only) == str:
                     if self.calculate_fix_sigma_for_each_dimension_with_target_only == 'median':
-                        # mask distances that are exactly zero to avoid setting the bw to zero for one-hot-encoded dimensions
-                        self.fix_sigma_target_only_by_dimension = torch.tensor([L2_distances[:source.size()[0], source.size()[0]:, i][~(L2_distances[:source.size()[0], source.size()[0]:, i] == 0)].median() for i in range(total.size()[1])], device=total.device)
+                        self.fix_sigma_target_only_by_dimension = torch.tensor([nonzero_median(xy_distances(i)) for i in range(ndimensions)], device=source.device)
                     elif self.calculate_fix_sigma_for_each_dimension_with_target_only == 'mean':
-                        self.fix_sigma_target_only_by_dimension = torch.tensor([L2_distances[:source.size()[0], source.size()[0]:, i].mean() for i in range(total.size()[1])], device=total.device)
+                        self.fix_sigma_target_only_by_dimension = torch.tensor([xy_distances(i).mean() for i in range(ndimensions)], device=source.device)
                     else:
                         raise NotImplementedError('cannot understand how to calculate MMD bandwidths: ' + self.fix_sigma_target_only_by_dimension)
                 else:
-                    self.fix_sigma_target_only_by_dimension = torch.tensor([L2_distances[:source.size()[0], source.size()[0]:, i][~(L2_distances[:source.size()[0], source.size()[0]:, i] == 0)].median() for i in range(total.size()[1])], device=total.device)
+                    self.fix_sigma_target_only_by_dimension = torch.tensor([nonzero_median(xy_distances(i)) for i in range(ndimensions)], device=source.device)
 
                 print('\ncalculated BWs by dimension to be:')
                 print(self.fix_sigma_target_only_by_dimension)
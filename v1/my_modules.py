@@ -1,3 +1,5 @@
+import os
+
 import torch
 from torch import nn
 
@@ -72,6 +74,29 @@ class EarlyStopper:
         return False
 
 
+def drop_nonfinite_rows(*tensors):
+    """Drops the rows with a nan or inf in any of the given tensors
+    returns the filtered tensors and the number of dropped rows
+    """
+
+    keep = torch.stack([torch.isfinite(t).all(dim=1) for t in tensors]).all(dim=0)
+    ndropped = int((~keep).sum())
+    if ndropped > 0:
+        tensors = tuple(t[keep] for t in tensors)
+
+    return tensors, ndropped
+
+
+def flush_to_disk(*files):
+    """Flushes and fsyncs the given open files, so the logs of a running training can be followed
+    and survive a crash or a killed job
+    """
+
+    for f in files:
+        f.flush()
+        os.fsync(f.fileno())
+
+
 class Dummy(nn.Module):
 
     def __init__(self, n_params):
@@ -364,6 +389,15 @@ class LinearWithSkipConnection(nn.Module):
         self._islast = islast
         self._noskipping = noskipping
 
+        # the columns of the input that are skipped, registered once instead of building a tensor in every forward
+        # (not persistent, so the state dicts stay the same)
+        if self._in_features < self._out_features:
+            identity_indices = self._skipindices if self._isfirst else list(range(len(self._skipindices)))
+        else:
+            identity_indices = []
+        self.register_buffer('_identity_indices', torch.tensor(identity_indices, dtype=torch.long), persistent=False)
+        self._num_skipped = len(identity_indices)
+
         self._linears = nn.ModuleList()
         self._leakyrelus = nn.ModuleList()
         if dropout: self._dropouts = nn.ModuleList()
@@ -391,30 +425,6 @@ class LinearWithSkipConnection(nn.Module):
 
     def forward(self, x):
 
-        if self._in_features < self._out_features:
-
-            if self._isfirst:
-                identity = torch.index_select(x, 1, torch.tensor(self._skipindices, device=x.device))
-            else:
-                identity = torch.index_select(x, 1, torch.tensor([idx for idx in range(len(self._skipindices))], device=x.device))
-
-            identity = torch.cat((identity, torch.zeros((identity.size(dim=0), self._out_features - len(self._skipindices)), device=x.device, dtype=x.dtype)), dim=1)
-
-        elif self._out_features < self._in_features:
-
-            if self._islast and len(self._skipindices) > self._n_vars:
-                # if we have skipped also the parameters, we need to drop them in the last layer
-                identity = x[:, self._n_params:self._n_params+self._out_features]
-            else:
-                identity = x[:, :self._out_features]
-
-        else:
-
-            identity = x
-
-        if self._noskipping:
-            identity = torch.zeros_like(identity)
-
         residual = x
         if self._dropouts is not None:
             for ilayer, (linear, leakyrelu, dropout) in enumerate(zip(self._linears, self._leakyrelus, self._dropouts)):
@@ -428,7 +438,30 @@ class LinearWithSkipConnection(nn.Module):
                 if not (self._islast and ilayer == self._nskiplayers-1):
                     residual = leakyrelu(residual)
 
-        return residual + identity
+        if self._noskipping:
+            return residual
+
+        # residual + identity used to promote to the dtype of x (e.g. under autocast), keep that before adding in place
+        residual = residual.to(x.dtype)
+
+        if self._in_features < self._out_features:
+
+            # the identity only covers the first columns, the others are left as they are instead of adding a zero padding
+            residual[:, :self._num_skipped] += torch.index_select(x, 1, self._identity_indices)
+
+        elif self._out_features < self._in_features:
+
+            if self._islast and len(self._skipindices) > self._n_vars:
+                # if we have skipped also the parameters, we need to drop them in the last layer
+                residual += x[:, self._n_params:self._n_params+self._out_features]
+            else:
+                residual += x[:, :self._out_features]
+
+        else:
+
+            residual += x
+
+        return residual
 
 
 class CastTo16Bit(nn.Module):
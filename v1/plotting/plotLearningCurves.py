@@ -1,10 +1,14 @@
 import csv
+from collections import Counter
 import numpy as np
 import matplotlib.lines as mlines
 import matplotlib.pyplot as plt
 import os, sys
 
-def read_csv(filepath):
+def read_csv(filepath, split='train'):
+
+    if is_long_format(filepath):
+        return read_long_csv(filepath, split)
 
     with open(filepath) as f:
         rows = 0
@@ -20,13 +24,13 @@ def read_csv(filepath):
             elif irow == 2:
                 for icol, value in enumerate(row[2:]):
                     starts[icol].append(float(value))
-            else:
+            elif len(row) == len(values) and all(row):  # not a line that is still being written
                 rows += 1
                 for icol, value in enumerate(row):
                     values[icol].append(float(value))
 
-        nepochs_ = int(row[0]) + 1
-        nbatches_ = int(rows / nepochs_)
+    nepochs_, nbatches_, nrows = complete_epochs(values[0][1:])
+    values = [v[:1 + nrows] for v in values]
 
     print('starts', starts)
     return nepochs_, nbatches_, \
@@ -35,6 +39,63 @@ def read_csv(filepath):
         {s[0]: np.array(s[1]) for s in starts if len(s)>1}
 
 
+def complete_epochs(epoch_column):
+    # number of epochs and batches per epoch, and the number of rows that belong to complete epochs
+    # while the training is still writing the file the last epoch can be incomplete, it is left out
+    # so it doesn't shift the boundaries of the other epochs
+
+    batches_per_epoch = Counter(int(epoch) for epoch in epoch_column)
+    first_epoch, last_epoch = int(epoch_column[0]), int(epoch_column[-1])
+    nbatches_ = batches_per_epoch[first_epoch]
+
+    nrows = len(epoch_column)
+    if last_epoch != first_epoch and batches_per_epoch[last_epoch] < nbatches_:
+        print(f'epoch {last_epoch} is incomplete ({batches_per_epoch[last_epoch]} of {nbatches_} batches), leaving it out')
+        nrows -= batches_per_epoch[last_epoch]
+        last_epoch -= 1
+
+    return last_epoch + 1, nbatches_, nrows
+
+
+LONG_FORMAT_HEADER = ['loss_name', 'type', 'epoch', 'batch', 'value']
+
+def is_long_format(filepath):
+
+    with open(filepath) as f:
+        header = next(csv.reader(f), [])
+
+    return header == LONG_FORMAT_HEADER
+
+
+def read_long_csv(filepath, split):
+    # loss_logs.csv written by v2 (also while the training is still running): one row per loss, split, epoch and batch
+    # losses that were not calculated in a batch are nan, there are no benchmark and start rows
+
+    rows = {}
+    loss_names = []
+    with open(filepath) as f:
+        reader = csv.DictReader(f)
+        for row in reader:
+            if row['type'] != split or not row['value']:
+                continue  # other split or a line that is still being written
+            if row['loss_name'] not in loss_names:
+                loss_names.append(row['loss_name'])
+            rows.setdefault((int(row['epoch']), int(row['batch'])), {})[row['loss_name']] = float(row['value'])
+
+    keys = sorted(rows)
+    nepochs_, nbatches_, nrows = complete_epochs([key[0] for key in keys])
+    keys = keys[:nrows]
+
+    values = {
+        'epoch': np.array([key[0] for key in keys], dtype=float),
+        'iteration': np.array([key[1] for key in keys], dtype=float),
+    }
+    for loss_name in loss_names:
+        values[loss_name] = np.array([rows[key].get(loss_name, np.nan) for key in keys])
+
+    return nepochs_, nbatches_, values, {}, {}
+
+
 
 try: training_id = sys.argv[1]
 except: 
@@ -46,6 +107,11 @@ except:
     
     
 in_path = '/data/dust/user/beinsam/FastSim/Refinement/Regress/TrainingOutput/traininglog_refinement_regression_TRAININGID'
+
+# optionally the loss_logs.csv of a v2 training, which has the train and the validation losses in one file
+try: loss_logs_path = sys.argv[2]
+except: loss_logs_path = None
+
 if not os.path.exists('figs'+training_id):
     os.system('mkdir figs'+training_id)
     
@@ -100,18 +166,20 @@ plotheight = 8  # Adjusted for bigger text
 #plotheight = 5
 
 print('\n### read csv files')
-print('hopefully this exists', in_path.replace('TRAININGID', training_id) + '_train.csv')
-nepochs_train, nbatches_train, values_train, benchmarks_train, starts_train = read_csv(in_path.replace('TRAININGID', training_id) + '_train.csv')
+train_csv = loss_logs_path if loss_logs_path else in_path.replace('TRAININGID', training_id) + '_train.csv'
+print('hopefully this exists', train_csv)
+nepochs_train, nbatches_train, values_train, benchmarks_train, starts_train = read_csv(train_csv, split='train')
 
-print('hopefully this exists too', in_path.replace('TRAININGID', training_id) + '_validation.csv')
-nepochs_val, nbatches_val, values_val, benchmarks_val, starts_val = read_csv(in_path.replace('TRAININGID', training_id) + '_validation.csv')
+validation_csv = loss_logs_path if loss_logs_path else in_path.replace('TRAININGID', training_id) + '_validation.csv'
+print('hopefully this exists too', validation_csv)
+nepochs_val, nbatches_val, values_val, benchmarks_val, starts_val = read_csv(validation_csv, split='validation')
 print('done with that')
-assert nepochs_train == nepochs_val
-nepochs = nepochs_train
+# the validation of the last epoch can still be missing while the training is running
+nepochs = min(nepochs_train, nepochs_val)
 epochs = np.array(range(nepochs + 1))
 
 data_train = {
-    key: np.array([np.mean(values_train[key][epoch*nbatches_train:(epoch+1)*nbatches_train]) for epoch in range(nepochs)])
+    key: np.array([np.nanmean(values_train[key][epoch*nbatches_train:(epoch+1)*nbatches_train]) for epoch in range(nepochs)])
     for key in values_train if key in [p for plot in plots for p in plot]
 }
 
@@ -120,16 +188,17 @@ mdmm_constraints = {key.replace('lmbda_', ''): benchmarks_train[key] for key in
 for key in data_train:
     if key in ['epoch', 'iteration']: continue
     assert len(data_train[key]) == nepochs
-    data_train[key] = np.insert(data_train[key], 0, starts_train[key])
+    # the long format has no start row, the first epoch is used instead
+    data_train[key] = np.insert(data_train[key], 0, starts_train.get(key, data_train[key][0]))
 
 data_val = {
-    key: np.array([np.mean(values_val[key][epoch*nbatches_val:(epoch+1)*nbatches_val]) for epoch in range(nepochs)])
+    key: np.array([np.nanmean(values_val[key][epoch*nbatches_val:(epoch+1)*nbatches_val]) for epoch in range(nepochs)])
     for key in values_val if key in [p for plot in plots for p in plot]
 }
 
 for key in data_val:
     assert len(data_val[key]) == nepochs
-    data_val[key] = np.insert(data_val[key], 0, starts_val[key])
+    data_val[key] = np.insert(data_val[key], 0, starts_val.get(key, data_val[key][0]))
 
 
 def styleAx(a):
@@ -189,7 +258,7 @@ for iplot, plot in enumerate(plots):
         print('and after', plot, data_train[p], min_y_axis_value)
 
     styleAx(ax)
-    ax.set_xlim(1,nepochs_train)
+    ax.set_xlim(1,nepochs)
     ax.set_xscale('log',base=10)
     
     ax.set_yscale('linear')  # Explicitly set to linear for clarity, though it's the default
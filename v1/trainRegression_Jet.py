@@ -266,12 +266,16 @@ data_spec = torch.tensor(np.stack([dict_spectators[var] for var in spectator_var
 torch.cuda.empty_cache()
 
 
+(data_input, data_target, data_spec), ndropped = drop_nonfinite_rows(data_input, data_target, data_spec)
+if ndropped > 0:
+    print('dropped ' + str(ndropped) + ' rows with non-finite values')
+
 dataset = torch.utils.data.TensorDataset(data_input, data_target, data_spec)
 
-if ntest == 0:
+if ntest == 0 or len(dataset) < ntrain + nval + ntest:
     ntest = len(dataset) - (ntrain + nval)
 
-if rdf.Count().GetValue() < ntrain + nval + ntest:
+if ntest < 0:
     raise Exception('input dataset too small, choose smaller/fewer batches')
 
 train_dataset, val_dataset, test_dataset = torch.utils.data.random_split(
@@ -280,14 +284,9 @@ train_dataset, val_dataset, test_dataset = torch.utils.data.random_split(
 )
 
 
-def collate_fn(batch_):
-    batch_ = list(filter(lambda x: torch.all(torch.isfinite(torch.cat(x))), batch_))
-    return torch.utils.data.dataloader.default_collate(batch_)
-
-
-train_loader = torch.utils.data.DataLoader(train_dataset, batch_size=batch_size, shuffle=not is_test, collate_fn=collate_fn)
-validation_loader = torch.utils.data.DataLoader(val_dataset, batch_size=batch_size, shuffle=False, collate_fn=collate_fn)
-test_loader = torch.utils.data.DataLoader(test_dataset, batch_size=batch_size, shuffle=False, collate_fn=collate_fn)
+train_loader = torch.utils.data.DataLoader(train_dataset, batch_size=batch_size, shuffle=not is_test)
+validation_loader = torch.utils.data.DataLoader(val_dataset, batch_size=batch_size, shuffle=False)
+test_loader = torch.utils.data.DataLoader(test_dataset, batch_size=batch_size, shuffle=False)
 
 len_train_loader = len(train_loader)
 len_validation_loader = len(validation_loader)
@@ -846,6 +845,8 @@ for epoch in range(num_epochs):
 
         print('[{} / {}] validation loss: {:.10f}'.format(epoch + 1, num_epochs, epoch_validation_loss / len_validation_loader))
 
+    flush_to_disk(csvfile_train, csvfile_validation)
+
     if lr_scheduler is not None and lr_scheduler_gamma:
         lr_scheduler.step()
 
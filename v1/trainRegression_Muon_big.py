@@ -205,25 +205,24 @@ data_input = torch.tensor(np.stack([dict_input[var] for var in dict_input], axis
 data_target = torch.tensor(np.stack([dict_target[var] for var in dict_target], axis=1), dtype=my_dtype, device=device)
 data_spec = torch.tensor(np.stack([dict_spectators[var] for var in dict_spectators], axis=1), dtype=my_dtype, device=device)
 
+(data_input, data_target, data_spec), ndropped = drop_nonfinite_rows(data_input, data_target, data_spec)
+if ndropped > 0:
+    print('dropped ' + str(ndropped) + ' rows with non-finite values')
+
 dataset = torch.utils.data.TensorDataset(data_input, data_target, data_spec)
 
-if ntest == 0:
+if ntest == 0 or len(dataset) < ntrain + nval + ntest:
     ntest = len(dataset) - (ntrain + nval)
 
-if rdf.Count().GetValue() < ntrain + nval + ntest:
+if ntest < 0:
     raise Exception('input dataset too small, choose smaller/fewer batches')
 
 train_dataset, val_dataset, test_dataset = torch.utils.data.random_split(dataset, [ntrain, nval, ntest])
 
 
-def collate_fn(batch_):
-    batch_ = list(filter(lambda x: torch.all(torch.isfinite(torch.cat(x))), batch_))
-    return torch.utils.data.dataloader.default_collate(batch_)
-
-
-train_loader = torch.utils.data.DataLoader(train_dataset, batch_size=batch_size, shuffle=not is_test, collate_fn=collate_fn)
-validation_loader = torch.utils.data.DataLoader(val_dataset, batch_size=batch_size, shuffle=False, collate_fn=collate_fn)
-test_loader = torch.utils.data.DataLoader(test_dataset, batch_size=batch_size, shuffle=False, collate_fn=collate_fn)
+train_loader = torch.utils.data.DataLoader(train_dataset, batch_size=batch_size, shuffle=not is_test)
+validation_loader = torch.utils.data.DataLoader(val_dataset, batch_size=batch_size, shuffle=False)
+test_loader = torch.utils.data.DataLoader(test_dataset, batch_size=batch_size, shuffle=False)
 
 len_train_loader = len(train_loader)
 len_validation_loader = len(validation_loader)
@@ -657,6 +656,8 @@ for epoch in range(num_epochs):
         print('[{} / {}] validation loss: {:.10f}'.format(epoch + 1, num_epochs, epoch_train_loss / len_train_loader))
 
 
+    flush_to_disk(csvfile_train, csvfile_validation)
+
     lr_scheduler.step()
 
     if epoch + 1 == num_epochs:
@@ -0,0 +1,90 @@
+"""Training steps per second of the refinement model from config.json, eager against torch.compile, on CPU
+
+one step is forward, MSE loss, backward and an Adam update, the compiled model is checked against the eager one first
+
+python benchmarks/benchmark_compile.py
+"""
+
+import copy
+import os
+import sys
+import time
+
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from config import Config
+from model import RefinementModelBuilder
+from scalers import Scalers
+
+
+BATCH_SIZES = [1024, 4096, 16384]
+WARMUP = 5
+STEPS = 50
+
+
+def build_model(config_path):
+
+    config = Config(config_path=config_path)
+    scalers = Scalers(config)
+
+    # normally filled by the data loader
+    config.datasetInfo = {}
+    config.datasetInfo.inputDim = len(scalers.input_features_dict)
+    config.datasetInfo.targetDim = len(scalers.target_features_dict)
+    config.datasetInfo.train_numbatch = 0
+
+    return RefinementModelBuilder(config).build(), config.datasetInfo.inputDim, config.datasetInfo.targetDim
+
+
+def steps_per_second(model, inputs, targets):
+
+    optimizer = torch.optim.Adam(model.parameters(), lr=1e-4)
+
+    def step():
+        optimizer.zero_grad(set_to_none=True)
+        loss = torch.nn.functional.mse_loss(model(inputs), targets)
+        loss.backward()
+        optimizer.step()
+
+    for _ in range(WARMUP):
+        step()
+
+    start = time.perf_counter()
+    for _ in range(STEPS):
+        step()
+    return STEPS / (time.perf_counter() - start)
+
+
+def main():
+
+    torch.manual_seed(0)
+
+    model, input_dim, target_dim = build_model(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'config.json'))
+
+    print(f"{'batch':>6} {'eager [steps/s]':>16} {'compiled [steps/s]':>19} {'speed-up':>9} {'max abs diff':>13}")
+
+    for batch_size in BATCH_SIZES:
+
+        inputs = torch.randn(batch_size, input_dim)
+        targets = torch.randn(batch_size, target_dim)
+
+        eager = copy.deepcopy(model)
+        compiled = torch.compile(copy.deepcopy(model), dynamic=False)
+
+        eager.eval()
+        compiled.eval()
+        with torch.no_grad():
+            max_diff = (eager(inputs) - compiled(inputs)).abs().max().item()
+        eager.train()
+        compiled.train()
+
+        s_eager = steps_per_second(eager, inputs, targets)
+        s_compiled = steps_per_second(compiled, inputs, targets)
+
+        print(f"{batch_size:>6} {s_eager:>16.1f} {s_compiled:>19.1f} {s_compiled/s_eager:>8.2f}x {max_diff:>13.2e}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,52 @@
+"""Time per epoch of torch.utils.data.DataLoader over a TensorDataset against the FastTensorBatchLoader
+
+python benchmarks/benchmark_loader.py
+"""
+
+import os
+import sys
+import time
+
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from data_loader import FastTensorBatchLoader
+
+
+NUM_SAMPLES = 500 * 2048
+DIMS = (12, 9, 30)
+BATCH_SIZES = [1024, 2048, 8192]
+
+
+def time_epoch(loader):
+    start = time.perf_counter()
+    for _ in loader:
+        pass
+    return time.perf_counter() - start
+
+
+def main():
+
+    tensors = [torch.rand(NUM_SAMPLES, dim) for dim in DIMS]
+    indices = torch.randperm(NUM_SAMPLES)[:NUM_SAMPLES // 2]
+
+    subset = torch.utils.data.Subset(torch.utils.data.TensorDataset(*tensors), indices.tolist())
+
+    print(f"{'batch':>6} {'torch DataLoader [s]':>21} {'FastTensorBatchLoader [s]':>26} {'speed-up':>9}")
+
+    for batch_size in BATCH_SIZES:
+
+        torch_loader = torch.utils.data.DataLoader(subset, batch_size=batch_size, shuffle=True)
+        fast_loader = FastTensorBatchLoader(tensors, indices, batch_size=batch_size, shuffle=True, seed=42)
+
+        assert len(torch_loader) == len(fast_loader)
+
+        t_torch = time_epoch(torch_loader)
+        t_fast = time_epoch(fast_loader)
+
+        print(f"{batch_size:>6} {t_torch:>21.3f} {t_fast:>26.3f} {t_torch/t_fast:>8.1f}x")
+
+
+if __name__ == '__main__':
+    main()
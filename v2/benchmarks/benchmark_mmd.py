@@ -0,0 +1,68 @@
+"""Variance and wall-time of the approximate MMD losses (mmd_rff, mmd_linear) against the exact blocked MMDLoss
+
+source and target are drawn from two slightly shifted Gaussians, every estimate is repeated on fresh samples
+to get its mean and standard deviation
+
+python benchmarks/benchmark_mmd.py
+"""
+
+import os
+import sys
+import time
+
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from modules import loss_modules
+
+
+BATCH_SIZES = [1024, 4096, 16384, 65536]
+NUM_FEATURES = 10
+SHIFT = 0.1
+REPEATS = 5
+INIT_PARAMS = {'kernel_mul': 2.0, 'kernel_num': 5, 'fix_sigma': [0.5 * NUM_FEATURES, NUM_FEATURES, 2. * NUM_FEATURES], 'unbiased': True}
+
+
+def make_losses():
+    return {
+        'mmd': loss_modules['mmd'](**INIT_PARAMS),
+        'mmd_rff': loss_modules['mmd_rff'](**INIT_PARAMS, seed=42),
+        'mmd_linear': loss_modules['mmd_linear'](**INIT_PARAMS),
+    }
+
+
+def main():
+
+    torch.manual_seed(0)
+
+    print(f"{'loss':>11} {'batch':>6} {'mean':>11} {'std':>11} {'time [s]':>9} {'fwd+bwd [s]':>12}")
+
+    for batch_size in BATCH_SIZES:
+        for name, loss_fn in make_losses().items():
+
+            values = []
+            t_forward = 0.
+            t_backward = 0.
+            for _ in range(REPEATS):
+
+                source = torch.randn(batch_size, NUM_FEATURES) + SHIFT
+                target = torch.randn(batch_size, NUM_FEATURES)
+
+                with torch.no_grad():
+                    start = time.perf_counter()
+                    values.append(loss_fn(source, target).item())
+                    t_forward += time.perf_counter() - start
+
+                source.requires_grad_(True)
+                start = time.perf_counter()
+                loss_fn(source, target).backward()
+                t_backward += time.perf_counter() - start
+
+            values = torch.tensor(values)
+            print(f"{name:>11} {batch_size:>6} {values.mean().item():>11.3e} {values.std().item():>11.3e} "
+                  f"{t_forward/REPEATS:>9.3f} {t_backward/REPEATS:>12.3f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,152 @@
+"""Micro-benchmark of the vectorized masked scalers against the old per-column loop,
+and of the FusedScalerPipeline against the chained nn.Sequential built by Scalers from config.json
+
+the vectorized scalers win at small batches and many columns, where the loop is dominated by the python
+overhead per column. With few columns and large batches the loop can be faster (it only writes the
+transformed columns, the vectorized path gathers and scatters them), the cases where the vectorized
+scalers are slower are listed at the end. The loop returns a transposed view, the time to make it
+contiguous (paid by the next op in the model) is shown separately.
+
+python benchmarks/benchmark_scalers.py
+"""
+
+import os
+import sys
+import time
+
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from modules import scaler_modules
+from config import Config
+from scalers import Scalers
+
+from export_checks import check_onnx, check_script
+
+
+NUM_FEATURES = [5, 15, 30, 60]
+BATCH_SIZES = [1024, 4096, 16384, 65536]
+REPEATS = 20
+
+
+def loop_forward(scaler, x):
+    # the way the scalers were applied before: transpose, loop over the columns, write each row
+    xt = torch.t(x)
+    x_ = torch.empty_like(xt)
+    for idim, dim in enumerate(xt):
+        if scaler._mask[idim]:
+            x_[idim] = scaler.transform(dim)
+        else:
+            x_[idim] = dim
+
+    return torch.t(x_)
+
+
+def make_scalers(num_features):
+    # every second column is transformed, which is about what we have in config.json
+    mask = [i % 2 for i in range(num_features)]
+    return {
+        'tanh': scaler_modules.TanhScaler(mask, norm=1200),
+        'tanh_inverse': scaler_modules.TanhInverseScaler(mask, norm=1200),
+        'log': scaler_modules.LogScaler(mask, base=10),
+        'log_inverse': scaler_modules.LogInverseScaler(mask, base=10),
+        'logit': scaler_modules.LogitScaler(mask, onnxcompatible=True),
+        'logit_inverse': scaler_modules.LogitInverseScaler(mask),
+    }
+
+
+def timeit(fn, x):
+    fn(x)
+    start = time.perf_counter()
+    for _ in range(REPEATS):
+        fn(x)
+    return (time.perf_counter() - start) / REPEATS
+
+
+def check_export(name, scaler, x):
+    check_script(name, scaler)
+    check_onnx(name, scaler, x[:8])
+
+
+def benchmark_pipelines(config_path):
+
+    scalers = Scalers(Config(config_path=config_path))
+
+    print(f"\n{'pipeline':>22} {'batch':>6} {'chained [ms]':>13} {'fused [ms]':>11} {'max abs diff':>13}")
+
+    for name, num_features, getter in [
+        ('input', len(scalers.input_features_dict), scalers.get_input_scalers),
+        ('input inverse', len(scalers.input_features_dict), scalers.get_input_inverse_scalers),
+        ('target', len(scalers.target_features_dict), scalers.get_target_scalers),
+        ('target inverse', len(scalers.target_features_dict), scalers.get_target_inverse_scalers),
+    ]:
+        chained = getter(fused=False)
+        fused = getter(fused=True)
+
+        for batch_size in BATCH_SIZES:
+
+            x = torch.rand(batch_size, num_features) * 0.98 + 0.01
+            if 'inverse' in name:
+                # feed the inverse pipelines with something the forward direction produces
+                forward_getter = scalers.get_input_scalers if name.startswith('input') else scalers.get_target_scalers
+                with torch.no_grad():
+                    x = forward_getter(fused=False)(x)
+
+            with torch.no_grad():
+                out_chained = chained(x)
+                out_fused = fused(x)
+
+                if not torch.allclose(out_chained, out_fused, rtol=1e-4, atol=1e-5, equal_nan=True):
+                    raise AssertionError(f"fused {name} pipeline differs from the chained modules")
+
+                t_chained = timeit(chained, x)
+                t_fused = timeit(fused, x)
+
+            max_diff = (out_chained - out_fused).abs().max().item()
+            print(f"{name:>22} {batch_size:>6} {t_chained*1e3:>13.3f} {t_fused*1e3:>11.3f} {max_diff:>13.2e}")
+
+        check_export(name, fused, x)
+
+
+def main():
+
+    torch.manual_seed(0)
+
+    print(f"{'scaler':>14} {'features':>8} {'batch':>6} {'loop [ms]':>10} {'loop+contiguous [ms]':>21} {'vectorized [ms]':>16} {'speed-up':>9}")
+
+    slower = []
+
+    for num_features in NUM_FEATURES:
+        for name, scaler in make_scalers(num_features).items():
+            for batch_size in BATCH_SIZES:
+
+                # values in (0, 1) are valid inputs for all the transformations
+                x = torch.rand(batch_size, num_features) * 0.98 + 0.01
+
+                with torch.no_grad():
+                    if not torch.allclose(loop_forward(scaler, x), scaler(x), atol=1e-6, equal_nan=True):
+                        print(f"  {name}: vectorized result differs from the loop!")
+
+                    t_loop = timeit(lambda x_: loop_forward(scaler, x_), x)
+                    t_loop_contiguous = timeit(lambda x_: loop_forward(scaler, x_).contiguous(), x)
+                    t_vectorized = timeit(scaler, x)
+
+                print(f"{name:>14} {num_features:>8} {batch_size:>6} {t_loop*1e3:>10.3f} {t_loop_contiguous*1e3:>21.3f} "
+                      f"{t_vectorized*1e3:>16.3f} {t_loop/t_vectorized:>8.2f}x")
+
+                if t_vectorized > t_loop:
+                    slower.append(f"{name} ({num_features} features, batch {batch_size}): {t_loop/t_vectorized:.2f}x")
+
+            check_export(name, scaler, x)
+
+    if slower:
+        print("\nThe vectorized scaler is slower than the loop for:")
+        for case in slower:
+            print(f"  {case}")
+
+    benchmark_pipelines(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'config.json'))
+
+
+if __name__ == '__main__':
+    main()
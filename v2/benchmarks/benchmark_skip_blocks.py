@@ -0,0 +1,115 @@
+"""Forward and forward+backward time of every LinearWithSkipConnection block of the model from config.json,
+against the old skip path that padded the identity with zeros and added it to the residual
+
+the outputs and gradients of both versions have to be identical, every block is also exported to ONNX (opset 11)
+
+python benchmarks/benchmark_skip_blocks.py
+"""
+
+import os
+import sys
+import time
+
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from config import Config
+from model import RefinementModelBuilder
+from scalers import Scalers
+
+from export_checks import check_onnx
+
+
+BATCH_SIZES = [1024, 8192]
+REPEATS = 50
+
+
+def padded_forward(block, x):
+    # the way the skip connection was computed before
+    if block._in_features < block._out_features:
+        if block._isfirst:
+            identity = torch.index_select(x, 1, torch.tensor(block._skipindices, device=x.device))
+        else:
+            identity = torch.index_select(x, 1, torch.tensor([idx for idx in range(len(block._skipindices))], device=x.device))
+        identity = torch.cat((identity, torch.zeros((identity.size(dim=0), block._out_features - len(block._skipindices)), device=x.device, dtype=x.dtype)), dim=1)
+    elif block._out_features < block._in_features:
+        if block._islast and len(block._skipindices) > block._n_vars:
+            identity = x[:, block._n_params:block._n_params+block._out_features]
+        else:
+            identity = x[:, :block._out_features]
+    else:
+        identity = x
+
+    residual = x
+    for ilayer, linear in enumerate(block._linears):
+        residual = linear(residual)
+        if not (block._islast and ilayer == block._nskiplayers-1):
+            residual = block._leakyrelus[ilayer](residual)
+
+    return residual + identity
+
+
+def build_blocks(config_path):
+
+    config = Config(config_path=config_path)
+    scalers = Scalers(config)
+
+    config.datasetInfo = {}
+    config.datasetInfo.inputDim = len(scalers.input_features_dict)
+    config.datasetInfo.targetDim = len(scalers.target_features_dict)
+    config.datasetInfo.train_numbatch = 0
+
+    model = RefinementModelBuilder(config).build()
+    # dropout is random, the blocks are compared in eval mode
+    model.eval()
+
+    return model.named_children()
+
+
+def timeit(fn, x, backward):
+    def run():
+        x.grad = None
+        out = fn(x)
+        if backward:
+            out.sum().backward()
+    run()
+    start = time.perf_counter()
+    for _ in range(REPEATS):
+        run()
+    return (time.perf_counter() - start) / REPEATS
+
+
+def main():
+
+    torch.manual_seed(0)
+
+    blocks = build_blocks(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'config.json'))
+
+    print(f"{'block':>28} {'batch':>6} {'padded fwd [ms]':>16} {'in-place fwd [ms]':>18} {'padded fwd+bwd [ms]':>20} {'in-place fwd+bwd [ms]':>22}")
+
+    for name, block in blocks:
+        for batch_size in BATCH_SIZES:
+
+            x = torch.randn(batch_size, block._in_features, requires_grad=True)
+
+            out_padded = padded_forward(block, x)
+            grad_padded, = torch.autograd.grad(out_padded.sum(), x)
+            out = block(x)
+            grad, = torch.autograd.grad(out.sum(), x)
+            if not (torch.equal(out_padded, out) and torch.equal(grad_padded, grad)):
+                raise AssertionError(f"{name}: in-place skip connection differs from the padded one")
+
+            with torch.no_grad():
+                t_padded = timeit(lambda x_: padded_forward(block, x_), x, backward=False)
+                t_inplace = timeit(block, x, backward=False)
+            t_padded_bwd = timeit(lambda x_: padded_forward(block, x_), x, backward=True)
+            t_inplace_bwd = timeit(block, x, backward=True)
+
+            print(f"{name:>28} {batch_size:>6} {t_padded*1e3:>16.3f} {t_inplace*1e3:>18.3f} {t_padded_bwd*1e3:>20.3f} {t_inplace_bwd*1e3:>22.3f}")
+
+        check_onnx(name, block, x[:8].detach())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+"""TorchScript and ONNX export checks shared by the benchmarks"""
+
+import inspect
+import io
+import traceback
+
+import torch
+
+
+def export_onnx(module, example, opset_version=11):
+    """Exports module with the TorchScript based exporter, returns the ONNX bytes
+
+    newer torch versions default to the dynamo exporter, which exports with its own opset and then
+    converts the model to opset_version, that conversion fails for opset 11. The TorchScript exporter
+    writes opset_version directly, like convertONNX.py does.
+    """
+
+    kwargs = {}
+    if 'dynamo' in inspect.signature(torch.onnx.export).parameters:
+        kwargs['dynamo'] = False
+
+    f = io.BytesIO()
+    torch.onnx.export(module, example, f, opset_version=opset_version, **kwargs)
+
+    return f.getvalue()
+
+
+def check_onnx(name, module, example, opset_version=11):
+    """Prints the full traceback if the export fails, and checks the opset of the model if onnx is installed"""
+
+    try:
+        model_bytes = export_onnx(module, example, opset_version)
+    except Exception:
+        print(f"  {name}: ONNX export (opset {opset_version}) failed:")
+        traceback.print_exc()
+        return False
+
+    try:
+        import onnx
+    except ImportError:
+        return True
+
+    opsets = [opset.version for opset in onnx.load_from_string(model_bytes).opset_import if opset.domain in ('', 'ai.onnx')]
+    if opsets != [opset_version]:
+        print(f"  {name}: ONNX export has opset {opsets} instead of {opset_version}")
+        return False
+
+    return True
+
+
+def check_script(name, module):
+
+    try:
+        torch.jit.script(module)
+    except Exception:
+        print(f"  {name}: TorchScript failed:")
+        traceback.print_exc()
+        return False
+
+    return True
@@ -0,0 +1,99 @@
+import hashlib
+import json
+import os
+import re
+import time
+
+import torch
+
+
+# training settings that only set how long or where the training runs, or how it is logged, but not the result
+# of an epoch. A stopped or finished training can be continued with more epochs.
+RUN_SETTINGS = ['epochs', 'checkpoint', 'device', 'pinMemory', 'asyncLossLogging']
+
+
+def config_hash(config: dict) -> str:
+    """Hash of the model, loss and training settings of a configuration dictionary, a checkpoint is only resumed with the same ones"""
+
+    settings = {
+        'modelSettings': config.get('modelSettings'),
+        'losses': config.get('losses'),
+        'trainingSettings': {key: value for key, value in config.get('trainingSettings', {}).items() if key not in RUN_SETTINGS},
+        # only the configured features, the derived lists are built in an arbitrary order
+        'features': {key: config['features'].get(key) for key in ['parameters', 'variables', 'spectators']},
+        'scalers': config.get('scalers'),
+    }
+
+    return hashlib.sha256(json.dumps(settings, sort_keys=True).encode()).hexdigest()
+
+
+class CheckpointManager:
+    """Periodic training checkpoints in output_path/checkpoints/
+
+    a checkpoint is written every every_epochs epochs or when every_minutes have passed since the last one,
+    only the keep newest are kept. Every file is written to a temporary file first, synced and then renamed,
+    so a job that is killed while writing never leaves a broken checkpoint behind.
+    """
+
+    prefix = "checkpoint_epoch"
+
+    def __init__(self, output_path: str, every_epochs: int = 10, every_minutes: float = None, keep: int = 2):
+
+        self.directory = output_path + "checkpoints/"
+        self.every_epochs = every_epochs
+        self.every_minutes = every_minutes
+        self.keep = keep
+        self._last_save = time.monotonic()
+
+        os.makedirs(self.directory, exist_ok=True)
+
+    def checkpoints(self) -> list:
+        """Paths of the checkpoints, oldest first"""
+
+        pattern = re.compile(rf"{self.prefix}(\d+)\.pt$")
+        found = []
+        for name in os.listdir(self.directory):
+            match = pattern.match(name)
+            if match:
+                found.append((int(match.group(1)), self.directory + name))
+
+        return [path for _, path in sorted(found)]
+
+    def is_due(self, epoch: int) -> bool:
+
+        if self.every_epochs and (epoch + 1) % self.every_epochs == 0:
+            return True
+
+        return self.every_minutes is not None and time.monotonic() - self._last_save >= 60 * self.every_minutes
+
+    def save(self, state: dict, epoch: int):
+
+        path = f"{self.directory}{self.prefix}{epoch:06d}.pt"
+        tmp_path = path + ".tmp"
+
+        with open(tmp_path, 'wb') as f:
+            torch.save(state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+        self._last_save = time.monotonic()
+
+        for old_path in self.checkpoints()[:-self.keep] if self.keep else []:
+            os.remove(old_path)
+
+    def load_latest(self, map_location=None):
+        """State of the newest checkpoint that can be read, None if there is none"""
+
+        for path in reversed(self.checkpoints()):
+            try:
+                # our own files, they hold numpy arrays and the python RNG state next to the tensors
+                state = torch.load(path, map_location=map_location, weights_only=False)
+            except Exception as e:
+                print(f"Could not read checkpoint {path}: {e}")
+                continue
+
+            print(f"Loaded checkpoint {path}")
+            return state
+
+        return None
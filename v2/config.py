@@ -42,6 +42,20 @@ class Config(ConfigDict):
 
     def process_config(self):
         self.process_features()
+        self.check_ensemble()
+
+    def check_ensemble(self):
+        """Ensembles (modelSettings.ensembleSize > 1) are trained without checkpoints and early stopping"""
+
+        ensemble_size = self.config_dict.get('modelSettings', {}).get('ensembleSize') or 1
+        if ensemble_size <= 1:
+            return
+
+        training_settings = self.config_dict.get('trainingSettings', {})
+        for key in ['checkpoint', 'earlyStopping']:
+            setting = training_settings.get(key)
+            if setting and setting.get('enabled', True):
+                raise ValueError(f"trainingSettings.{key} is not supported for ensembles (modelSettings.ensembleSize = {ensemble_size}), disable it")
 
     def process_features(self):
 
@@ -2,29 +2,337 @@ import ROOT
 import numpy as np
 import pandas as pd
 import torch
+import glob
+import os
+
+from tensor_cache import TensorCache
 
 from typing import TYPE_CHECKING
 
 if TYPE_CHECKING:
     from config import Config
 
+class FastTensorBatchLoader:
+    """Drop-in replacement for torch.utils.data.DataLoader over dense in-memory tensors
+
+    the split is kept as an index tensor and every batch is drawn with one index_select per tensor,
+    instead of fetching the rows one by one from a TensorDataset and collating them again
+    """
+
+    def __init__(self, tensors, indices, batch_size, shuffle=False, seed=None, pin_memory=False):
+
+        self.tensors = tuple(tensors)
+        self.indices = torch.as_tensor(indices, dtype=torch.long)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.generator = torch.Generator()
+        if seed is not None:
+            self.generator.manual_seed(seed)
+
+        # pinning only makes sense for host tensors that are copied to a GPU later on
+        self.pin_memory = pin_memory and torch.cuda.is_available() and self.tensors[0].device.type == 'cpu'
+
+        # same interface as the Subset a torch DataLoader would hold
+        self.dataset = torch.utils.data.Subset(torch.utils.data.TensorDataset(*self.tensors), self.indices)
+
+    def __len__(self):
+        return (len(self.indices) + self.batch_size - 1) // self.batch_size
+
+    def __iter__(self):
+
+        indices = self.indices
+        if self.shuffle:
+            indices = indices[torch.randperm(len(indices), generator=self.generator)]
+        indices = indices.to(self.tensors[0].device)
+
+        for batch_indices in torch.split(indices, self.batch_size):
+            batch = tuple(torch.index_select(t, 0, batch_indices) for t in self.tensors)
+            if self.pin_memory:
+                batch = tuple(t.pin_memory() for t in batch)
+            yield batch
+
+
+# multiplicative (Fibonacci) hash of EventID into SPLIT_BUCKETS buckets, jets of the same event end up in the same split
+SPLIT_BUCKETS = 1024
+SPLIT_HASH = "(static_cast<ULong64_t>({event_id}) * 11400714819323198485ull) >> 54"
+
+# smallest entry window per thread of DataLoader.load_data_mt, a few clusters of a typical tree
+MT_WINDOW_ENTRIES_PER_THREAD = 100000
+
+
+def resolve_files(file_path) -> list:
+    """inputSettings.filePath as a list of files
+
+    it can be a path, a glob or a list of them, the matches of a glob are sorted so that the order of the
+    files (and so of the rows) doesn't depend on the file system
+    """
+
+    patterns = file_path if isinstance(file_path, list) else [file_path]
+
+    files = []
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern)) if any(c in pattern for c in '*?[') else [pattern]
+        if not matches:
+            raise ValueError(f"No input files match {pattern}")
+        files += matches
+
+    return list(dict.fromkeys(files))
+
+
+def enable_implicit_mt(num_threads):
+    """ROOT implicit multithreading with num_threads threads, -1 for all cores, 0 or None to keep it off"""
+
+    if not num_threads or ROOT.IsImplicitMTEnabled():
+        return
+    if num_threads < 0:
+        ROOT.EnableImplicitMT()
+    else:
+        ROOT.EnableImplicitMT(num_threads)
+    print(f"ROOT implicit multithreading with {ROOT.GetThreadPoolSize()} threads")
+
+
+def columns_to_tensors(columns: dict, feature_lists):
+    """One contiguous float32 tensor of shape (rows, features) per list of features
+
+    the matrices are allocated once and every column is cast and copied straight into its place, then it is
+    removed from columns, so the arrays read from the file are released one by one instead of being stacked
+    into temporary copies. A column that is needed by several lists (e.g. a parameter that is also a spectator)
+    is read once and copied into each of them. The tensors share the memory of the numpy matrices.
+    """
+
+    num_rows = len(next(iter(columns.values()))) if columns else 0
+    matrices = [np.empty((num_rows, len(features)), dtype=np.float32) for features in feature_lists]
+
+    positions = {}
+    for matrix, features in zip(matrices, feature_lists):
+        for icolumn, var in enumerate(features):
+            positions.setdefault(var, []).append((matrix, icolumn))
+
+    for var, targets in positions.items():
+        column = columns.pop(var)
+        for matrix, icolumn in targets:
+            matrix[:, icolumn] = column
+        del column
+
+    return [torch.from_numpy(matrix) for matrix in matrices]
+
+
+def entry_range_dataframe(tree_name, path, begin, end):
+    """RDataFrame over the entries [begin, end) of the tree in one file
+
+    the range is a global entry range of the dataset, the event loop starts at begin (with implicit
+    multithreading only the clusters overlapping the range are processed), instead of stepping through all
+    entries before it like Range or a filter on rdfentry_ do
+    """
+
+    spec = ROOT.RDF.Experimental.RDatasetSpec()
+    spec.AddSample(ROOT.RDF.Experimental.RSample(tree_name, tree_name, path))
+    spec.WithGlobalRange(ROOT.RDF.Experimental.RDatasetSpec.REntryRange(begin, end))
+
+    return ROOT.RDataFrame(spec)
+
+
+def split_bucket_ranges(fractions):
+    """[start, stop) hash buckets of the train/validation/test splits for the given fractions"""
+
+    edges = np.round(np.cumsum([0.] + list(fractions)) / sum(fractions) * SPLIT_BUCKETS).astype(int)
+    return [(int(edges[i]), int(edges[i+1])) for i in range(len(fractions))]
+
+
+class RootStreamingDataset(torch.utils.data.IterableDataset):
+    """Batches of one split streamed from a ROOT file, for datasets that don't fit into memory
+
+    the tree is read in windows of chunk_size entries, the preselection and the split assignment (a hash of
+    EventID) are applied per window. With shuffle the order of the windows is random and the rows go through a
+    shuffle buffer of at most shuffle_buffer rows, so the memory needed is bounded by the window and the
+    buffer, not by the size of the file. With several DataLoader workers every worker reads its own share of
+    the windows.
+
+    Every window is read from a graph over only its own entries (see window_node), so an epoch goes over every
+    entry of the files once per split. The selection strings are jitted again for every window, a fixed cost
+    per window that doesn't grow with the size of the files.
+    """
+
+    def __init__(self, tree_name, files, preselection, input_features, target_features, spectator_features,
+                 bucket_range, batch_size, chunk_size=200000, shuffle_buffer=0, event_id='EventID'):
+
+        super(RootStreamingDataset, self).__init__()
+
+        self.tree_name = tree_name
+        self.files = list(files)
+        self.preselection = preselection
+        self.input_features = list(input_features)
+        self.target_features = list(target_features)
+        self.spectator_features = list(spectator_features)
+        self.bucket_range = bucket_range
+        self.batch_size = batch_size
+        self.chunk_size = chunk_size
+        self.shuffle_buffer = shuffle_buffer
+        self.event_id = event_id
+
+        # set by StreamLoader before every epoch
+        self.seed = 0
+
+        self.file_entries = []
+        for path in self.files:
+            root_file = ROOT.TFile.Open(path)
+            self.file_entries.append(int(root_file.Get(tree_name).GetEntries()))
+            root_file.Close()
+        self.num_entries = sum(self.file_entries)
+
+    def windows(self):
+        return [(path, begin, min(begin + self.chunk_size, num_entries))
+                for path, num_entries in zip(self.files, self.file_entries) for begin in range(0, num_entries, self.chunk_size)]
+
+    def window_node(self, path, begin, end):
+        """Selected rows of the split in the entries [begin, end) of a file
+
+        the graph starts at begin and stops at end (entry_range_dataframe), so reading a window costs its own
+        entries only. With implicit multithreading the threads process the clusters in any order, the entry
+        number is read along to put the rows back into entry order.
+        """
+
+        rdf = entry_range_dataframe(self.tree_name, path, begin, end)
+        if self.preselection:
+            rdf = rdf.Filter(self.preselection)
+        rdf = rdf.Define('_split_bucket', SPLIT_HASH.format(event_id=self.event_id))
+        rdf = rdf.Filter(f"_split_bucket >= {self.bucket_range[0]} && _split_bucket < {self.bucket_range[1]}")
+        if ROOT.IsImplicitMTEnabled():
+            rdf = rdf.Define('_entry', 'rdfentry_')
+
+        return rdf
+
+    def read_window(self, path, begin, end):
+        """Inputs, targets and spectators of the selected rows of the split in the entries [begin, end) of a file"""
+
+        implicit_mt = ROOT.IsImplicitMTEnabled()
+        rdf = self.window_node(path, begin, end)
+
+        column_names = list(dict.fromkeys(self.input_features + self.target_features + self.spectator_features))
+        columns = rdf.AsNumpy(column_names + ['_entry'] if implicit_mt else column_names)
+        if implicit_mt:
+            order = np.argsort(columns.pop('_entry'), kind='stable')
+            columns = {var: columns.pop(var)[order] for var in column_names}
+
+        tensors = columns_to_tensors(columns, (self.input_features, self.target_features, self.spectator_features))
+
+        keep = torch.ones(tensors[0].size(0), dtype=torch.bool)
+        for tensor in tensors:
+            keep &= torch.isfinite(tensor).all(dim=1)
+
+        return tuple(tensor[keep] for tensor in tensors)
+
+    def chunks(self, shuffle=False, generator=None):
+
+        windows = self.windows()
+        if shuffle:
+            windows = [windows[i] for i in torch.randperm(len(windows), generator=generator).tolist()]
+
+        worker_info = torch.utils.data.get_worker_info()
+        if worker_info is not None:
+            windows = windows[worker_info.id::worker_info.num_workers]
+
+        for path, begin, end in windows:
+            chunk = self.read_window(path, begin, end)
+            if chunk[0].size(0) > 0:
+                yield chunk
+
+    def batches(self, rows, generator=None):
+
+        if generator is not None:
+            rows = tuple(t[torch.randperm(rows[0].size(0), generator=generator)] for t in rows)
+        for start in range(0, rows[0].size(0), self.batch_size):
+            yield tuple(t[start:start + self.batch_size] for t in rows)
+
+    def __iter__(self):
+
+        shuffle = self.shuffle_buffer > 0
+        worker_info = torch.utils.data.get_worker_info()
+
+        # the windows are shuffled the same way in every worker (each takes its share of them), the buffers differently
+        window_generator = torch.Generator().manual_seed(self.seed)
+        generator = torch.Generator().manual_seed(self.seed if worker_info is None else self.seed + worker_info.id + 1)
+
+        pool = None
+        for chunk in self.chunks(shuffle, window_generator):
+
+            pool = chunk if pool is None else tuple(torch.cat((p, c)) for p, c in zip(pool, chunk))
+
+            if not shuffle:
+                # only full batches, the rest is carried over to the next window
+                num_full = pool[0].size(0) // self.batch_size * self.batch_size
+                yield from self.batches(tuple(t[:num_full] for t in pool))
+                pool = tuple(t[num_full:] for t in pool)
+
+            elif pool[0].size(0) >= self.shuffle_buffer:
+                # draw half of the buffer in random order, the other half stays for mixing with the next windows
+                pool = tuple(t[torch.randperm(pool[0].size(0), generator=generator)] for t in pool)
+                num_out = (pool[0].size(0) - self.shuffle_buffer // 2) // self.batch_size * self.batch_size
+                yield from self.batches(tuple(t[:num_out] for t in pool))
+                pool = tuple(t[num_out:] for t in pool)
+
+        if pool is not None and pool[0].size(0) > 0:
+            yield from self.batches(pool, generator if shuffle else None)
+
+    def sample(self, num_samples):
+        """The first num_samples selected rows of the split (inputs and targets), read window by window"""
+
+        inputs, targets = [], []
+        num_read = 0
+        for chunk in self.chunks():
+            inputs.append(chunk[0])
+            targets.append(chunk[1])
+            num_read += chunk[0].size(0)
+            if num_read >= num_samples:
+                break
+
+        return torch.cat(inputs)[:num_samples], torch.cat(targets)[:num_samples]
+
+
+class StreamLoader:
+    """Iterates a RootStreamingDataset through a torch DataLoader, with a new shuffling seed for every epoch
+
+    the seeds are drawn from generator, so its state (saved in the checkpoints) fixes the order of the coming epochs
+    """
+
+    def __init__(self, stream: RootStreamingDataset, num_workers=0, seed=None, pin_memory=False):
+
+        self.dataset = stream
+        self.generator = torch.Generator()
+        if seed is not None:
+            self.generator.manual_seed(seed)
+        self.loader = torch.utils.data.DataLoader(stream, batch_size=None, num_workers=num_workers,
+                                                  pin_memory=pin_memory and torch.cuda.is_available())
+
+    def __iter__(self):
+        self.dataset.seed = int(torch.randint(2**62, (1,), generator=self.generator))
+        return iter(self.loader)
+
+
 class DataLoader():
     def __init__(self, config:"Config"):
         
         self.read_config(config = config)
-        self.load_data()
+        if not self.load_cache():
+            self.load_data()
+            self.convert_tensor()
+            self.save_cache()
+        self.drop_nonfinite()
         self.extract_dicts()
-        self.convert_tensor()
         self.create_dataloader()  
 
     def read_config(self, config:"Config"):
         self.treeName = config.inputSettings.treeName
         self.filePath = config.inputSettings.filePath
+        self.files = resolve_files(self.filePath)
+        self.numThreads = config.inputSettings.numThreads
         self.preselection = config.inputSettings.preselection
 
         self.batchSize = config.trainingSettings.batchSize
         self.numBatches = config.trainingSettings.numBatches
         self.randomSeed = config.trainingSettings.randomSeed
+        self.fastBatchLoader = config.trainingSettings.fastBatchLoader
+        self.pinMemory = config.trainingSettings.pinMemory
 
         self.numTrain = self.numBatches[0] * self.batchSize
         self.numVal = self.numBatches[1] * self.batchSize
@@ -41,60 +349,232 @@ class DataLoader():
         self.input_features = list(self.input_features_dict.keys())
         self.target_features = list(self.target_features_dict.keys())
 
-    def load_data(self):
+        cache_config = config.inputSettings.cache
+        self.cache = None
+        if cache_config and cache_config.get('enabled', True):
+            if all(os.path.exists(path) for path in self.files):
+                directory = cache_config.get('directory') or os.path.join(os.path.expanduser('~'), '.cache', 'refinement')
+                max_size = cache_config.get('maxSizeGB')
+                self.cache = TensorCache(directory, max_bytes=int(max_size * 1024**3) if max_size else None)
+            else:
+                print("Not all input files are local, the dataset is not cached")
 
-        rdf = ROOT.RDataFrame(
-            self.treeName, 
-            self.filePath
-            ).Filter(self.preselection)
-        
-        if self.numTest == 0:
-            rdf = rdf.Range(self.numTrain + self.numVal)
-        else:
-            rdf = rdf.Range(self.numTrain + self.numVal + self.numTest)
+    def cache_key(self) -> str:
 
-        self.rdf_numpy = rdf.AsNumpy(self.input_features + self.target_features + self.spectator_features)
-            
-    def extract_dicts(self):
-        self.dict_input = {var: self.rdf_numpy[var] for var in self.input_features}
-        self.dict_target = {var: self.rdf_numpy[var] for var in self.target_features}
-        self.dict_spectators = {var: self.rdf_numpy[var] for var in self.spectator_features}
+        return self.cache.make_key({
+            'files': [TensorCache.file_signature(path) for path in self.files],
+            'treeName': self.treeName,
+            'preselection': self.preselection,
+            'features': [self.input_features, self.target_features, self.spectator_features],
+            'numRows': self.numTrain + self.numVal + self.numTest,
+        })
+
+    def load_cache(self) -> bool:
+        """Opens the matrices from the cache, before the non-finite rows are dropped, returns False on a miss"""
+
+        if self.cache is None:
+            return False
+
+        tensors = self.cache.load(self.cache_key())
+        if tensors is None:
+            return False
+
+        self.data_input, self.data_target, self.data_spectators = tensors['input'], tensors['target'], tensors['spectators']
+        print(f"Loaded the dataset from the cache in {self.cache.directory}")
+        return True
+
+    def save_cache(self):
+
+        if self.cache is None:
+            return
+
+        settings = {'filePath': self.filePath, 'treeName': self.treeName, 'preselection': self.preselection}
+        self.cache.save(self.cache_key(), {'input': self.data_input, 'target': self.data_target, 'spectators': self.data_spectators}, settings)
+
+    def load_data(self):
+
+        # every branch once, also the ones that are used as input and spectator
+        columns = list(dict.fromkeys(self.input_features + self.target_features + self.spectator_features))
+        num_rows = self.numTrain + self.numVal + self.numTest
+
+        enable_implicit_mt(self.numThreads)
+
+        if not ROOT.IsImplicitMTEnabled():
+            rdf = ROOT.RDataFrame(self.treeName, self.files)
+            if self.preselection:
+                rdf = rdf.Filter(self.preselection)
+            rdf = rdf.Range(num_rows)
+            self.rdf_numpy = rdf.AsNumpy(columns)
+            return
+
+        self.rdf_numpy = self.load_data_mt(columns, num_rows)
+
+    def load_data_mt(self, columns, num_rows):
+        """The first num_rows selected rows, like Filter(...).Range(num_rows), with implicit multithreading
+
+        Range isn't allowed with implicit multithreading, so the files are read one after the other in entry
+        windows with all threads, every window from a graph over only its own entries (entry_range_dataframe).
+        The windows are sized with the fraction of entries that passed the selection so far, so only about as
+        many rows as needed are read instead of whole files, and they have at least MT_WINDOW_ENTRIES_PER_THREAD
+        entries per thread, so that every thread gets clusters to read. The rows of every window are put back
+        into entry order (the threads process the clusters in any order).
+        """
+
+        min_size = MT_WINDOW_ENTRIES_PER_THREAD * ROOT.GetThreadPoolSize()
+
+        parts = []
+        num_read = 0
+        num_scanned = 0
+        for path in self.files:
+
+            root_file = ROOT.TFile.Open(path)
+            num_entries = int(root_file.Get(self.treeName).GetEntries())
+            root_file.Close()
+
+            begin = 0
+            while begin < num_entries and num_read < num_rows:
+
+                missing = num_rows - num_read
+                if num_read > 0:
+                    # 10% more than the expected number of entries for the missing rows
+                    size = int(1.1 * missing * num_scanned / num_read) + 1
+                elif num_scanned > 0:
+                    # nothing passed the selection yet
+                    size = 2 * num_scanned
+                else:
+                    size = missing
+                end = min(begin + max(size, min_size), num_entries)
+
+                rdf = entry_range_dataframe(self.treeName, path, begin, end)
+                if self.preselection:
+                    rdf = rdf.Filter(self.preselection)
+                part = rdf.Define('_entry', 'rdfentry_').AsNumpy(columns + ['_entry'])
+
+                order = np.argsort(part.pop('_entry'), kind='stable')
+                parts.append({var: part.pop(var)[order] for var in columns})
+                num_read += len(order)
+                num_scanned += end - begin
+                begin = end
+
+            if num_read >= num_rows:
+                break
+
+        return {var: np.concatenate([part.pop(var) for part in parts])[:num_rows] for var in columns}
 
     def convert_tensor(self):
-        self.data_input = torch.tensor(np.stack(list(self.dict_input.values()), axis=1), dtype=torch.float32)
-        self.data_target = torch.tensor(np.stack(list(self.dict_target.values()), axis=1), dtype=torch.float32)
-        self.data_spectators = torch.tensor(np.stack(list(self.dict_spectators.values()), axis=1), dtype=torch.float32)
+
+        # the columns of rdf_numpy are released while they are copied
+        self.data_input, self.data_target, self.data_spectators = columns_to_tensors(
+            self.rdf_numpy, (self.input_features, self.target_features, self.spectator_features))
+        self.rdf_numpy = None
+
+    def extract_dicts(self):
+        # views of the columns of the tensors, no copies
+        self.dict_input = {var: self.data_input[:, i] for i, var in enumerate(self.input_features)}
+        self.dict_target = {var: self.data_target[:, i] for i, var in enumerate(self.target_features)}
+        self.dict_spectators = {var: self.data_spectators[:, i] for i, var in enumerate(self.spectator_features)}
+
+    def drop_nonfinite(self):
+        """Drops every row with a nan or inf in its inputs, targets or spectators with one vectorized mask"""
+
+        nonfinite_counts = {}
+        keep = torch.ones(self.data_input.size(0), dtype=torch.bool)
+
+        for data, features in [(self.data_input, self.input_features),
+                               (self.data_target, self.target_features),
+                               (self.data_spectators, self.spectator_features)]:
+            finite = torch.isfinite(data)
+            keep &= finite.all(dim=1)
+            for feature, count in zip(features, (~finite).sum(dim=0).tolist()):
+                if count > 0:
+                    nonfinite_counts[feature] = count
+
+        self.nonfinite_counts = nonfinite_counts
+        self.numDropped = int((~keep).sum())
+
+        if self.numDropped > 0:
+            self.data_input = self.data_input[keep]
+            self.data_target = self.data_target[keep]
+            self.data_spectators = self.data_spectators[keep]
 
     def create_dataloader(self):
 
         dataset = torch.utils.data.TensorDataset(self.data_input, self.data_target, self.data_spectators)
 
-        if self.numTest == 0:
+        if self.numTest == 0 or len(dataset) < self.numTrain + self.numVal + self.numTest:
+            # the test split takes whatever is left after dropping the non-finite rows
             self.numTest = len(dataset) - (self.numTrain + self.numVal)
 
+        if self.numTest < 0:
+            raise ValueError(f"Only {len(dataset)} finite samples available, choose smaller/fewer batches.")
+
         train_dataset, val_dataset, test_dataset = torch.utils.data.random_split(
             dataset, [self.numTrain, self.numVal, self.numTest],
             generator=torch.Generator().manual_seed(self.randomSeed)
         )
+        self.split_indices = [train_dataset.indices, val_dataset.indices, test_dataset.indices]
+
+        return self.wrap_datasets(train_dataset, val_dataset, test_dataset)
 
-        def collate_fn(batch_):
-            batch_ = list(filter(lambda x: torch.all(torch.isfinite(torch.cat(x))), batch_))
-            return torch.utils.data.dataloader.default_collate(batch_)
+    def wrap_datasets(self, train_dataset, val_dataset, test_dataset):
 
+        if self.fastBatchLoader:
+            return tuple(
+                FastTensorBatchLoader(split.dataset.tensors, split.indices, batch_size=self.batchSize,
+                                      shuffle=shuffle, seed=self.randomSeed, pin_memory=self.pinMemory)
+                for split, shuffle in [(train_dataset, True), (val_dataset, False), (test_dataset, False)]
+            )
 
-        train_loader = torch.utils.data.DataLoader(train_dataset, batch_size=self.batchSize, shuffle=True, collate_fn=collate_fn)
-        validation_loader = torch.utils.data.DataLoader(val_dataset, batch_size=self.batchSize, shuffle=False, collate_fn=collate_fn)
-        test_loader = torch.utils.data.DataLoader(test_dataset, batch_size=self.batchSize, shuffle=False, collate_fn=collate_fn)
+        train_loader = torch.utils.data.DataLoader(train_dataset, batch_size=self.batchSize, shuffle=True)
+        validation_loader = torch.utils.data.DataLoader(val_dataset, batch_size=self.batchSize, shuffle=False)
+        test_loader = torch.utils.data.DataLoader(test_dataset, batch_size=self.batchSize, shuffle=False)
 
         return train_loader, validation_loader, test_loader
+
+    def prescale(self, input_scalers, target_scalers, device, chunk_size=65536):
+        """Applies the (parameter-free) scalers once to the whole dataset
+
+        the transformed tensors are kept on the training device if they fit there, the returned loaders
+        use the same train/validation/test split as the raw ones
+        """
+
+        nbytes = sum(t.element_size() * t.nelement() for t in (self.data_input, self.data_target, self.data_spectators))
+        storage_device = device if fits_on_device(nbytes, device) else torch.device('cpu')
+
+        with torch.no_grad():
+            self.scaled_input = torch.cat([input_scalers(chunk.to(device)).to(storage_device) for chunk in torch.split(self.data_input, chunk_size)])
+            self.scaled_target = torch.cat([target_scalers(chunk.to(device)).to(storage_device) for chunk in torch.split(self.data_target, chunk_size)])
+        scaled_spectators = self.data_spectators.to(storage_device)
+
+        print(f"Pre-scaled dataset stored on {storage_device}")
+
+        dataset = torch.utils.data.TensorDataset(self.scaled_input, self.scaled_target, scaled_spectators)
+
+        return self.wrap_datasets(*[torch.utils.data.Subset(dataset, indices) for indices in self.split_indices])
     
 
+def fits_on_device(nbytes, device, max_fraction=0.5):
+    """Checks if nbytes can be put on the device without taking more than max_fraction of its free memory"""
+
+    device = torch.device(device)
+    if device.type != 'cuda':
+        return True
+
+    free, _ = torch.cuda.mem_get_info(device)
+    return nbytes < max_fraction * free
+
+
 class Dataset:
 
+    # rows per split written by save_root, None for all
+    max_saved_samples = None
+
     def __init__(self, config:"Config"):
         
         self.config = config
         dataloader = DataLoader(config)
+        self.dataloader = dataloader
+        self.prescaled = False
         train_loader, validation_loader, test_loader = dataloader.create_dataloader()
         
         self.dict_input = dataloader.dict_input        
@@ -105,6 +585,11 @@ class Dataset:
         self.validation = validation_loader
         self.test = test_loader
 
+        # the unscaled loaders, used to write the outputs
+        self.raw_train = train_loader
+        self.raw_validation = validation_loader
+        self.raw_test = test_loader
+
         config.datasetInfo = {}
         config.datasetInfo.train_numbatch = len(train_loader)
         config.datasetInfo.validation_numbatch = len(validation_loader)
@@ -120,6 +605,33 @@ class Dataset:
         config.datasetInfo.validationTotalSamples = len(validation_loader.dataset)
         config.datasetInfo.testTotalSamples = len(test_loader.dataset)
 
+        config.datasetInfo.droppedSamples = dataloader.numDropped
+        config.datasetInfo.nonfiniteCounts = dataloader.nonfinite_counts
+
+    def reset(self):
+        """Restores the unscaled loaders with freshly seeded shuffling, so that one Dataset can be used by
+        several trainings in a row and each of them sees the same batches as with a newly loaded Dataset"""
+
+        self.train, self.validation, self.test = self.dataloader.create_dataloader()
+        self.raw_train, self.raw_validation, self.raw_test = self.train, self.validation, self.test
+        self.prescaled = False
+
+    def sample_train(self, num_samples, seed=0):
+        """Random rows of the training split, unscaled inputs and targets"""
+
+        indices = torch.as_tensor(self.dataloader.split_indices[0])
+        generator = torch.Generator().manual_seed(seed)
+        indices = indices[torch.randperm(len(indices), generator=generator)[:num_samples]]
+
+        return self.dataloader.data_input[indices], self.dataloader.data_target[indices]
+
+    def prescale(self, input_scalers, target_scalers, device):
+        """Switches train/validation/test to loaders that return already scaled inputs and targets,
+        so the scalers don't have to be applied to every batch of every epoch"""
+
+        self.train, self.validation, self.test = self.dataloader.prescale(input_scalers, target_scalers, device)
+        self.prescaled = True
+
     def print_summary(self):
         print("#"*50)
         print("Dataset summary:")
@@ -130,6 +642,11 @@ class Dataset:
         print(f"Input: {self.config.datasetInfo.inputDim} features")
         print(f"Target: {self.config.datasetInfo.targetDim} features")
         print(f"Spectators: {self.config.datasetInfo.spectatorsDim} features")
+        if self.config.datasetInfo.droppedSamples > 0:
+            print("-"*50)
+            print(f"Dropped {self.config.datasetInfo.droppedSamples} samples with non-finite values:")
+            for feature, count in self.config.datasetInfo.nonfiniteCounts.items():
+                print(f"  {feature}: {count}")
         print("#"*50)
     
     def get_summary(self):
@@ -155,6 +672,10 @@ class Dataset:
             },
             "spectators": {
                 "dim": self.config.datasetInfo.spectatorsDim,
+            },
+            "dropped": {
+                "total_samples": self.config.datasetInfo.droppedSamples,
+                "nonfinite_per_feature": dict(self.config.datasetInfo.nonfiniteCounts),
             }
         }
 
@@ -164,15 +685,20 @@ class Dataset:
     def process_dataset_split(self, model, split_type):
 
         if split_type == 0:
-            dataloader = self.train
+            dataloader = self.raw_train
         elif split_type == 1:
-            dataloader = self.validation
+            dataloader = self.raw_validation
         elif split_type == 2:
-            dataloader = self.test
+            dataloader = self.raw_test
         else:
             raise ValueError("Invalid split type")
 
+        num_samples = 0
         for i, (inp, target, spectators) in enumerate(dataloader):
+            if self.max_saved_samples is not None and num_samples >= self.max_saved_samples:
+                break
+            num_samples += inp.size(0)
+
             out = model(inp)
             
             self.out_dict['isTrainValTest'].append(torch.ones(inp.size(dim=0), dtype=torch.int) * split_type)
@@ -217,4 +743,91 @@ class Dataset:
             self.out_dict[branch] = torch.cat(self.out_dict[branch]).detach().cpu().numpy()
     
         out_rdf = ROOT.RDF.FromNumpy(self.out_dict)
-        out_rdf.Snapshot(treename, path)
\ No newline at end of file
+        out_rdf.Snapshot(treename, path)
+
+
+class StreamingDataset(Dataset):
+    """Dataset that streams the batches from the ROOT file instead of loading it (inputSettings.streaming)
+
+    the splits are assigned by a hash of EventID with the fractions of splitFractions, numBatches is not used,
+    every epoch goes over the whole file. The data can't be pre-scaled and save_root writes at most
+    maxSavedSamples rows per split.
+    """
+
+    def __init__(self, config:"Config"):
+
+        self.config = config
+        self.prescaled = False
+
+        streaming = config.inputSettings.streaming
+        features = config.features
+        self.dict_input = dict.fromkeys(features.input_features.keys())
+        self.dict_target = dict.fromkeys(features.target_features.keys())
+        self.dict_spectators = dict.fromkeys(features.spectator_features)
+        self.max_saved_samples = streaming.get('maxSavedSamples', 1000000)
+        self.num_workers = streaming.get('numWorkers', 0)
+        self.random_seed = config.trainingSettings.randomSeed
+        self.pin_memory = config.trainingSettings.pinMemory
+
+        self.streams = [
+            RootStreamingDataset(config.inputSettings.treeName, resolve_files(config.inputSettings.filePath), config.inputSettings.preselection,
+                                 self.dict_input.keys(), self.dict_target.keys(), self.dict_spectators.keys(),
+                                 bucket_range=bucket_range,
+                                 batch_size=config.trainingSettings.batchSize,
+                                 chunk_size=streaming.get('chunkSize', 200000),
+                                 shuffle_buffer=streaming.get('shuffleBuffer', 1000000) if isplit == 0 else 0,
+                                 event_id=streaming.get('eventIdColumn', 'EventID'))
+            for isplit, bucket_range in enumerate(split_bucket_ranges(streaming.get('splitFractions', [0.8, 0.1, 0.1])))
+        ]
+        self.reset()
+
+        # the number of batches is not known before the first epoch, the loss buffers grow as needed
+        config.datasetInfo = {}
+        config.datasetInfo.train_numbatch = 1
+        config.datasetInfo.validation_numbatch = 1
+        config.datasetInfo.test_numbatch = 1
+
+        config.datasetInfo.inputDim = len(self.dict_input)
+        config.datasetInfo.targetDim = len(self.dict_target)
+        config.datasetInfo.spectatorsDim = len(self.dict_spectators)
+
+        config.datasetInfo.streamedEntries = self.streams[0].num_entries
+        config.datasetInfo.droppedSamples = 0
+        config.datasetInfo.nonfiniteCounts = {}
+
+    def reset(self):
+
+        self.train, self.validation, self.test = [StreamLoader(stream, num_workers=self.num_workers, seed=self.random_seed, pin_memory=self.pin_memory)
+                                                  for stream in self.streams]
+        self.raw_train, self.raw_validation, self.raw_test = self.train, self.validation, self.test
+        self.prescaled = False
+
+    def sample_train(self, num_samples, seed=0):
+        """The first num_samples rows of the training split, unscaled inputs and targets"""
+
+        return self.streams[0].sample(num_samples)
+
+    def prescale(self, input_scalers, target_scalers, device):
+        print("Streamed data can't be pre-scaled, the scalers are applied to every batch")
+
+    def print_summary(self):
+        print("#"*50)
+        print("Dataset summary:")
+        print(f"Streaming {self.config.datasetInfo.streamedEntries} entries of {self.config.inputSettings.filePath}")
+        for name, stream in zip(['Train', 'Validation', 'Test'], self.streams):
+            print(f"{name}: EventID hash buckets {stream.bucket_range[0]}-{stream.bucket_range[1]} of {SPLIT_BUCKETS}")
+        print("-"*50)
+        print(f"Input: {self.config.datasetInfo.inputDim} features")
+        print(f"Target: {self.config.datasetInfo.targetDim} features")
+        print(f"Spectators: {self.config.datasetInfo.spectatorsDim} features")
+        print("#"*50)
+
+
+def make_dataset(config:"Config") -> Dataset:
+    """StreamingDataset if inputSettings.streaming is enabled, otherwise the in-memory Dataset"""
+
+    streaming = config.inputSettings.streaming
+    if streaming and streaming.get('enabled', True):
+        return StreamingDataset(config)
+
+    return Dataset(config)
@@ -1,6 +1,8 @@
 import torch
 from torch import nn
+import numpy as np
 import pandas as pd
+import json
 import os
 
 from dataclasses import dataclass
@@ -10,29 +12,256 @@ if TYPE_CHECKING:
     from config import Config
 
 from modules import loss_modules
+from modules.loss_modules import estimate_bandwidth, DistanceCache
 
-@dataclass
-class LogEntry:
-    value: float
-    epoch: int
-    batch: int
+class SplitLog:
+    """Columnar log of the loss values of one split
+
+    one row per (epoch, batch) with a column per loss, values that were not calculated are NaN.
+    The arrays grow by doubling, and the row range of every epoch is kept together with running
+    sums and counts per loss, so epoch averages and lookups don't have to scan the log.
+    """
+
+    def __init__(self, loss_names: list, capacity: int = 1024):
+        self.loss_names = list(loss_names)
+        self._columns = {name: i for i, name in enumerate(self.loss_names)}
+        self._size = 0
+        self._epochs = np.empty(capacity, dtype=np.int64)
+        self._batches = np.empty(capacity, dtype=np.int64)
+        self._values = np.full((capacity, len(self.loss_names)), np.nan)
+        self._epoch_rows = {}
+        self._epoch_sums = {}
+        self._epoch_counts = {}
+
+    def __len__(self):
+        return self._size
+
+    def _reserve(self, n: int):
+
+        if self._size + n <= len(self._epochs):
+            return
+
+        capacity = max(2 * len(self._epochs), self._size + n)
+        epochs = np.empty(capacity, dtype=np.int64)
+        batches = np.empty(capacity, dtype=np.int64)
+        values = np.full((capacity, len(self.loss_names)), np.nan)
+        epochs[:self._size] = self._epochs[:self._size]
+        batches[:self._size] = self._batches[:self._size]
+        values[:self._size] = self._values[:self._size]
+        self._epochs, self._batches, self._values = epochs, batches, values
+
+    def append(self, epoch: int, batches, values):
+        """Appends the rows of one epoch, batches has shape (n,) and values (n, number of losses)"""
+
+        batches = np.atleast_1d(np.asarray(batches, dtype=np.int64))
+        values = np.asarray(values, dtype=np.float64).reshape(len(batches), len(self.loss_names))
+
+        self._reserve(len(batches))
+        start, stop = self._size, self._size + len(batches)
+        self._epochs[start:stop] = epoch
+        self._batches[start:stop] = batches
+        self._values[start:stop] = values
+        self._size = stop
+
+        rows = self._epoch_rows.get(epoch)
+        if rows is None:
+            self._epoch_rows[epoch] = [start, stop]
+            self._epoch_sums[epoch] = np.zeros(len(self.loss_names))
+            self._epoch_counts[epoch] = np.zeros(len(self.loss_names), dtype=np.int64)
+        elif rows[1] != start:
+            raise ValueError(f"The batches of epoch {epoch} have to be logged contiguously")
+        else:
+            rows[1] = stop
+
+        finite = ~np.isnan(values)
+        self._epoch_sums[epoch] += np.where(finite, values, 0.).sum(axis=0)
+        self._epoch_counts[epoch] += finite.sum(axis=0)
+
+    def epochs(self) -> list:
+        return list(self._epoch_rows.keys())
+
+    def get(self, loss_name: str, epoch: int, batch: int):
+
+        rows = self._epoch_rows.get(epoch)
+        if rows is None:
+            return None
+
+        # batches are logged in increasing order within an epoch
+        row = rows[0] + np.searchsorted(self._batches[rows[0]:rows[1]], batch)
+        if row >= rows[1] or self._batches[row] != batch:
+            return None
+
+        value = self._values[row, self._columns[loss_name]]
+        return None if np.isnan(value) else float(value)
+
+    def epoch_average(self, loss_name: str, epoch: int):
+
+        if epoch not in self._epoch_rows:
+            return None
+
+        column = self._columns[loss_name]
+        count = self._epoch_counts[epoch][column]
+
+        return float(self._epoch_sums[epoch][column] / count) if count > 0 else None
+
+    def epoch_averages(self, loss_name: str):
+        """Epochs with at least one value of the loss and the averages of these epochs"""
+
+        column = self._columns[loss_name]
+        epochs = [epoch for epoch in self._epoch_rows if self._epoch_counts[epoch][column] > 0]
+
+        return epochs, [float(self._epoch_sums[epoch][column] / self._epoch_counts[epoch][column]) for epoch in epochs]
+
+    def column(self, loss_name: str, start: int = 0):
+        """epochs, batches and values of the logged values of a loss, from row start on"""
+
+        values = self._values[start:self._size, self._columns[loss_name]]
+        finite = ~np.isnan(values)
+
+        return self._epochs[start:self._size][finite], self._batches[start:self._size][finite], values[finite]
+
+    def to_frame(self, mode: str, start: int = 0) -> pd.DataFrame:
+        """The rows from start on in the long format of loss_logs.csv"""
+
+        frames = []
+        for loss_name in self.loss_names:
+            epochs, batches, values = self.column(loss_name, start)
+            frames.append(pd.DataFrame({
+                'loss_name': loss_name,
+                'type': mode,
+                'epoch': epochs,
+                'batch': batches,
+                'value': values
+            }))
+
+        return pd.concat(frames, ignore_index=True)
+
+    def state_dict(self) -> dict:
+        return {
+            'epochs': self._epochs[:self._size].copy(),
+            'batches': self._batches[:self._size].copy(),
+            'values': self._values[:self._size].copy(),
+        }
+
+    def load_state_dict(self, state: dict):
+        """Replaces the log with the rows of state, the per-epoch sums and counts are rebuilt from them"""
+
+        self.__init__(self.loss_names, capacity=max(len(state['epochs']), 1))
+
+        epochs = state['epochs']
+        for epoch in dict.fromkeys(epochs.tolist()):
+            rows = epochs == epoch
+            self.append(epoch, state['batches'][rows], state['values'][rows])
 
 @dataclass
 class LossLog:
-    train: dict[str, list[LogEntry]]
-    validation : dict[str, list[LogEntry]]
-    test: dict[str, list[LogEntry]]
+    train: SplitLog
+    validation : SplitLog
+    test: SplitLog
+
+class LossLogSink:
+    """Appends the new rows of the loss log to loss_logs.csv while the training is running
+
+    the file has the same format as the one written by save_log, each write is flushed and fsynced
+    so the log survives a crashed or killed job and can be followed during the training
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._written = {'train': 0, 'validation': 0, 'test': 0}
+        self._file = open(path, 'w', newline='')
+        self._file.write('loss_name,type,epoch,batch,value\n')
+        self._sync()
+
+    def write(self, mode: str, split_log: SplitLog):
+
+        start = self._written[mode]
+        if start == len(split_log):
+            return
+
+        split_log.to_frame(mode, start).to_csv(self._file, header=False, index=False)
+        self._written[mode] = len(split_log)
+        self._sync()
+
+    def rewrite(self, loss_log: LossLog):
+        """Starts the file over with the rows of loss_log, e.g. after restoring it from a checkpoint"""
+
+        self._file.seek(0)
+        self._file.truncate()
+        self._file.write('loss_name,type,epoch,batch,value\n')
+        self._written = {'train': 0, 'validation': 0, 'test': 0}
+        for mode in self._written:
+            self.write(mode, getattr(loss_log, mode))
+        self._sync()
+
+    def _sync(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def close(self):
+        self._file.close()
+
+class StepContext:
+    """Inputs and intermediates shared by the losses of one batch
+
+    the forward params are resolved once, so all the losses get the same tensors and the MMD losses
+    can share their pairwise distances through the distance cache
+    """
+
+    def __init__(self, resolve, _input, _output, _target, distance_cache: DistanceCache):
+        self._resolve = resolve
+        self._input = _input
+        self._output = _output
+        self._target = _target
+        self._resolved = {}
+        self.distance_cache = distance_cache
+
+    def resolve(self, name: str, placeholder: str, full_precision: bool = False):
+
+        key = (placeholder, torch.is_grad_enabled(), full_precision)
+        if key not in self._resolved:
+            if (placeholder, True, full_precision) in self._resolved:
+                # resolved with grad enabled, which is also fine for the losses computed without
+                return self._resolved[(placeholder, True, full_precision)]
+            value = self._resolve(self._input, self._output, self._target, name, placeholder)
+            # cast once per batch, so the float32 losses still get the same tensors and can share intermediates
+            self._resolved[key] = value.float() if full_precision else value
+
+        return self._resolved[key]
 
 class LossManager:
 
     def __init__(self, config: "Config"):
         self.config = config.losses
         self.numParameters = len(config.features.parameters if config.features.parameters else {})
-        self.loss_log = LossLog({}, {}, {})
         self._loss_classes = {}
         self.loss_funcs = {}
         self.epoch = None
         self.primary_loss = None
+
+        # asynchronous logging: the loss values stay on the device in a (loss, epoch, batch) buffer per mode
+        # and are only copied to the host once per epoch (see sync_log) instead of calling .item() on every batch
+        self.asyncLogging = bool(config.trainingSettings.asyncLossLogging)
+        dataset_info = config.datasetInfo
+        num_epochs = config.trainingSettings.epochs
+        self._buffer_shapes = {
+            'train': (num_epochs, dataset_info.train_numbatch if dataset_info else 1),
+            'validation': (num_epochs, dataset_info.validation_numbatch if dataset_info else 1),
+            'test': (1, dataset_info.test_numbatch if dataset_info else 1),
+        }
+        self._loss_buffers = {}
+        self._buffered_batches = {'train': {}, 'validation': {}, 'test': {}}
+        self._sink = None
+
+        # only the primary loss and losses with requiresGrad build a graph, the others are only monitored
+        # and can be evaluated on every calculateEvery-th batch only
+        self._grad_losses = set()
+        self._calculate_every = {}
+
+        # pairwise distance matrices up to this number of entries are shared by the MMD losses of a batch,
+        # kept as a whole for the batch instead of in blocks (see DistanceCache)
+        self.distanceCacheSize = config.trainingSettings.distanceCacheSize or 2**20
+
         for loss_name, loss_config in self.config.items():
 
             if loss_config.get("isPrimary",False):
@@ -40,14 +269,42 @@ class LossManager:
                     raise ValueError("You can only select one primary loss function.")
                 self.primary_loss = loss_name
 
+            if loss_config.get("isPrimary", False) or loss_config.get("requiresGrad", False):
+                self._grad_losses.add(loss_name)
+            self._calculate_every[loss_name] = int(loss_config.get("calculateEvery", 1))
+
             self.init_loss_fn(loss_name, loss_config['type'], loss_config.get('initParams', {}), loss_config.get('forwardParams', {}))
 
         if self.primary_loss is None:
             raise ValueError("No primary loss function defined. You have to define one for training.")
 
+        # the losses with a graph come first, so the losses computed without one can reuse their intermediates
+        self._calculation_order = [self.primary_loss] + [name for name in self.loss_funcs if name in self._grad_losses and name != self.primary_loss] \
+            + [name for name in self.loss_funcs if name not in self._grad_losses]
+
+        loss_names = list(self.loss_funcs.keys())
+        self.loss_log = LossLog(SplitLog(loss_names), SplitLog(loss_names), SplitLog(loss_names))
+
     def set_epoch(self, epoch):
         self.epoch = epoch
+
+    def open_log_sink(self, output_path: str):
+        """Streams the loss log to output_path/loss_logs.csv, every sync_log appends the new rows"""
+        self._sink = LossLogSink(output_path + "loss_logs.csv")
   
+    def _resolve(self, _input, _output, _target, name: str, placeholder: str):
+
+        if placeholder == '$OUTPUT$':
+            return _output
+        elif placeholder == '$PARAMETERS$':
+            return _input[:, : self.numParameters]
+        elif placeholder == '$VARIABLES$':
+            return _input[:, self.numParameters :]
+        elif placeholder == '$TARGET$':
+            return _target
+
+        raise ValueError(f"Invalid forward_param_{name}: {placeholder}")
+
     def init_loss_fn(self, loss_name:str, loss_type:str, init_params: dict, forward_params: dict):
         fn = loss_modules.get(loss_type)
 
@@ -56,72 +313,219 @@ class LossManager:
         
         self._loss_classes[loss_name] = fn(**init_params)
 
-        def loss_fn_params(_input, _output, _target, forward_params: dict):
-
-            loss_fn_input = None
-            loss_fn_target = None
-            
-            forward_param_input = forward_params.get('input', '$OUTPUT$')
-            forward_param_target = forward_params.get('target', '$TARGET$')
-
-            if forward_param_input == '$OUTPUT$':
-                loss_fn_input = _output
-            elif forward_param_input == '$PARAMETERS$':
-                loss_fn_input = _input[:, : self.numParameters]
-            elif forward_param_input == '$VARIABLES$':
-                loss_fn_input = _input[:, self.numParameters :]
-            elif forward_param_input == '$TARGET$':
-                loss_fn_input = _target
-            else:
-                raise ValueError(f"Invalid forward_param_input: {forward_param_input}")
-
-            if forward_param_target == '$OUTPUT$':
-                loss_fn_target = _output
-            elif forward_param_target == '$PARAMETERS$':
-                loss_fn_target = _input[:, : self.numParameters]
-            elif forward_param_target == '$VARIABLES$':
-                loss_fn_target = _input[:, self.numParameters :]
-            elif forward_param_target == '$TARGET$':
-                loss_fn_target = _target
-            else:
-                raise ValueError(f"Invalid forward_param_target: {forward_param_target}")
+        loss_class = self._loss_classes[loss_name]
+        uses_distance_cache = getattr(loss_class, 'uses_distance_cache', False)
+        # losses that are too sensitive for autocast (the exponentials of the MMD kernels) always run in float32
+        full_precision = getattr(loss_class, 'full_precision', False)
 
-            return loss_fn_input, loss_fn_target
-        
-        self.loss_funcs[loss_name] = lambda input, output, target : self._loss_classes[loss_name](*loss_fn_params(input, output, target, forward_params))
+        def loss_fn(input, output, target, context: StepContext = None):
+
+            if context is None:
+                context = self.step_context(input, output, target)
+
+            loss_fn_input = context.resolve('input', forward_params.get('input', '$OUTPUT$'), full_precision)
+            loss_fn_target = context.resolve('target', forward_params.get('target', '$TARGET$'), full_precision)
+
+            # every other forward param is passed by name, e.g. "parameters": "$PARAMETERS$" for the MMD losses
+            kwargs = {name: context.resolve(name, placeholder, full_precision) for name, placeholder in forward_params.items() if name not in ['input', 'target']}
+            if uses_distance_cache:
+                kwargs['distance_cache'] = context.distance_cache
 
-        self.loss_log.train[loss_name] = []
-        self.loss_log.validation[loss_name] = []
-        self.loss_log.test[loss_name] = []
+            if full_precision:
+                with torch.autocast(device_type=loss_fn_input.device.type, enabled=False):
+                    return loss_class(loss_fn_input, loss_fn_target, **kwargs)
 
-    def calculate(self, input, output, target, epoch:int, batch:int, mode:str = 'train'):
+            return loss_class(loss_fn_input, loss_fn_target, **kwargs)
+
+        self.loss_funcs[loss_name] = loss_fn
+
+    def step_context(self, input, output, target) -> StepContext:
+        return StepContext(self._resolve, input, output, target, DistanceCache(self.distanceCacheSize))
+
+    def calculate(self, input, output, target, epoch:int, batch:int, mode:str = 'train', precomputed: dict = None):
+        """Evaluates and logs the losses of one batch
+
+        returns a dict with the loss tensors computed for this batch, so the primary loss can be reused for the
+        backward pass instead of being evaluated a second time. Losses in precomputed (e.g. the primary loss of a
+        compiled training step) are only logged.
+        """
         self.set_epoch(epoch)
-        for name in self.loss_funcs.keys():
-            self._calculate_one(name, mode, input, output, target, batch)        
 
-    def _calculate_one(self, name:str, mode:str, input, output, target, batch:int):
-        value = self.loss_funcs[name](input, output, target)
-        value = value.item()
-        
-        if self.epoch is None:
-            if mode == 'test':
-                epoch = len(self.loss_log.test[name])
-            elif mode == 'validation':
-                epoch = len(self.loss_log.validation[name])
+        context = self.step_context(input, output, target)
+
+        values = {}
+        for name in self._calculation_order:
+            if precomputed and name in precomputed:
+                values[name] = precomputed[name]
+                continue
+            if name != self.primary_loss and batch % self._calculate_every[name] != 0:
+                continue
+            if name in self._grad_losses:
+                values[name] = self.loss_funcs[name](input, output, target, context)
             else:
-                epoch = len(self.loss_log.train[name])
+                with torch.no_grad():
+                    values[name] = self.loss_funcs[name](input, output, target, context)
+
+        if self.asyncLogging:
+            names = list(self.loss_funcs.keys())
+            self._buffer_values(mode, epoch, batch, torch.stack([value.detach().float() for value in values.values()]),
+                                [names.index(name) for name in values])
         else:
-            epoch = self.epoch
-        
+            row = np.full(len(self.loss_funcs), np.nan)
+            for iname, name in enumerate(self.loss_funcs.keys()):
+                if name in values:
+                    row[iname] = values[name].item()
+            self._get_split_log(mode).append(epoch, [batch], row)
+
+        return values
+
+    def _buffer_values(self, mode:str, epoch:int, batch:int, values, rows:list):
+
+        buffer = self._loss_buffers.get(mode)
+        if buffer is None:
+            num_epochs, num_batches = self._buffer_shapes[mode]
+            buffer = torch.full((len(self.loss_funcs), max(num_epochs, epoch + 1), max(num_batches, batch + 1)), float('nan'), device=values.device)
+        elif epoch >= buffer.size(1) or batch >= buffer.size(2):
+            num_epochs = buffer.size(1) if epoch < buffer.size(1) else max(2 * buffer.size(1), epoch + 1)
+            num_batches = buffer.size(2) if batch < buffer.size(2) else max(2 * buffer.size(2), batch + 1)
+            grown = torch.full((buffer.size(0), num_epochs, num_batches), float('nan'), device=buffer.device)
+            grown[:, :buffer.size(1), :buffer.size(2)] = buffer
+            buffer = grown
+        self._loss_buffers[mode] = buffer
+
+        buffer[rows, epoch, batch] = values.to(buffer.dtype)
+
+        pending = self._buffered_batches[mode]
+        pending[epoch] = max(pending.get(epoch, 0), batch + 1)
+
+    def sync_log(self):
+        """Copies the buffered loss values of all modes to the host log, with one device-to-host copy per mode"""
+
+        for mode, pending in self._buffered_batches.items():
+            if not pending:
+                continue
+
+            first_epoch, last_epoch = min(pending), max(pending)
+            values = self._loss_buffers[mode][:, first_epoch:last_epoch + 1].cpu().numpy()
+
+            for epoch in sorted(pending):
+                rows = values[:, epoch - first_epoch, :pending[epoch]].T
+                batches = np.flatnonzero(~np.isnan(rows).all(axis=1))
+                self._get_split_log(mode).append(epoch, batches, rows[batches])
+
+            pending.clear()
+
+        if self._sink is not None:
+            for mode in ['train', 'validation', 'test']:
+                self._sink.write(mode, self._get_split_log(mode))
+
+    def state_dict(self) -> dict:
+        """The logged loss values of all splits, for checkpoints"""
+
+        self.sync_log()
+
+        return {mode: self._get_split_log(mode).state_dict() for mode in ['train', 'validation', 'test']}
+
+    def load_state_dict(self, state: dict):
+
+        for mode, split_state in state.items():
+            self._get_split_log(mode).load_state_dict(split_state)
+
+        if self._sink is not None:
+            self._sink.rewrite(self.loss_log)
+
+    def _get_split_log(self, mode: str) -> SplitLog:
+
         if mode == 'test':
-            self.loss_log.test[name].append(LogEntry(value, epoch, batch))
+            return self.loss_log.test
         elif mode == 'validation':
-            self.loss_log.validation[name].append(LogEntry(value, epoch, batch))
-        else:
-            self.loss_log.train[name].append(LogEntry(value, epoch, batch))
-        
-        return value
+            return self.loss_log.validation
+        return self.loss_log.train
     
+    def dataset_sample_size(self) -> int:
+        """Number of training samples needed by the losses with a datasetBandwidth or datasetGroupFractions setting"""
+
+        sizes = [loss_config[key].get('numSamples', default) for loss_config in self.config.values()
+                 for key, default in [('datasetBandwidth', 4096), ('datasetGroupFractions', 100000)] if loss_config.get(key)]
+
+        return max(sizes, default=0)
+
+    def init_group_fractions(self, inputs, targets):
+        """Sets the group fractions of the grouped losses with a datasetGroupFractions setting from a sample of the scaled training data"""
+
+        for loss_name, loss_config in self.config.items():
+
+            fractions_config = loss_config.get('datasetGroupFractions')
+            if not fractions_config:
+                continue
+
+            loss_class = self._loss_classes[loss_name]
+            if not hasattr(loss_class, 'set_group_fractions'):
+                raise ValueError(f"Loss {loss_name} of type {loss_config['type']} doesn't support datasetGroupFractions")
+
+            num_samples = fractions_config.get('numSamples', 100000)
+            forward_params = loss_config.get('forwardParams', {})
+            parameters = self._resolve(inputs[:num_samples], targets[:num_samples], targets[:num_samples], 'parameters', forward_params.get('parameters', '$PARAMETERS$'))
+
+            fractions = loss_class.group_fractions(parameters)
+            loss_class.set_group_fractions(fractions)
+            print(f"Group fractions of {loss_name}: {fractions.tolist()}")
+
+    def init_bandwidths(self, inputs, targets, output_path: str = None):
+        """Sets the bandwidths of the MMD losses with a datasetBandwidth setting
+
+        they are estimated once on a sample of the scaled training inputs and targets, and cached in
+        output_path/bandwidths.json so a rerun with the same settings reuses them
+        """
+
+        cache_path = output_path + "bandwidths.json" if output_path else None
+        cache = {}
+        if cache_path and os.path.exists(cache_path):
+            with open(cache_path) as f:
+                cache = json.load(f)
+
+        for loss_name, loss_config in self.config.items():
+
+            bandwidth_config = loss_config.get('datasetBandwidth')
+            if not bandwidth_config:
+                continue
+
+            loss_class = self._loss_classes[loss_name]
+            if not hasattr(loss_class, 'set_bandwidth'):
+                raise ValueError(f"Loss {loss_name} of type {loss_config['type']} doesn't support datasetBandwidth")
+
+            forward_params = loss_config.get('forwardParams', {})
+            # the parameters only enter the kernel if the loss appends them to source and target,
+            # grouped_mmd uses them for the groups and leaves them out of the kernel by default
+            include_parameters = 'parameters' in forward_params and getattr(loss_class, 'include_parameters', True)
+            settings = {
+                'method': bandwidth_config.get('method', 'median'),
+                'perDimension': bandwidth_config.get('perDimension', False),
+                'numSamples': bandwidth_config.get('numSamples', 4096),
+                'forwardParams': forward_params,
+                'includeParameters': include_parameters,
+            }
+
+            entry = cache.get(loss_name)
+            if entry is None or entry['settings'] != settings:
+
+                # the distances are taken in the space of the target, the output is supposed to follow its distribution
+                sample_inputs, sample_targets = inputs[:settings['numSamples']], targets[:settings['numSamples']]
+                sample = self._resolve(sample_inputs, sample_targets, sample_targets, 'target', forward_params.get('target', '$TARGET$'))
+                if include_parameters:
+                    parameters = self._resolve(sample_inputs, sample_targets, sample_targets, 'parameters', forward_params['parameters'])
+                    sample = torch.cat((sample, parameters), dim=1)
+
+                entry = {'settings': settings, 'bandwidth': estimate_bandwidth(sample, settings['method'], settings['perDimension'])}
+                cache[loss_name] = entry
+
+            loss_class.set_bandwidth(entry['bandwidth'])
+            print(f"Bandwidth of {loss_name}: {entry['bandwidth']}")
+
+        if cache_path:
+            with open(cache_path, 'w') as f:
+                json.dump(cache, f, indent=4)
+
     def get_loss_fn(self, name: str):
         return self.loss_funcs[name]
 
@@ -130,65 +534,39 @@ class LossManager:
     
     def get_primary_loss(self, mode: int, epoch:int, batch:int):
 
-        if mode == "test":
-            log_entries = self.loss_log.test[self.primary_loss]
-        elif mode == "validation":
-            log_entries = self.loss_log.validation[self.primary_loss]
-        else:
-            log_entries = self.loss_log.train[self.primary_loss]
-
-        for entry in log_entries:
-            if entry.epoch == epoch and entry.batch == batch:
-                return entry.value
+        self.sync_log()
 
-        return None
+        return self._get_split_log(mode).get(self.primary_loss, epoch, batch)
 
     def get_epoch_average(self, loss_name: str, epoch: int, is_val: bool = False) -> float:
 
-        log_entries = self.loss_log.validation[loss_name] if is_val else self.loss_log.train[loss_name]
-        epoch_values = [entry.value for entry in log_entries if entry.epoch == epoch]
-        
-        if not epoch_values:
+        self.sync_log()
+
+        split_log = self.loss_log.validation if is_val else self.loss_log.train
+        average = split_log.epoch_average(loss_name, epoch)
+
+        if average is None:
             raise ValueError(f"No data found for loss '{loss_name}' at epoch {epoch}")
-        
-        return sum(epoch_values) / len(epoch_values)
+
+        return average
     
     def save_log(self, output_path: str):
 
         output_path  = output_path + "loss_logs.csv"
-        
-        data = []
-        
-        for loss_name, log_entries in self.loss_log.train.items():
-            for entry in log_entries:
-                data.append({
-                    'loss_name': loss_name,
-                    'type': 'train',
-                    'epoch': entry.epoch,
-                    'batch': entry.batch,
-                    'value': entry.value
-                })
-        
-        for loss_name, log_entries in self.loss_log.validation.items():
-            for entry in log_entries:
-                data.append({
-                    'loss_name': loss_name,
-                    'type': 'validation',
-                    'epoch': entry.epoch,
-                    'batch': entry.batch,
-                    'value': entry.value
-                })
-        
-        for loss_name, log_entries in self.loss_log.test.items():
-            for entry in log_entries:
-                data.append({
-                    'loss_name': loss_name,
-                    'type': 'test',
-                    'epoch': entry.epoch,
-                    'batch': entry.batch,
-                    'value': entry.value
-                })
-        
-        df = pd.DataFrame(data)
+
+        self.sync_log()
+
+        if self._sink is not None and self._sink.path == output_path:
+            # everything was already streamed to the file
+            self._sink.close()
+            self._sink = None
+            print(f"Loss logs saved to {output_path}")
+            return
+
+        df = pd.concat([
+            self.loss_log.train.to_frame('train'),
+            self.loss_log.validation.to_frame('validation'),
+            self.loss_log.test.to_frame('test'),
+        ], ignore_index=True)
         df.to_csv(output_path, index=False)
-        print(f"Loss logs saved to {output_path}")
\ No newline at end of file
+        print(f"Loss logs saved to {output_path}")
@@ -1,17 +1,16 @@
 #source /cvmfs/sft.cern.ch/lcg/views/LCG_106_cuda/x86_64-el9-gcc11-opt/setup.sh
 
 from config import Config
-from data_loader import Dataset
+from data_loader import Dataset, make_dataset
 from scalers import Scalers
 from model import RefinementModelBuilder
 from loss import LossManager
-from train import Trainer
+from train import Trainer, EnsembleTrainer
 
 import os
 
-def main():
-
-    config = Config(config_path='config.json')
+def get_output_path(config: Config) -> str:
+    """storeFolder/gridId/trainingId/ of a config"""
 
     training_id = config.generalSettings.trainingId
 
@@ -32,27 +31,66 @@ def main():
     if storeFolder[-1] != '/':
         storeFolder += '/'
 
-    output_path = f"{storeFolder}{grid_id}/{training_id}/"
+    return f"{storeFolder}{grid_id}/{training_id}/"
+
+def run(config: Config, dataset: Dataset = None, pruner = None):
+    """One training with the given config
+
+    a Dataset that was already loaded (e.g. by sweep.py) can be passed, it has to be loaded with the same
+    inputSettings, features and data loader settings. pruner is called after every epoch with the epoch
+    and the validation loss, the training stops if it returns True
+    """
+
+    output_path = get_output_path(config)
 
     os.makedirs(os.path.dirname(output_path), exist_ok=True)
 
-    dataset = Dataset(config)
+    ensemble_size = config.modelSettings.ensembleSize or 1
+
+    # an ensemble has one loss log and output folder per member
+    member_paths = [output_path] if ensemble_size == 1 else EnsembleTrainer.member_paths(output_path, ensemble_size)
+
+    if dataset is None:
+        dataset = make_dataset(config)
+    else:
+        dataset.reset()
+        config.datasetInfo = dict(dataset.config.datasetInfo)
     scalers = Scalers(config)
     refinement_model_builder = RefinementModelBuilder(config=config)
-    loss_manager = LossManager(config=config)
+    loss_managers = [LossManager(config=config) for _ in member_paths]
+
+    for member_path, loss_manager in zip(member_paths, loss_managers):
+        os.makedirs(member_path, exist_ok=True)
+        if config.outputSettings.streamLossLog:
+            loss_manager.open_log_sink(member_path)
     
     dataset.print_summary()
     
-    trainer = Trainer(
-        config=config,
-        dataset=dataset,
-        losses=loss_manager,
-        refinement_model_builder=refinement_model_builder,
-        scalers=scalers
-    )
+    if ensemble_size == 1:
+        trainer = Trainer(
+            config=config,
+            dataset=dataset,
+            losses=loss_managers[0],
+            refinement_model_builder=refinement_model_builder,
+            scalers=scalers
+        )
+    else:
+        trainer = EnsembleTrainer(
+            config=config,
+            dataset=dataset,
+            losses=loss_managers,
+            refinement_model_builder=refinement_model_builder,
+            scalers=scalers
+        )
+
+    trainer.pruner = pruner
+    trainer.init_loss_statistics(output_path=output_path)
+    if config.modelSettings.compile:
+        trainer.compile_model(config.modelSettings.compileMode or 'default', config.modelSettings.compileTrainingStep)
+    trainer.init_checkpoints(output_path=output_path)
 
     refinement_model_builder.show_architecture(
-        model=trainer.model, 
+        model=trainer.model if ensemble_size == 1 else trainer.model.members[0], 
         depth=3, 
         output_path=output_path
     )
@@ -64,11 +102,23 @@ def main():
     test_loss = trainer.test()
     
     print("\nTraining completed successfully!")
-    print(f"Final test loss: {test_loss:.6f}")
+    if ensemble_size == 1:
+        print(f"Final test loss: {test_loss:.6f}")
+    else:
+        print(f"Final test losses: {EnsembleTrainer.format_losses(test_loss)}")
 
     trainer.save_results(output_path = output_path)
-    loss_manager.save_log(output_path = output_path)
+    for member_path, loss_manager in zip(member_paths, loss_managers):
+        loss_manager.save_log(output_path = member_path)
     
+    return trained_model, trainer, test_loss
+
+def main():
+
+    config = Config(config_path='config.json')
+
+    trained_model, trainer, test_loss = run(config)
+
     return trained_model, trainer
 
 if __name__ == "__main__":
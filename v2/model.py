@@ -69,6 +69,16 @@ class RefinementModelBuilder():
         self.model = nn.Sequential(self.model_dict)
         return self.model
 
+    def build_ensemble(self, seeds: list):
+        """Builds one model per seed (for the initialization of its weights) and combines them into a ModelEnsemble"""
+
+        members = []
+        for seed in seeds:
+            torch.manual_seed(seed)
+            members.append(self.build())
+
+        return model_modules.ModelEnsemble(members)
+
 
     def show_architecture(self, output_path = None, model = None, input_size = None, depth = 3):
         if (model is None) and (not hasattr(self, 'model')):
@@ -1,8 +1,184 @@
+import math
+
 import torch
 from torch import nn
+from torch.utils.checkpoint import checkpoint
+
+def pairwise_dist_sq(x, y):
+    """Squared L2-distances between all rows of x and y"""
+    return torch.clamp(x.pow(2).sum(1, keepdim=True) + y.pow(2).sum(1) - 2 * torch.matmul(x, y.t()), min=0)
+
+def rbf_kernel(dist_sq, inverse_bandwidths):
+    """Multi-bandwidth RBF kernel of the given squared distances, summed over the bandwidths"""
+
+    kernel = torch.exp(-dist_sq * inverse_bandwidths[0])
+    for inverse_bandwidth in inverse_bandwidths[1:]:
+        kernel = kernel + torch.exp(-dist_sq * inverse_bandwidth)
+
+    return kernel
+
+def rbf_kernel_sum(dist_sq, inverse_bandwidths, diagonal_offset=None):
+    """Sum of the multi-bandwidth RBF kernel of the given squared distances
+
+    if diagonal_offset is given, the entries (r, r + diagonal_offset) are left out
+    """
+
+    kernel = rbf_kernel(dist_sq, inverse_bandwidths)
+
+    total = kernel.sum()
+    if diagonal_offset is not None:
+        total = total - kernel.diagonal(offset=diagonal_offset).sum()
+
+    return total
+
+def _rbf_block_sum(x, y, inverse_bandwidths, diagonal_offset=None):
+    # x is a block of rows, if diagonal_offset is given x is a block of y starting at row diagonal_offset
+    return rbf_kernel_sum(pairwise_dist_sq(x, y), inverse_bandwidths, diagonal_offset)
+
+def grouped_rbf_kernel_sums(dist_sq, x_groups, y_groups, inverse_bandwidths, diagonal_offset=None):
+    """Sums of the RBF kernel over the pairs of rows that are in the same group, one sum per group
+
+    x_groups and y_groups are the one-hot (rows, groups) group matrices of the rows and the columns of dist_sq,
+    so the block-diagonal part of the kernel is summed with one matmul instead of masking every group
+    """
+
+    kernel = rbf_kernel(dist_sq, inverse_bandwidths)
+
+    sums = (torch.matmul(kernel, y_groups) * x_groups).sum(0)
+    if diagonal_offset is not None:
+        diagonal = kernel.diagonal(offset=diagonal_offset)
+        sums = sums - torch.matmul(diagonal, x_groups[:diagonal.size(0)])
+
+    return sums
+
+def _grouped_rbf_block_sums(x, y, x_groups, y_groups, inverse_bandwidths, diagonal_offset=None):
+    return grouped_rbf_kernel_sums(pairwise_dist_sq(x, y), x_groups, y_groups, inverse_bandwidths, diagonal_offset)
+
+def blocked_grouped_kernel_sums(x, y, x_groups, y_groups, inverse_bandwidths, block_size, exclude_diagonal=False):
+    """Per group sums of the RBF kernel like grouped_rbf_kernel_sums, computed in blocks like blocked_kernel_sum"""
+
+    requires_grad = torch.is_grad_enabled() and (x.requires_grad or y.requires_grad)
+
+    total = x.new_zeros(x_groups.size(1))
+    for start in range(0, x.size(0), block_size):
+
+        args = (x[start:start + block_size], y, x_groups[start:start + block_size], y_groups, inverse_bandwidths,
+                start if exclude_diagonal else None)
+
+        if requires_grad and x.size(0) > block_size:
+            total = total + checkpoint(_grouped_rbf_block_sums, *args, use_reentrant=False)
+        else:
+            total = total + _grouped_rbf_block_sums(*args)
+
+    return total
+
+def blocked_kernel_sum(x, y, inverse_bandwidths, block_size, exclude_diagonal=False):
+    """Sum of the RBF kernel over all pairs of rows of x and y, computed in blocks of block_size rows of x
+
+    only one (block_size, len(y)) kernel block exists at a time. With autograd the blocks are checkpointed,
+    so they are recomputed one by one in the backward pass instead of being kept for it, the gradients are exact
+    and the memory grows linearly with the batch size
+    """
+
+    requires_grad = torch.is_grad_enabled() and (x.requires_grad or y.requires_grad)
+
+    total = x.new_zeros(())
+    for start in range(0, x.size(0), block_size):
+
+        x_block = x[start:start + block_size]
+        diagonal_offset = start if exclude_diagonal else None
+
+        if requires_grad and x.size(0) > block_size:
+            total = total + checkpoint(_rbf_block_sum, x_block, y, inverse_bandwidths, diagonal_offset, use_reentrant=False)
+        else:
+            total = total + _rbf_block_sum(x_block, y, inverse_bandwidths, diagonal_offset)
+
+    return total
+
+class DistanceCache:
+    """Pairwise squared distances shared by the MMD losses of one batch
+
+    the entries are keyed on the identity of the loss inputs and on the grad mode, so a cache must not outlive
+    the batch it was created for. Matrices with more than max_elements entries are not cached, the losses
+    compute them in blocks instead.
+
+    A cached matrix is kept as a whole, together with its autograd graph, until the end of the batch, while the
+    blocked path only ever holds one (block_size, B) block. The default of 2**20 entries (a 1024 x 1024 matrix,
+    the size of one block of the default block_size) caches the distances only where that costs no more memory
+    than the blocked path. A larger budget saves more recomputation between the losses, at the price of
+    memory that grows with the square of the batch size.
+    """
+
+    def __init__(self, max_elements=2**20):
+        self.max_elements = max_elements
+        self._entries = {}
+        self._inputs = []
+
+    def keep(self, *tensors):
+        # holds on to the tensors a key was built from, so their ids can't be reused within the batch
+        self._inputs.append(tensors)
+
+    def pairwise(self, key, x, y):
+
+        if x.size(0) * y.size(0) > self.max_elements:
+            return None
+
+        grad_enabled = torch.is_grad_enabled()
+        dist_sq = self._entries.get((key, grad_enabled))
+
+        if dist_sq is None and not grad_enabled and (key, True) in self._entries:
+            dist_sq = self._entries[(key, True)].detach()
+
+        if dist_sq is None:
+            dist_sq = pairwise_dist_sq(x, y)
+            self._entries[(key, grad_enabled)] = dist_sq
+
+        return dist_sq
+
+    def memo(self, key, fn):
+
+        if key not in self._entries:
+            self._entries[key] = fn()
+
+        return self._entries[key]
+
+def estimate_bandwidth(x, method='median', per_dimension=False):
+    """Median or mean of the squared pairwise distances between the rows of x
+
+    with per_dimension one value per column is returned (zero distances are left out of the median,
+    so one-hot encoded columns don't get a zero bandwidth), otherwise one value for the full distance
+    """
+
+    with torch.no_grad():
+
+        if per_dimension:
+            columns = [torch.pdist(x[:, i:i+1]).pow(2) for i in range(x.size(1))]
+        else:
+            columns = [torch.pdist(x).pow(2)]
+
+        bandwidths = []
+        for dist_sq in columns:
+            if method == 'median':
+                dist_sq = dist_sq[dist_sq > 1e-9]
+                bandwidths.append(dist_sq.median().item() if dist_sq.numel() > 0 else 1.)
+            elif method == 'mean':
+                bandwidths.append(dist_sq.mean().item())
+            else:
+                raise ValueError(f"Unknown bandwidth method: {method}. Use 'median' or 'mean'.")
+
+    return bandwidths if per_dimension else bandwidths[0]
 
 class MMDLoss(nn.Module):
-    def __init__(self, kernel_type='rbf', kernel_mul=2.0, kernel_num=5, fix_sigma=None, unbiased=False):
+
+    # LossManager passes the DistanceCache of the batch to the losses that set this
+    uses_distance_cache = True
+    # and runs them in float32 outside of autocast
+    full_precision = True
+    # the distance heuristic of _median_distance_sq, part of the key of the median in the DistanceCache
+    median_heuristic = 'pdist'
+
+    def __init__(self, kernel_type='rbf', kernel_mul=2.0, kernel_num=5, fix_sigma=None, unbiased=False,
+                 bandwidth_per_dimension=None, block_size=1024, median_samples=4096):
         """
         Args:
             kernel_type (str): Type of kernel to use. Currently only 'rbf' is supported.
@@ -15,6 +191,12 @@ class MMDLoss(nn.Module):
             fix_sigma (float or list): If not None, this sigma/list of sigmas will be used directly.
                                       In this case, kernel_mul and kernel_num are ignored.
             unbiased (bool): If True, uses the unbiased MMD estimator, if False uses the biased one.
+            bandwidth_per_dimension (list): If not None, the squared distance in every dimension is divided
+                                            by this bandwidth before the sigmas are applied.
+            block_size (int): Number of rows of the kernel matrices that are computed at once.
+            median_samples (int): Maximum number of samples used for the median distance if fix_sigma is None,
+                                  larger batches are subsampled with a fixed stride (no random numbers are drawn,
+                                  so the losses that are logged don't change the random state of the training).
         """
         super(MMDLoss, self).__init__()
         self.kernel_type = kernel_type
@@ -22,117 +204,363 @@ class MMDLoss(nn.Module):
         self.kernel_num = kernel_num
         self.fix_sigma = fix_sigma
         self.unbiased = unbiased
+        self.block_size = block_size
+        self.median_samples = median_samples
 
         if self.kernel_type not in ['rbf']:
             raise ValueError(f"Unsupported kernel type: {kernel_type}. Only 'rbf' is supported.")
 
-    def _guassian_kernel(self, source, target, kernel_mul, kernel_num, fix_sigma):
-        n_samples_source = source.size(0)
-        n_samples_target = target.size(0)
+        self.register_buffer('_dimension_scales',
+                             None if bandwidth_per_dimension is None else torch.rsqrt(torch.tensor(bandwidth_per_dimension, dtype=torch.float32)))
+        self._reference_distance_sq = None
+        self._scales_key = None if bandwidth_per_dimension is None else tuple(bandwidth_per_dimension)
+
+    def set_bandwidth(self, bandwidth):
+        """Fixes the distance the sigmas are derived from, instead of taking the median of every batch
+
+        a list is used as the bandwidth of every dimension, the sigmas are then derived from a distance of 1
+        """
+
+        if isinstance(bandwidth, (list, tuple)):
+            self._dimension_scales = torch.rsqrt(torch.tensor(bandwidth, dtype=torch.float32))
+            self._scales_key = tuple(bandwidth)
+            self._reference_distance_sq = 1.
+        else:
+            self._reference_distance_sq = float(bandwidth)
+
+    def _median_distance_sq(self, source, target):
+
+        with torch.no_grad():
+            total = torch.cat([source, target], dim=0)
+            if total.size(0) > self.median_samples:
+                # the batches are shuffled already, every stride-th row is as good as a random subset
+                total = total[::math.ceil(total.size(0) / self.median_samples)]
+
+            all_dist_sq = torch.pdist(total).pow(2)
+            all_dist_sq = all_dist_sq[all_dist_sq > 1e-9]
+
+            if all_dist_sq.numel() == 0:
+                return 1.0
+
+            return all_dist_sq.median().item() + 1e-9
 
-        total = torch.cat([source, target], dim=0)
-        total0 = total.unsqueeze(0).expand(total.size(0), total.size(0), total.size(1))
-        total1 = total.unsqueeze(1).expand(total.size(0), total.size(0), total.size(1))
-        
-        X_sq = torch.sum(source**2, dim=1, keepdim=True) 
-        Y_sq = torch.sum(target**2, dim=1, keepdim=True) 
-        XY = torch.matmul(source, target.t())            
+    def _cache_key(self, source, target, parameters, distance_cache):
+        # identifies the prepared source and target, losses with the same inputs and the same scaling share the distances
 
-        dist_ss_sq = X_sq + X_sq.t() - 2 * torch.matmul(source, source.t()) 
-        dist_tt_sq = Y_sq + Y_sq.t() - 2 * torch.matmul(target, target.t()) 
-        dist_st_sq = X_sq + Y_sq.t() - 2 * XY                               
+        if distance_cache is None:
+            return None
+
+        distance_cache.keep(source, target, parameters)
+
+        return (id(source), id(target), id(parameters), self._scales_key)
+
+    def _kernel_sum(self, x, y, inverse_bandwidths, exclude_diagonal, distance_cache, key):
+
+        dist_sq = distance_cache.pairwise(key, x, y) if distance_cache is not None else None
+
+        if dist_sq is None:
+            return blocked_kernel_sum(x, y, inverse_bandwidths, self.block_size, exclude_diagonal)
+
+        return rbf_kernel_sum(dist_sq, inverse_bandwidths, 0 if exclude_diagonal else None)
+
+    def _sigma_list(self, source, target, kernel_mul, kernel_num, fix_sigma, distance_cache=None, key=None):
 
         if fix_sigma is not None:
             if isinstance(fix_sigma, (float, int)):
-                sigma_list = [float(fix_sigma)]
+                return [float(fix_sigma)]
             elif isinstance(fix_sigma, list):
-                sigma_list = [float(s) for s in fix_sigma]
+                return [float(s) for s in fix_sigma]
             else:
                 raise ValueError("fix_sigma must be a float or a list of floats.")
+
+        if self._reference_distance_sq is not None:
+            median_dist_sq = self._reference_distance_sq
+        elif distance_cache is not None:
+            median_dist_sq = distance_cache.memo((key, self.median_heuristic, self.median_samples),
+                                                 lambda: self._median_distance_sq(source, target))
         else:
-            all_dist_sq = torch.cat([
-                dist_ss_sq[torch.triu(torch.ones_like(dist_ss_sq), diagonal=1) == 1], 
-                dist_tt_sq[torch.triu(torch.ones_like(dist_tt_sq), diagonal=1) == 1],
-                dist_st_sq.view(-1)
-            ])
-            
-            median_dist_sq = torch.median(all_dist_sq[all_dist_sq > 1e-9]) + 1e-9 
-            if torch.isnan(median_dist_sq) or median_dist_sq <= 1e-9: 
-                median_dist_sq = torch.tensor(1.0, device=source.device) 
-
-            if isinstance(kernel_mul, (float, int)):
-                sigma_list = [median_dist_sq.item() * kernel_mul] 
-                                                                  
-                if kernel_num > 1:
-                    base_sigma_sq_x2 = sigma_list[0] 
-                    
-                    factors = [0.25, 0.5, 1.0, 2.0, 4.0] 
-                    if self.kernel_num == 1: factors = [1.0]
-                    elif self.kernel_num == 3: factors = [0.5, 1.0, 2.0]
-                    
-                    
-                    if self.kernel_num not in [1,3,5]:
-                        print(f"WARNING: Using default factors for kernel_num={self.kernel_num} (similar to kernel_num=5).")
-
-                    sigma_list = [base_sigma_sq_x2 * f for f in factors[:self.kernel_num]]
-
-            elif isinstance(kernel_mul, list):
-                sigma_list = [median_dist_sq.item() * mul for mul in kernel_mul]
-            else:
-                raise ValueError("kernel_mul must be a float or a list of floats.")
-        
-        K_ss_total = torch.zeros_like(dist_ss_sq, device=source.device)
-        K_tt_total = torch.zeros_like(dist_tt_sq, device=source.device)
-        K_st_total = torch.zeros_like(dist_st_sq, device=source.device)
+            median_dist_sq = self._median_distance_sq(source, target)
 
-        for sigma_val_sq_x2 in sigma_list:
-            if sigma_val_sq_x2 <= 1e-9: 
-                sigma_val_sq_x2 = 1e-9
-            K_ss_total += torch.exp(-dist_ss_sq / sigma_val_sq_x2)
-            K_tt_total += torch.exp(-dist_tt_sq / sigma_val_sq_x2)
-            K_st_total += torch.exp(-dist_st_sq / sigma_val_sq_x2)
-            
-        return K_ss_total / len(sigma_list), \
-               K_tt_total / len(sigma_list), \
-               K_st_total / len(sigma_list)
-
-    def forward(self, source, target):
+        if isinstance(kernel_mul, (float, int)):
+            sigma_list = [median_dist_sq * kernel_mul]
+
+            if kernel_num > 1:
+                base_sigma_sq_x2 = sigma_list[0]
+
+                factors = [0.25, 0.5, 1.0, 2.0, 4.0]
+                if self.kernel_num == 1: factors = [1.0]
+                elif self.kernel_num == 3: factors = [0.5, 1.0, 2.0]
+
+                if self.kernel_num not in [1,3,5]:
+                    print(f"WARNING: Using default factors for kernel_num={self.kernel_num} (similar to kernel_num=5).")
+
+                sigma_list = [base_sigma_sq_x2 * f for f in factors[:self.kernel_num]]
+
+            return sigma_list
+
+        elif isinstance(kernel_mul, list):
+            return [median_dist_sq * mul for mul in kernel_mul]
+
+        raise ValueError("kernel_mul must be a float or a list of floats.")
+
+    def _prepare(self, source, target, parameters=None):
         if source.size(1) != target.size(1):
             raise ValueError(f"Source and target feature dimensions must match: {source.size(1)} != {target.size(1)}")
-        
-        m = source.size(0)
-        n = target.size(0)
 
-        if self.kernel_type == 'rbf':
-            K_ss, K_tt, K_st = self._guassian_kernel(source, target, self.kernel_mul, self.kernel_num, self.fix_sigma)
-        else:
+        if self.kernel_type != 'rbf':
             #TODO: add new kernels
             raise NotImplementedError
 
+        if parameters is not None:
+            # conditioned on the parameters, like my_mmd.MMD in v1
+            source = torch.cat((source, parameters), dim=1)
+            target = torch.cat((target, parameters), dim=1)
+
+        if self._dimension_scales is not None:
+            scales = self._dimension_scales.to(device=source.device, dtype=source.dtype)
+            source = source * scales
+            target = target * scales
+
+        return source, target
+
+    def forward(self, source, target, parameters=None, distance_cache=None):
+
+        key = self._cache_key(source, target, parameters, distance_cache)
+        source, target = self._prepare(source, target, parameters)
+
+        m = source.size(0)
+        n = target.size(0)
+
+        if m == 0 or n == 0:  # empty batch
+            return source.sum() * 0. + target.sum() * 0.
+
+        sigma_list = self._sigma_list(source, target, self.kernel_mul, self.kernel_num, self.fix_sigma, distance_cache, key)
+        inverse_bandwidths = [1. / max(sigma_val_sq_x2, 1e-9) for sigma_val_sq_x2 in sigma_list]
+
+        K_ss = self._kernel_sum(source, source, inverse_bandwidths, self.unbiased, distance_cache, (key, 'ss'))
+        K_tt = self._kernel_sum(target, target, inverse_bandwidths, self.unbiased, distance_cache, (key, 'tt'))
+        K_st = self._kernel_sum(source, target, inverse_bandwidths, False, distance_cache, (key, 'st'))
+
         if self.unbiased:
 
-            if m < 2: 
-                term1 = torch.tensor(0.0, device=source.device)
-            else:
-                term1 = (K_ss.sum() - K_ss.diag().sum()) / (m * (m - 1))
-            
-            if n < 2:
-                term2 = torch.tensor(0.0, device=source.device)
+            term1 = K_ss / (m * (m - 1)) if m >= 2 else torch.tensor(0.0, device=source.device)
+            term2 = K_tt / (n * (n - 1)) if n >= 2 else torch.tensor(0.0, device=source.device)
+
+        else:
+
+            term1 = K_ss / (m * m)
+            term2 = K_tt / (n * n)
+
+        term3 = 2 * K_st / (m * n)
+
+        loss = term1 + term2 - term3
+
+        return loss / len(sigma_list)
+
+class RFFMMDLoss(MMDLoss):
+    """MMD with the RBF kernel approximated by random Fourier features, linear in the batch size
+
+    the kernel mean embeddings of source and target are approximated with num_features random features per sigma,
+    the standard normal frequencies and the phases are drawn once (from seed) and rescaled to the sigmas of each batch
+    """
+
+    def __init__(self, kernel_type='rbf', kernel_mul=2.0, kernel_num=5, fix_sigma=None, unbiased=False,
+                 bandwidth_per_dimension=None, block_size=1024, median_samples=4096, num_features=1024, seed=None):
+
+        super(RFFMMDLoss, self).__init__(kernel_type, kernel_mul, kernel_num, fix_sigma, unbiased,
+                                         bandwidth_per_dimension, block_size, median_samples)
+
+        self.num_features = num_features
+        self.seed = seed
+        self.register_buffer('_frequencies', None)
+        self.register_buffer('_phases', None)
+
+    def _draw_features(self, dim):
+
+        generator = torch.Generator()
+        if self.seed is not None:
+            generator.manual_seed(self.seed)
+        else:
+            generator.seed()
+
+        self._frequencies = torch.randn(dim, self.num_features, generator=generator)
+        self._phases = 2 * math.pi * torch.rand(self.num_features, generator=generator)
+
+    def forward(self, source, target, parameters=None, distance_cache=None):
+
+        key = self._cache_key(source, target, parameters, distance_cache)
+        source, target = self._prepare(source, target, parameters)
+
+        m = source.size(0)
+        n = target.size(0)
+
+        if m == 0 or n == 0:  # empty batch
+            return source.sum() * 0. + target.sum() * 0.
+
+        if self._frequencies is None or self._frequencies.size(0) != source.size(1):
+            self._draw_features(source.size(1))
+
+        if self._frequencies.device != source.device or self._frequencies.dtype != source.dtype:
+            # moved once, the buffers follow the module from then on
+            self._frequencies = self._frequencies.to(device=source.device, dtype=source.dtype)
+            self._phases = self._phases.to(device=source.device, dtype=source.dtype)
+
+        frequencies = self._frequencies
+        phases = self._phases
+        norm = math.sqrt(2. / self.num_features)
+
+        sigma_list = self._sigma_list(source, target, self.kernel_mul, self.kernel_num, self.fix_sigma, distance_cache, key)
+
+        loss = source.new_zeros(())
+        for sigma_val_sq_x2 in sigma_list:
+
+            # exp(-d^2 / sigma) is a Gaussian with variance sigma / 2, so the frequencies have variance 2 / sigma
+            scaled_frequencies = frequencies * math.sqrt(2. / max(sigma_val_sq_x2, 1e-9))
+            features_s = norm * torch.cos(torch.matmul(source, scaled_frequencies) + phases)
+            features_t = norm * torch.cos(torch.matmul(target, scaled_frequencies) + phases)
+
+            sum_s = features_s.sum(0)
+            sum_t = features_t.sum(0)
+
+            if self.unbiased:
+
+                term1 = (sum_s.dot(sum_s) - features_s.pow(2).sum()) / (m * (m - 1)) if m >= 2 else torch.tensor(0.0, device=source.device)
+                term2 = (sum_t.dot(sum_t) - features_t.pow(2).sum()) / (n * (n - 1)) if n >= 2 else torch.tensor(0.0, device=source.device)
+                term3 = 2 * sum_s.dot(sum_t) / (m * n)
+
+                loss = loss + term1 + term2 - term3
+
             else:
-                term2 = (K_tt.sum() - K_tt.diag().sum()) / (n * (n - 1))
-            
-            term3 = 2 * K_st.mean() 
-            
-            loss = term1 + term2 - term3
+
+                loss = loss + (sum_s / m - sum_t / n).pow(2).sum()
+
+        return loss / len(sigma_list)
+
+class LinearMMDLoss(MMDLoss):
+    """Linear-time MMD estimator on disjoint pairs of consecutive samples (Gretton et al. 2012, lemma 14)
+
+    unbiased by construction, source and target are cut to the same even length. Without fix_sigma or a dataset
+    bandwidth the sigmas are derived from the median squared distance of the pairs the estimator uses, which is
+    linear in the batch size as well (median_samples isn't used), instead of the pdist median of MMDLoss.
+    """
+
+    median_heuristic = 'pairs'
+
+    def _median_distance_sq(self, source, target):
+
+        with torch.no_grad():
+            n = min(source.size(0), target.size(0)) // 2 * 2
+            x1, x2 = source[0:n:2], source[1:n:2]
+            y1, y2 = target[0:n:2], target[1:n:2]
+
+            all_dist_sq = torch.cat([(a - b).pow(2).sum(1) for a, b in ((x1, x2), (y1, y2), (x1, y2), (x2, y1))])
+            all_dist_sq = all_dist_sq[all_dist_sq > 1e-9]
+
+            if all_dist_sq.numel() == 0:
+                return 1.0
+
+            return all_dist_sq.median().item() + 1e-9
+
+    def forward(self, source, target, parameters=None, distance_cache=None):
+
+        key = self._cache_key(source, target, parameters, distance_cache)
+        source, target = self._prepare(source, target, parameters)
+
+        n = min(source.size(0), target.size(0)) // 2 * 2
+
+        if n < 2:  # not a single pair
+            return source.sum() * 0. + target.sum() * 0.
+
+        x1, x2 = source[0:n:2], source[1:n:2]
+        y1, y2 = target[0:n:2], target[1:n:2]
+
+        sigma_list = self._sigma_list(source, target, self.kernel_mul, self.kernel_num, self.fix_sigma, distance_cache, key)
+        inverse_bandwidths = [1. / max(sigma_val_sq_x2, 1e-9) for sigma_val_sq_x2 in sigma_list]
+
+        def kernel(a, b):
+            dist_sq = (a - b).pow(2).sum(1)
+            return sum(torch.exp(-dist_sq * inverse_bandwidth) for inverse_bandwidth in inverse_bandwidths)
+
+        h = kernel(x1, x2) + kernel(y1, y2) - kernel(x1, y2) - kernel(x2, y1)
+
+        return h.mean() / len(sigma_list)
+
+class GroupedMMDLoss(MMDLoss):
+    """Sum of the MMDs within groups (e.g. hadron flavours) weighted with the group fractions, in one kernel pass
+
+    the group of every sample is the value of column group_column of the parameters. Only the pairs of samples
+    in the same group enter the kernel sums, which gives the MMD of every group without masking and
+    recomputing the kernels for each of them. The fractions are either given or set once by LossManager
+    from the training data (see set_group_fractions), otherwise they are taken from the first batch.
+    """
+
+    def __init__(self, kernel_type='rbf', kernel_mul=2.0, kernel_num=5, fix_sigma=None, unbiased=False,
+                 bandwidth_per_dimension=None, block_size=1024, median_samples=4096,
+                 group_column=0, groups=(0, 4, 5), fractions=None, include_parameters=False):
+
+        super(GroupedMMDLoss, self).__init__(kernel_type, kernel_mul, kernel_num, fix_sigma, unbiased,
+                                             bandwidth_per_dimension, block_size, median_samples)
+
+        self.group_column = group_column
+        self.include_parameters = include_parameters
+        self.register_buffer('_groups', torch.tensor(groups, dtype=torch.float32))
+        self.register_buffer('_fractions', None if fractions is None else torch.tensor(fractions, dtype=torch.float32))
+
+    def group_fractions(self, parameters):
+        """Fractions of the samples in every group"""
+
+        with torch.no_grad():
+            one_hot = (parameters[:, self.group_column].unsqueeze(1) == self._groups.to(parameters.device)).float()
+            return (one_hot.sum(0) / max(parameters.size(0), 1)).cpu()
+
+    def set_group_fractions(self, fractions):
+        self._fractions = torch.as_tensor(fractions, dtype=torch.float32)
+
+    def forward(self, source, target, parameters=None, distance_cache=None):
+
+        if parameters is None:
+            raise ValueError("grouped_mmd needs the parameters, set \"parameters\": \"$PARAMETERS$\" in its forwardParams")
+
+        if self._fractions is None:
+            self.set_group_fractions(self.group_fractions(parameters))
+
+        one_hot = (parameters[:, self.group_column].unsqueeze(1) == self._groups.to(parameters.device)).to(source.dtype)
+
+        kernel_parameters = parameters if self.include_parameters else None
+        key = self._cache_key(source, target, kernel_parameters, distance_cache)
+        source, target = self._prepare(source, target, kernel_parameters)
+
+        if source.size(0) == 0:  # empty batch
+            return source.sum() * 0. + target.sum() * 0.
+
+        sigma_list = self._sigma_list(source, target, self.kernel_mul, self.kernel_num, self.fix_sigma, distance_cache, key)
+        inverse_bandwidths = [1. / max(sigma_val_sq_x2, 1e-9) for sigma_val_sq_x2 in sigma_list]
+
+        # source and target rows belong to the same events, so they share the groups
+        K_ss = self._grouped_sums(source, source, one_hot, inverse_bandwidths, self.unbiased, distance_cache, (key, 'ss'))
+        K_tt = self._grouped_sums(target, target, one_hot, inverse_bandwidths, self.unbiased, distance_cache, (key, 'tt'))
+        K_st = self._grouped_sums(source, target, one_hot, inverse_bandwidths, False, distance_cache, (key, 'st'))
+
+        counts = one_hot.sum(0)
+        if self.unbiased:
+            pairs_same = torch.clamp(counts * (counts - 1), min=1)
         else:
-            
-            term1 = K_ss.mean() 
-            term2 = K_tt.mean() 
-            term3 = 2 * K_st.mean() 
-            
-            loss = term1 + term2 - term3
-            
-        return loss
+            pairs_same = torch.clamp(counts * counts, min=1)
+        pairs_cross = torch.clamp(counts * counts, min=1)
+
+        mmd_per_group = (K_ss + K_tt) / pairs_same - 2 * K_st / pairs_cross
+        weights = self._fractions.to(device=source.device, dtype=source.dtype) * (counts > 0).to(source.dtype)
+
+        return (weights * mmd_per_group).sum() / len(sigma_list)
+
+    def _grouped_sums(self, x, y, one_hot, inverse_bandwidths, exclude_diagonal, distance_cache, key):
+
+        dist_sq = distance_cache.pairwise(key, x, y) if distance_cache is not None else None
+
+        if dist_sq is None:
+            return blocked_grouped_kernel_sums(x, y, one_hot, one_hot, inverse_bandwidths, self.block_size, exclude_diagonal)
+
+        return grouped_rbf_kernel_sums(dist_sq, one_hot, one_hot, inverse_bandwidths, 0 if exclude_diagonal else None)
 
 losses = {
     'l1': nn.L1Loss,
@@ -143,5 +571,8 @@ losses = {
     'bce_logits': nn.BCEWithLogitsLoss,
     'cross_entropy': nn.CrossEntropyLoss,
     'smooth_l1': nn.SmoothL1Loss,
-    'mmd': MMDLoss
+    'mmd': MMDLoss,
+    'mmd_rff': RFFMMDLoss,
+    'mmd_linear': LinearMMDLoss,
+    'grouped_mmd': GroupedMMDLoss
 }
\ No newline at end of file
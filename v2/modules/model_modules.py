@@ -1,5 +1,8 @@
+import copy
+
 import torch
 from torch import nn
+from torch.func import functional_call, vmap
 
 class LinearWithSkipConnection(nn.Module):
     def __init__(self, in_features, out_features, n_params, n_vars, skipindices, hidden_features=None, nskiplayers=1, dropout=0, isfirst=False, islast=False, noskipping=False):
@@ -20,6 +23,15 @@ class LinearWithSkipConnection(nn.Module):
         self._islast = islast
         self._noskipping = noskipping
 
+        # the columns of the input that are skipped, registered once instead of building a tensor in every forward
+        # (not persistent, so the state dicts stay the same)
+        if self._in_features < self._out_features:
+            identity_indices = self._skipindices if self._isfirst else list(range(len(self._skipindices)))
+        else:
+            identity_indices = []
+        self.register_buffer('_identity_indices', torch.tensor(identity_indices, dtype=torch.long), persistent=False)
+        self._num_skipped = len(identity_indices)
+
         self._linears = nn.ModuleList()
         self._leakyrelus = nn.ModuleList()
         if dropout: self._dropouts = nn.ModuleList()
@@ -41,30 +53,6 @@ class LinearWithSkipConnection(nn.Module):
 
     def forward(self, x):
 
-        if self._in_features < self._out_features:
-
-            if self._isfirst:
-                identity = torch.index_select(x, 1, torch.tensor(self._skipindices, device=x.device))
-            else:
-                identity = torch.index_select(x, 1, torch.tensor([idx for idx in range(len(self._skipindices))], device=x.device))
-
-            identity = torch.cat((identity, torch.zeros((identity.size(dim=0), self._out_features - len(self._skipindices)), device=x.device, dtype=x.dtype)), dim=1)
-
-        elif self._out_features < self._in_features:
-
-            if self._islast and len(self._skipindices) > self._n_vars:
-                # if we have skipped also the parameters, we need to drop them in the last layer
-                identity = x[:, self._n_params:self._n_params+self._out_features]
-            else:
-                identity = x[:, :self._out_features]
-
-        else:
-
-            identity = x
-
-        if self._noskipping:
-            identity = torch.zeros_like(identity)
-
         residual = x
         if self._dropouts is not None:
             for ilayer, (linear, leakyrelu, dropout) in enumerate(zip(self._linears, self._leakyrelus, self._dropouts)):
@@ -78,7 +66,30 @@ class LinearWithSkipConnection(nn.Module):
                 if not (self._islast and ilayer == self._nskiplayers-1):
                     residual = leakyrelu(residual)
 
-        return residual + identity
+        if self._noskipping:
+            return residual
+
+        # residual + identity used to promote to the dtype of x (e.g. under autocast), keep that before adding in place
+        residual = residual.to(x.dtype)
+
+        if self._in_features < self._out_features:
+
+            # the identity only covers the first columns, the others are left as they are instead of adding a zero padding
+            residual[:, :self._num_skipped] += torch.index_select(x, 1, self._identity_indices)
+
+        elif self._out_features < self._in_features:
+
+            if self._islast and len(self._skipindices) > self._n_vars:
+                # if we have skipped also the parameters, we need to drop them in the last layer
+                residual += x[:, self._n_params:self._n_params+self._out_features]
+            else:
+                residual += x[:, :self._out_features]
+
+        else:
+
+            residual += x
+
+        return residual
 
 
 class DeepJetConstraint(nn.Module):
@@ -97,6 +108,10 @@ class DeepJetConstraint(nn.Module):
 
     def forward(self, x):
 
+        # the normalization is done in float32 also under autocast, the sums of the discriminators are rounded
+        dtype = x.dtype
+        x = x.float()
+
         thedeepjets = torch.index_select(x, 1, torch.tensor(self._deepjetindices, device=x.device))
 
         if self._logittransform:
@@ -152,4 +167,80 @@ class DeepJetConstraint(nn.Module):
         else:
             x = normalized
 
-        return x
\ No newline at end of file
+        return x.to(dtype)
+
+
+class ModelEnsemble(nn.Module):
+    """Models with the same architecture evaluated on the same batch in one vectorized forward pass
+
+    the parameters of all members are kept in one stacked leaf tensor of shape (members, ...) per parameter,
+    the architecture is called once on them with torch.func.vmap, the output has the shape (members, batch, features).
+    The parameters of every member are leaves that share the memory of its rows of the stacked tensors, so the
+    members stay separate modules with their own optimizers and an optimizer step of a member updates its rows
+    in place, without stacking the weights again in every forward. The gradients end up in the stacked tensors,
+    share_grads hands every member the views of its rows before the optimizer steps.
+    """
+
+    def __init__(self, members):
+
+        super(ModelEnsemble, self).__init__()
+
+        self.members = nn.ModuleList(members)
+        # only the architecture, all parameters and buffers are passed to functional_call
+        # (kept in a list so it isn't registered as a submodule)
+        self._base = [copy.deepcopy(members[0]).to('meta')]
+
+        self._names = [name for name, _ in members[0].named_parameters()]
+        with torch.no_grad():
+            self._stacked = nn.ParameterList([torch.stack([member.get_parameter(name) for member in members]) for name in self._names])
+        self._tie_members()
+
+    def _tie_members(self):
+        # every parameter of a member becomes a leaf on the memory of its row of the stacked tensor
+
+        with torch.no_grad():
+            for name, stacked in zip(self._names, self._stacked):
+                module_name, _, param_name = name.rpartition('.')
+                for imember, member in enumerate(self.members):
+                    setattr(member.get_submodule(module_name), param_name, nn.Parameter(stacked[imember]))
+
+    def _apply(self, fn, *args, **kwargs):
+
+        super(ModelEnsemble, self)._apply(fn, *args, **kwargs)
+        # .to() and the casts copy the members and the stacked tensors separately
+        self._tie_members()
+
+        return self
+
+    def __len__(self):
+        return len(self.members)
+
+    def member(self, imember: int):
+        """Copy of a member with its own memory, e.g. for saving it (the members hold views of all members' weights)"""
+        # deepcopy clones the data of every parameter
+        return copy.deepcopy(self.members[imember])
+
+    def share_grads(self):
+        """Sets the gradient of every member parameter to the view of its row of the stacked gradient"""
+
+        for name, stacked in zip(self._names, self._stacked):
+            if stacked.grad is None:
+                continue
+            for imember, member in enumerate(self.members):
+                member.get_parameter(name).grad = stacked.grad[imember]
+
+    def train(self, mode: bool = True):
+        super(ModelEnsemble, self).train(mode)
+        self._base[0].train(mode)
+        return self
+
+    def forward(self, x):
+
+        params = dict(zip(self._names, self._stacked))
+        # the buffers (skip indices) are the same for all members
+        buffers = dict(self.members[0].named_buffers())
+
+        def call(params, x):
+            return functional_call(self._base[0], (params, buffers), (x,))
+
+        return vmap(call, in_dims=(0, None), randomness='different')(params, x)
@@ -1,164 +1,365 @@
 import torch
 from torch import nn
 
+from collections import OrderedDict
+
+
+## Column-wise kernels used by the FusedScalerPipeline
+# every parameter is a tensor with one entry per transformed column, forward_ is the in-place version of forward
+
+class TanhKernel(nn.Module):
+
+    def __init__(self, norm, factor):
+
+        super(TanhKernel, self).__init__()
+
+        self.register_buffer('_norm', torch.tensor(norm, dtype=torch.float32))
+        self.register_buffer('_factor', torch.tensor(factor, dtype=torch.float32))
+
+    def forward(self, x):
+        return self._factor * torch.tanh(x / self._norm)
+
+    def forward_(self, x):
+        return x.div_(self._norm).tanh_().mul_(self._factor)
+
+class TanhInverseKernel(nn.Module):
+
+    def __init__(self, norm, factor):
+
+        super(TanhInverseKernel, self).__init__()
+
+        self.register_buffer('_norm', torch.tensor(norm, dtype=torch.float32))
+        self.register_buffer('_factor', torch.tensor(factor, dtype=torch.float32))
+
+    def forward(self, x):
+        return torch.atanh(torch.clamp(x / self._factor, max=1.-1e-7)) * self._norm
+
+    def forward_(self, x):
+        return x.div_(self._factor).clamp_(max=1.-1e-7).atanh_().mul_(self._norm)
+
+class LogKernel(nn.Module):
+
+    def __init__(self, log_base, eps):
+
+        super(LogKernel, self).__init__()
+
+        # log_base is 1 for the natural logarithm
+        self.register_buffer('_log_base', torch.tensor(log_base, dtype=torch.float32))
+        self.register_buffer('_eps', torch.tensor(eps, dtype=torch.float32))
+
+    def forward(self, x):
+        return torch.log(torch.maximum(x, self._eps)) / self._log_base
+
+    def forward_(self, x):
+        return x.clamp_(min=self._eps).log_().div_(self._log_base)
+
+class LogInverseKernel(nn.Module):
+
+    def __init__(self, log_base):
+
+        super(LogInverseKernel, self).__init__()
+
+        self.register_buffer('_log_base', torch.tensor(log_base, dtype=torch.float32))
+
+    def forward(self, x):
+        # base**x, written like this so that columns with different bases can be mixed
+        return torch.exp(x * self._log_base)
+
+    def forward_(self, x):
+        return x.mul_(self._log_base).exp_()
+
+class LogitKernel(nn.Module):
+
+    def __init__(self, eps, tiny, factor):
+
+        super(LogitKernel, self).__init__()
+
+        self.register_buffer('_eps', torch.tensor(eps, dtype=torch.float32))
+        self.register_buffer('_tiny', torch.tensor(tiny, dtype=torch.float32))
+        self.register_buffer('_factor', torch.tensor(factor, dtype=torch.float32))
+
+    def forward(self, x):
+        x = torch.minimum(torch.maximum(x, self._tiny), 1.-self._eps)
+        return self._factor * torch.log(x/(1-x))
+
+    def forward_(self, x):
+        x = x.clamp_(min=self._tiny, max=1.-self._eps)
+        return x.div_(1 - x).log_().mul_(self._factor)
+
+class LogitInverseKernel(nn.Module):
+
+    def __init__(self, factor):
+
+        super(LogitInverseKernel, self).__init__()
+
+        self.register_buffer('_factor', torch.tensor(factor, dtype=torch.float32))
+
+    def forward(self, x):
+        return torch.sigmoid(x / self._factor)
+
+    def forward_(self, x):
+        return x.div_(self._factor).sigmoid_()
+
+
+class MaskedScaler(nn.Module):
+    """Base class for the masked scalers
+
+    the mask is stored as a boolean buffer together with the indices of the masked columns,
+    the transformation is applied to the whole masked sub-block at once and scattered back
+    into a copy of the input, so no python loop over the columns is needed. If every column is
+    masked, the gather and the scatter are skipped and the transformation is applied to x directly.
+
+    The gather and scatter cost two extra copies of the masked columns, with few columns and large
+    batches the old per-column loop can be faster (see benchmarks/benchmark_scalers.py)
+    """
+
+    kernel_class = None
+
+    def __init__(self, mask):
+
+        super(MaskedScaler, self).__init__()
+
+        mask = torch.as_tensor(mask, dtype=torch.bool)
+        self.register_buffer('_mask', mask)
+        self.register_buffer('_indices', torch.nonzero(mask).flatten())
+        self._all_columns = bool(mask.all())
+
+    def transform(self, x):
+        raise NotImplementedError
+
+    def kernel_params(self):
+        """Parameters of the transformation as plain numbers, named like the arguments of kernel_class"""
+        raise NotImplementedError
+
+    def forward(self, x):
+
+        if self._all_columns:
+            return self.transform(x)
+
+        x_ = torch.index_select(x, 1, self._indices)
+
+        return x.index_copy(1, self._indices, self.transform(x_))
+
 ## Tanh
-class TanhScaler(nn.Module):
+class TanhScaler(MaskedScaler):
+
+    kernel_class = TanhKernel
 
     def __init__(self, mask, norm=1, factor=1):
 
-        super(TanhScaler, self).__init__()
+        super(TanhScaler, self).__init__(mask)
 
-        self._mask = mask
         self._norm = norm
         self._factor = factor
 
-    def forward(self, x):
+    def transform(self, x):
+        return self._factor * torch.tanh(x / self._norm)
 
-        xt = torch.t(x)
-        x_ = torch.empty_like(xt)
-        for idim, dim in enumerate(xt):
-            if self._mask[idim]:
-                x_[idim] = self._factor * torch.tanh(dim / self._norm)
-            else:
-                x_[idim] = dim
+    def kernel_params(self):
+        return {'norm': float(self._norm), 'factor': float(self._factor)}
 
-        return torch.t(x_)
+class TanhInverseScaler(MaskedScaler):
 
-class TanhInverseScaler(nn.Module):
+    kernel_class = TanhInverseKernel
 
     def __init__(self, mask, norm=1, factor=1):
 
-        super(TanhInverseScaler, self).__init__()
+        super(TanhInverseScaler, self).__init__(mask)
 
-        self._mask = mask
         self._norm = norm
         self._factor = factor
 
-    def forward(self, x):
-
-        xt = torch.t(x)
-        x_ = torch.empty_like(xt)
-        for idim, dim in enumerate(xt):
-            if self._mask[idim]:
+    def transform(self, x):
 
-                dim = torch.clamp(dim / self._factor, max=1.-1e-7)
+        x = torch.clamp(x / self._factor, max=1.-1e-7)
 
-                # x_[idim] = 0.5 * torch.log((1 + dim) / (1 - dim)) * self._norm
-                x_[idim] = torch.atanh(dim) * self._norm
+        # 0.5 * torch.log((1 + x) / (1 - x)) * self._norm
+        return torch.atanh(x) * self._norm
 
-            else:
-                x_[idim] = dim
-
-        return torch.t(x_)
+    def kernel_params(self):
+        return {'norm': float(self._norm), 'factor': float(self._factor)}
 
 ## Log
-class LogScaler(nn.Module):
+class LogScaler(MaskedScaler):
+
+    kernel_class = LogKernel
 
     def __init__(self, mask, base=None, eps=1e-6):
 
-        super(LogScaler, self).__init__()
+        super(LogScaler, self).__init__(mask)
 
-        self._mask = mask
         if base is None:
             self.register_buffer('_base', torch.tensor(0.))
         else:
             self.register_buffer('_base', torch.tensor(base))
         self.register_buffer('_eps', torch.tensor(eps))
+        # decided once here instead of comparing the buffer (and syncing the device) on every call
+        self._use_base = base is not None and base > 0.
 
-    def forward(self, x):
+    def transform(self, x):
+
+        x = torch.log(torch.clamp(x, min=self._eps))
+        if self._use_base:
+            x = x / torch.log(self._base)
 
-        self._base = self._base.to(x.device)
-        self._eps = self._eps.to(x.device)
+        return x
 
-        xt = torch.t(x)
-        x_ = torch.empty_like(xt)
-        for idim, dim in enumerate(xt):
-            if self._mask[idim]:
-                dim = torch.clamp(dim, min=self._eps)
-                x_[idim] = torch.log(dim)
-                if self._base > 0.: x_[idim] /= torch.log(self._base)
-            else:
-                x_[idim] = dim
+    def kernel_params(self):
+        return {'log_base': torch.log(self._base).item() if self._use_base else 1., 'eps': self._eps.item()}
 
-        return torch.t(x_)
+class LogInverseScaler(MaskedScaler):
 
-class LogInverseScaler(nn.Module):
+    kernel_class = LogInverseKernel
 
     def __init__(self, mask, base=None):
 
-        super(LogInverseScaler, self).__init__()
-        self._mask = mask
+        super(LogInverseScaler, self).__init__(mask)
+
         if base is None:
             self.register_buffer('_base', torch.tensor(0.))
         else:
             self.register_buffer('_base', torch.tensor(base))
+        self._use_base = base is not None and base > 0.
 
-    def forward(self, x):
+    def transform(self, x):
 
-        self._base = self._base.to(x.device)
+        if self._use_base:
+            return torch.pow(self._base, x)
 
-        xt = torch.t(x)
-        x_ = torch.empty_like(xt)
-        for idim, dim in enumerate(xt):
-            if self._mask[idim]:
-                if self._base > 0.:
-                    x_[idim] = torch.pow(self._base, dim)
-                else:
-                    x_[idim] = torch.exp(dim)
-            else:
-                x_[idim] = dim
+        return torch.exp(x)
 
-        return torch.t(x_)
+    def kernel_params(self):
+        return {'log_base': torch.log(self._base).item() if self._use_base else 1.}
 
 # Logit
-class LogitScaler(nn.Module):
+class LogitScaler(MaskedScaler):
+
+    kernel_class = LogitKernel
 
     def __init__(self, mask, eps=1e-8, tiny=1e-8, factor=1., onnxcompatible=False):
 
-        super(LogitScaler, self).__init__()
+        super(LogitScaler, self).__init__(mask)
 
-        self._mask = mask
         self.register_buffer('_eps', torch.tensor(eps))
         self.register_buffer('_tiny', torch.tensor(tiny))
         self.register_buffer('_factor', torch.tensor(factor))
         self._onnxcompatible = onnxcompatible
 
-    def forward(self, x):
+    def transform(self, x):
+
+        x = torch.clamp(x, min=self._tiny, max=1.-self._eps)
+        if self._onnxcompatible:
+            return self._factor * torch.log(x/(1-x))
 
-        # somehow this was needed...
-        self._tiny = self._tiny.to(x.device)
-        self._eps = self._eps.to(x.device)
+        return self._factor * torch.logit(x)  # doesn't work with onnx (opset 13)
 
-        xt = torch.t(x)
-        x_ = torch.empty_like(xt)
-        for idim, dim in enumerate(xt):
-            if self._mask[idim]:
-                dim = torch.clamp(dim, min=self._tiny, max=1.-self._eps)
-                if self._onnxcompatible:
-                    x_[idim] = self._factor * torch.log(dim/(1-dim))
-                else:
-                    x_[idim] = self._factor * torch.logit(dim)  # doesn't work with onnx (opset 13)
-            else:
-                x_[idim] = dim
+    def kernel_params(self):
+        return {'eps': self._eps.item(), 'tiny': self._tiny.item(), 'factor': self._factor.item()}
 
-        return torch.t(x_)
+class LogitInverseScaler(MaskedScaler):
 
-class LogitInverseScaler(nn.Module):
+    kernel_class = LogitInverseKernel
 
     def __init__(self, mask, factor=1.):
 
-        super(LogitInverseScaler, self).__init__()
+        super(LogitInverseScaler, self).__init__(mask)
 
-        self._mask = mask
         self.register_buffer('_factor', torch.tensor(factor))
 
+    def transform(self, x):
+        return torch.sigmoid(x / self._factor)
+
+    def kernel_params(self):
+        return {'factor': self._factor.item()}
+
+
+## Fused pipeline
+class ScalerChain(nn.Module):
+    """Applies a chain of column-wise kernels to the columns [start, start + length) of the gathered columns"""
+
+    def __init__(self, start, length, kernels):
+
+        super(ScalerChain, self).__init__()
+
+        self.start = start
+        self.length = length
+        self._kernels = nn.ModuleList(kernels)
+
     def forward(self, x):
-        xt = torch.t(x)
-        x_ = torch.empty_like(xt)
-        for idim, dim in enumerate(xt):
-            if self._mask[idim]:
-                x_[idim] = torch.sigmoid(dim / self._factor)
-            else:
-                x_[idim] = dim
-
-        return torch.t(x_)
\ No newline at end of file
+
+        x = x.narrow(1, self.start, self.length)
+        for kernel in self._kernels:
+            x = kernel(x)
+
+        return x
+
+    def forward_(self, x):
+
+        x = x.narrow(1, self.start, self.length)
+        for kernel in self._kernels:
+            x = kernel.forward_(x)
+
+        return x
+
+class FusedScalerPipeline(nn.Module):
+    """Single-pass replacement for a nn.Sequential of masked scalers
+
+    the masked scalers are resolved into one chain of transformations per column, columns with the same
+    sequence of transformation types are grouped and their parameters (norm, factor, base, eps, ...) are
+    stacked into per-column tensors. All transformed columns are gathered into one buffer, group after group,
+    every group goes through its chain in place in its part of the buffer and the buffer is scattered into a
+    copy of the input with one index_copy. That is two tensors per call, independent of the number of steps.
+
+    Autograd needs the intermediate results, so if x requires grad (or the pipeline is traced for an export)
+    the chains run out of place and their results are concatenated before the scatter.
+    """
+
+    def __init__(self, scalers, num_features):
+
+        super(FusedScalerPipeline, self).__init__()
+
+        column_chains = [[] for _ in range(num_features)]
+        for scaler in scalers:
+            for idx in scaler._indices.tolist():
+                column_chains[idx].append(scaler)
+
+        groups = OrderedDict()
+        for idx, chain in enumerate(column_chains):
+            if chain:
+                groups.setdefault(tuple(type(scaler) for scaler in chain), []).append(idx)
+
+        self._chains = nn.ModuleList()
+        transformed = []
+        for scaler_types, indices in groups.items():
+            kernels = []
+            for istep, scaler_type in enumerate(scaler_types):
+                column_params = [column_chains[idx][istep].kernel_params() for idx in indices]
+                kernels.append(scaler_type.kernel_class(**{name: [p[name] for p in column_params] for name in column_params[0]}))
+            self._chains.append(ScalerChain(len(transformed), len(indices), kernels))
+            transformed += indices
+
+        self._has_chains = len(transformed) > 0
+        # the gathered buffer is the output if it holds every column in order
+        self._scatter = transformed != list(range(num_features))
+        self.register_buffer('_transformed', torch.tensor(transformed, dtype=torch.long))
+
+    def forward(self, x):
+
+        if not self._has_chains:
+            return x
+
+        x_ = torch.index_select(x, 1, self._transformed)
+
+        if torch.jit.is_tracing() or (x.requires_grad and torch.is_grad_enabled()):
+            parts = []
+            for chain in self._chains:
+                parts.append(chain(x_))
+            x_ = torch.cat(parts, dim=1)
+        else:
+            for chain in self._chains:
+                chain.forward_(x_)
+
+        if self._scatter:
+            return x.index_copy(1, self._transformed, x_)
+
+        return x_
@@ -34,32 +34,13 @@ class PlotLearningCurves:
     def _preprocess_data(self, loss_manager: "LossManager", loss_names: List[str]) -> Dict[str, Dict[str, Tuple[List[int], List[float]]]]:
         """Tüm loss verilerini bir kere işle ve hazırla"""
         processed_data = {}
+
+        loss_manager.sync_log()
         
         for loss_name in loss_names:
-            train_epochs = sorted(set(entry.epoch for entry in loss_manager.loss_log.train[loss_name]))
-            val_epochs = sorted(set(entry.epoch for entry in loss_manager.loss_log.validation[loss_name]))
-            
-            # Training averages
-            train_avgs = []
-            valid_train_epochs = []
-            for epoch in train_epochs:
-                try:
-                    avg = loss_manager.get_epoch_average(loss_name, epoch, is_val=False)
-                    train_avgs.append(avg)
-                    valid_train_epochs.append(epoch)
-                except ValueError:
-                    continue
-            
-            # Validation averages
-            val_avgs = []
-            valid_val_epochs = []
-            for epoch in val_epochs:
-                try:
-                    avg = loss_manager.get_epoch_average(loss_name, epoch, is_val=True)
-                    val_avgs.append(avg)
-                    valid_val_epochs.append(epoch)
-                except ValueError:
-                    continue
+            # the per-epoch sums are kept by the log, so this doesn't loop over the batches
+            valid_train_epochs, train_avgs = loss_manager.loss_log.train.epoch_averages(loss_name)
+            valid_val_epochs, val_avgs = loss_manager.loss_log.validation.epoch_averages(loss_name)
             
             processed_data[loss_name] = {
                 'train': (valid_train_epochs, train_avgs),
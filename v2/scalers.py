@@ -49,6 +49,14 @@ class Scalers:
         self.input_inverse_scaler_model = nn.Sequential(input_inverse_scalers_dict)
         self.target_inverse_scaler_model = nn.Sequential(target_inverse_scalers_dict)
 
+        num_input_features = len(self.input_features_dict)
+        num_target_features = len(self.target_features_dict)
+
+        self.fused_input_scaler_model = scaler_modules.FusedScalerPipeline(input_scalers_dict.values(), num_input_features)
+        self.fused_target_scaler_model = scaler_modules.FusedScalerPipeline(target_scalers_dict.values(), num_target_features)
+        self.fused_input_inverse_scaler_model = scaler_modules.FusedScalerPipeline(input_inverse_scalers_dict.values(), num_input_features)
+        self.fused_target_inverse_scaler_model = scaler_modules.FusedScalerPipeline(target_inverse_scalers_dict.values(), num_target_features)
+
     @staticmethod
     def _get_raw_optimized_scaler_sequence(feature_dict):
 
@@ -157,11 +165,11 @@ class Scalers:
         return ModuleClass
 
     
-    def get_input_scalers(self):
-        return self.input_scaler_model
-    def get_input_inverse_scalers(self):
-        return self.input_inverse_scaler_model
-    def get_target_scalers(self):
-        return self.target_scaler_model
-    def get_target_inverse_scalers(self):
-        return self.target_inverse_scaler_model
\ No newline at end of file
+    def get_input_scalers(self, fused: bool = True):
+        return self.fused_input_scaler_model if fused else self.input_scaler_model
+    def get_input_inverse_scalers(self, fused: bool = True):
+        return self.fused_input_inverse_scaler_model if fused else self.input_inverse_scaler_model
+    def get_target_scalers(self, fused: bool = True):
+        return self.fused_target_scaler_model if fused else self.target_scaler_model
+    def get_target_inverse_scalers(self, fused: bool = True):
+        return self.fused_target_inverse_scaler_model if fused else self.target_inverse_scaler_model
\ No newline at end of file
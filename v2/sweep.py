@@ -0,0 +1,259 @@
+"""Runs a grid of trainings over a base config, the dataset is loaded once and shared by all trials
+
+python sweep.py sweep.json
+
+with a sweep.json like
+{
+    "baseConfig": "config.json",
+    "gridId": "lr_scan",
+    "maxParallel": 2,
+    "grid": {
+        "trainingSettings.learningRate": [0.001, 0.0001],
+        "modelSettings.nodesHiddenLayer": [128, 256]
+    }
+}
+
+every trial is the base config with one combination of the grid values (dotted paths into the config), it gets
+its index as trainingId and writes to storeFolder/gridId/trainingId/ like a single training. A trial is
+complete once its trial.json is written, completed trials are skipped when the sweep is started again.
+With a "pruning" entry ({"warmupEpochs": 5, "minTrials": 3}) trials that are worse than the median of the
+other trials at the same epoch are stopped early (MedianPruner).
+
+Trials whose grid values change the data loading (inputSettings, features, batchSize, ...) share a Dataset
+only with the trials that load the same data. With maxParallel > 1 the trials run in forked processes,
+which see the datasets loaded by the parent without copying them.
+"""
+
+#source /cvmfs/sft.cern.ch/lcg/views/LCG_106_cuda/x86_64-el9-gcc11-opt/setup.sh
+
+import copy
+import glob
+import itertools
+import json
+import multiprocessing
+import os
+import sys
+import traceback
+
+import ROOT
+import torch
+
+from config import Config
+from data_loader import make_dataset
+from main import get_output_path, run
+
+# settings read by the DataLoader, trials that differ in any of them need their own Dataset
+DATASET_SETTINGS = [
+    'inputSettings',
+    'features',
+    'trainingSettings.batchSize',
+    'trainingSettings.numBatches',
+    'trainingSettings.randomSeed',
+    'trainingSettings.fastBatchLoader',
+    'trainingSettings.pinMemory',
+]
+
+# filled before the worker processes are forked, so that they share the loaded data
+_datasets = {}
+
+
+def get_setting(config_dict: dict, path: str):
+    for key in path.split('.'):
+        if not isinstance(config_dict, dict):
+            return None
+        config_dict = config_dict.get(key)
+    return config_dict
+
+def set_setting(config_dict: dict, path: str, value):
+    keys = path.split('.')
+    for key in keys[:-1]:
+        config_dict = config_dict.setdefault(key, {})
+    config_dict[keys[-1]] = value
+
+def dataset_key(config_dict: dict) -> str:
+    return json.dumps({path: get_setting(config_dict, path) for path in DATASET_SETTINGS}, sort_keys=True)
+
+
+class MedianPruner:
+    """Stops a trial whose validation loss is worse than the median of the other trials of the grid at the same epoch
+
+    every trial writes its validation curve to validation_curve.json after each epoch, the other trials are
+    read from there, so this also works across the worker processes. Nothing is pruned before warmup_epochs
+    or with fewer than min_trials other curves reaching the epoch.
+    """
+
+    def __init__(self, output_path: str, warmup_epochs: int = 5, min_trials: int = 3):
+
+        self.curve_path = output_path + "validation_curve.json"
+        self.grid_path = os.path.dirname(os.path.dirname(output_path))
+        self.warmup_epochs = warmup_epochs
+        self.min_trials = min_trials
+        self.curve = []
+
+    def other_values(self, epoch: int) -> list:
+
+        values = []
+        for path in glob.glob(os.path.join(self.grid_path, '*', "validation_curve.json")):
+            if os.path.abspath(path) == os.path.abspath(self.curve_path):
+                continue
+            try:
+                with open(path) as f:
+                    curve = json.load(f)
+            except (OSError, ValueError):
+                # written by another trial in this moment
+                continue
+            if len(curve) > epoch:
+                values.append(curve[epoch])
+
+        return values
+
+    def write_curve(self):
+
+        tmp_path = self.curve_path + ".tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(self.curve, f)
+        os.replace(tmp_path, self.curve_path)
+
+    def state_dict(self) -> dict:
+        return {'curve': list(self.curve)}
+
+    def load_state_dict(self, state: dict):
+        """Restores the curve of a resumed trial, the epochs after the checkpoint are dropped from the file"""
+
+        self.curve = list(state['curve'])
+        self.write_curve()
+
+    def __call__(self, epoch: int, value: float) -> bool:
+
+        self.curve.append(value)
+        self.write_curve()
+
+        if epoch + 1 < self.warmup_epochs:
+            return False
+
+        others = self.other_values(epoch)
+        if len(others) < self.min_trials:
+            return False
+
+        return value > torch.tensor(others).median().item()
+
+
+def make_trials(sweep: dict, base_config: dict) -> list:
+    """One (trainingId, grid values, config dict) per combination of the grid values"""
+
+    grid = sweep['grid']
+    names = list(grid.keys())
+
+    trials = []
+    for itrial, values in enumerate(itertools.product(*[grid[name] for name in names])):
+        params = dict(zip(names, values))
+
+        config_dict = copy.deepcopy(base_config)
+        for path, value in params.items():
+            set_setting(config_dict, path, value)
+        set_setting(config_dict, 'generalSettings.trainingId', str(itrial))
+        set_setting(config_dict, 'generalSettings.gridId', sweep.get('gridId', get_setting(base_config, 'generalSettings.gridId')))
+
+        trials.append((str(itrial), params, config_dict))
+
+    return trials
+
+
+def is_completed(output_path: str, params: dict) -> bool:
+
+    result_path = output_path + "trial.json"
+    if not os.path.exists(result_path):
+        return False
+
+    with open(result_path) as f:
+        result = json.load(f)
+
+    if result['params'] != params:
+        raise ValueError(f"{output_path} holds a trial with different grid values ({result['params']} instead of {params}), "
+                         "use another gridId for a changed grid")
+
+    return True
+
+
+def run_trial(training_id: str, params: dict, config_dict: dict, key: str, pruning: dict = None, num_threads: int = None):
+    """Runs one trial and writes its trial.json, returns the test loss or None if the training failed"""
+
+    if num_threads:
+        torch.set_num_threads(num_threads)
+
+    config = Config(data=config_dict)
+    output_path = get_output_path(config)
+
+    print(f"Trial {training_id}: {params}")
+
+    pruner = None
+    if pruning:
+        os.makedirs(output_path, exist_ok=True)
+        pruner = MedianPruner(output_path, warmup_epochs=pruning.get('warmupEpochs', 5), min_trials=pruning.get('minTrials', 3))
+
+    try:
+        _, trainer, test_loss = run(config, dataset=_datasets[key], pruner=pruner)
+    except Exception:
+        print(f"Trial {training_id} failed:")
+        traceback.print_exc()
+        return None
+
+    with open(output_path + "trial.json", 'w') as f:
+        json.dump({'params': params, 'testLoss': test_loss, 'pruned': trainer.pruned}, f, indent=4)
+
+    return test_loss
+
+
+def sweep(sweep_path: str):
+
+    with open(sweep_path) as f:
+        sweep = json.load(f)
+
+    base_config_path = os.path.join(os.path.dirname(os.path.abspath(sweep_path)), sweep.get('baseConfig', 'config.json'))
+    with open(base_config_path) as f:
+        base_config = json.load(f)
+
+    trials = make_trials(sweep, base_config)
+
+    pending = []
+    for training_id, params, config_dict in trials:
+        if is_completed(get_output_path(Config(data=copy.deepcopy(config_dict))), params):
+            print(f"Trial {training_id} is already completed, skipping it")
+            continue
+        pending.append((training_id, params, config_dict, dataset_key(config_dict), sweep.get('pruning')))
+
+    print(f"{len(pending)} of {len(trials)} trials to run")
+
+    for training_id, params, config_dict, key, pruning in pending:
+        if key not in _datasets:
+            _datasets[key] = make_dataset(Config(data=copy.deepcopy(config_dict)))
+
+    max_parallel = min(sweep.get('maxParallel', 1), len(pending))
+    if max_parallel > 1 and torch.cuda.is_initialized():
+        # CUDA doesn't survive a fork
+        print("CUDA is already initialized, running the trials sequentially")
+        max_parallel = 1
+    if max_parallel > 1 and ROOT.IsImplicitMTEnabled():
+        # neither does the thread pool of ROOT, the workers only use ROOT to write their outputs
+        ROOT.DisableImplicitMT()
+
+    if max_parallel <= 1:
+        results = [run_trial(*trial) for trial in pending]
+    else:
+        # every trial in a fresh forked process, the cores are divided between the running trials
+        num_threads = max(1, (os.cpu_count() or 1) // max_parallel)
+        with multiprocessing.get_context('fork').Pool(max_parallel, maxtasksperchild=1) as pool:
+            results = pool.starmap(run_trial, [trial + (num_threads,) for trial in pending])
+
+    failed = [training_id for (training_id, *_), result in zip(pending, results) if result is None]
+    if failed:
+        print(f"Failed trials: {failed}, they are run again when the sweep is restarted")
+
+
+if __name__ == "__main__":
+
+    if len(sys.argv) != 2:
+        print("Usage: python sweep.py sweep.json")
+        sys.exit(1)
+
+    sweep(sys.argv[1])
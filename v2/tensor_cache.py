@@ -0,0 +1,134 @@
+import hashlib
+import json
+import os
+import shutil
+import socket
+import time
+
+import numpy as np
+import torch
+
+
+class TensorCache:
+    """On-disk cache of the preselected data matrices, stored as .npy files that are opened memory-mapped
+
+    every entry is a folder <key>/ with one .npy file per matrix and a meta.json with the settings the key was
+    made from. The key is a hash of these settings (input files with size and modification time, tree,
+    preselection, features, number of rows), so a changed file or selection never hits an old entry. When the
+    cache holds more than max_bytes, the entries that were used least recently are removed.
+
+    An entry is written to <key>.tmp<pid>@<host>/ first. The folders of writers that crashed are removed by
+    evict, once their process is gone (on this host) or they are older than stale_seconds (on any host).
+    """
+
+    format_version = 1
+    tmp_suffix = ".tmp"
+    stale_seconds = 24 * 3600
+
+    def __init__(self, directory: str, max_bytes: int = None):
+
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def file_signature(path: str) -> dict:
+        stat = os.stat(path)
+        return {'path': os.path.abspath(path), 'size': stat.st_size, 'mtime': stat.st_mtime}
+
+    def make_key(self, settings: dict) -> str:
+        settings = dict(settings, formatVersion=self.format_version)
+        return hashlib.sha256(json.dumps(settings, sort_keys=True).encode()).hexdigest()[:32]
+
+    def load(self, key: str):
+        """dict of memory-mapped (copy-on-write) tensors of the entry, None if it isn't cached"""
+
+        entry = os.path.join(self.directory, key)
+        meta_path = os.path.join(entry, "meta.json")
+        if not os.path.exists(meta_path):
+            return None
+
+        with open(meta_path) as f:
+            meta = json.load(f)
+
+        # copy-on-write, the pages are only read when they are used and the tensors are writable without touching the files
+        tensors = {name: torch.from_numpy(np.load(os.path.join(entry, name + ".npy"), mmap_mode='c')) for name in meta['tensors']}
+
+        # the modification time of meta.json is the last use of the entry
+        os.utime(meta_path)
+
+        return tensors
+
+    def save(self, key: str, tensors: dict, settings: dict):
+
+        entry = os.path.join(self.directory, key)
+        tmp_entry = f"{entry}{self.tmp_suffix}{os.getpid()}@{socket.gethostname()}"
+        os.makedirs(tmp_entry, exist_ok=True)
+
+        for name, tensor in tensors.items():
+            np.save(os.path.join(tmp_entry, name + ".npy"), tensor.numpy())
+        with open(os.path.join(tmp_entry, "meta.json"), 'w') as f:
+            json.dump({'settings': settings, 'tensors': list(tensors.keys())}, f, indent=4)
+
+        # renamed as a whole, so other processes see either the complete entry or nothing
+        try:
+            os.rename(tmp_entry, entry)
+        except OSError:
+            # written by another process in the meantime
+            shutil.rmtree(tmp_entry, ignore_errors=True)
+
+        self.evict(keep=key)
+
+    def is_stale(self, name: str) -> bool:
+        """True for the temporary folder of a writer that is gone"""
+
+        path = os.path.join(self.directory, name)
+        try:
+            if time.time() - os.path.getmtime(path) > self.stale_seconds:
+                return True
+        except OSError:
+            # renamed or removed in the meantime
+            return False
+
+        pid, _, host = name.partition(self.tmp_suffix)[2].partition('@')
+        if host != socket.gethostname() or not pid.isdigit():
+            return False
+
+        try:
+            os.kill(int(pid), 0)
+        except ProcessLookupError:
+            return True
+        except PermissionError:
+            # the process of another user
+            pass
+
+        return False
+
+    def evict(self, keep: str = None):
+        """Removes the folders of crashed writers and the least recently used entries until the cache is below max_bytes"""
+
+        entries = []
+        for name in os.listdir(self.directory):
+            if self.tmp_suffix in name:
+                # an entry that another process is still writing, unless it is gone
+                if self.is_stale(name):
+                    shutil.rmtree(os.path.join(self.directory, name), ignore_errors=True)
+                    print(f"Removed unfinished cached dataset {name}")
+                continue
+            meta_path = os.path.join(self.directory, name, "meta.json")
+            if self.max_bytes is None or not os.path.exists(meta_path):
+                continue
+            entry = os.path.join(self.directory, name)
+            size = sum(os.path.getsize(os.path.join(entry, file_name)) for file_name in os.listdir(entry))
+            entries.append((os.path.getmtime(meta_path), name, size))
+
+        total = sum(size for _, _, size in entries)
+        for _, name, size in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if name == keep:
+                continue
+            shutil.rmtree(os.path.join(self.directory, name), ignore_errors=True)
+            total -= size
+            print(f"Removed cached dataset {name}")
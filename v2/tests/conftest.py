@@ -0,0 +1,13 @@
+import os
+import sys
+
+import pytest
+
+# the modules of v2 import each other as top-level modules, like when they are run from v2/
+V2_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, V2_PATH)
+
+
+@pytest.fixture
+def config_path():
+    return os.path.join(V2_PATH, 'config.json')
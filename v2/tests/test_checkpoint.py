@@ -0,0 +1,37 @@
+import copy
+import json
+
+import pytest
+
+pytest.importorskip("torch")
+
+from checkpoint import config_hash
+
+
+@pytest.fixture
+def config_dict(config_path):
+    with open(config_path) as f:
+        return json.load(f)
+
+
+def test_more_epochs_resume(config_dict):
+
+    more_epochs = copy.deepcopy(config_dict)
+    more_epochs['trainingSettings']['epochs'] += 10
+    more_epochs['trainingSettings']['checkpoint']['everyEpochs'] = 1
+    more_epochs['trainingSettings']['device'] = 'cpu'
+
+    assert config_hash(more_epochs) == config_hash(config_dict)
+
+
+@pytest.mark.parametrize("section, key, value", [
+    ('trainingSettings', 'learningRate', 0.1),
+    ('trainingSettings', 'batchSize', 7),
+    ('modelSettings', 'numSkipBlocks', 99),
+])
+def test_other_settings_dont_resume(config_dict, section, key, value):
+
+    changed = copy.deepcopy(config_dict)
+    changed[section][key] = value
+
+    assert config_hash(changed) != config_hash(config_dict)
@@ -0,0 +1,23 @@
+import copy
+import json
+
+import pytest
+
+from config import Config
+
+
+@pytest.fixture
+def config_dict(config_path):
+    with open(config_path) as f:
+        return json.load(f)
+
+
+@pytest.mark.parametrize("key", ['checkpoint', 'earlyStopping'])
+def test_ensemble_rejects_checkpoints_and_early_stopping(config_dict, key):
+
+    config_dict['modelSettings']['ensembleSize'] = 2
+    Config(data=copy.deepcopy(config_dict))
+
+    config_dict['trainingSettings'][key]['enabled'] = True
+    with pytest.raises(ValueError, match=key):
+        Config(data=config_dict)
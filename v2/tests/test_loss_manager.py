@@ -0,0 +1,66 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("pandas")
+
+from config import Config
+from loss import LossManager
+
+
+NUM_PARAMETERS = 3
+NUM_VARIABLES = 3
+
+
+def make_config(loss_type, init_params, bandwidth):
+
+    return Config(data={
+        'features': {
+            'parameters': {f'parameter{i}': [] for i in range(NUM_PARAMETERS)},
+            'variables': {f'variable{i}_CLASS': [] for i in range(NUM_VARIABLES)},
+            'spectators': [],
+        },
+        'trainingSettings': {'epochs': 1},
+        'losses': {
+            'mmd_output_target': {
+                'isPrimary': True,
+                'type': loss_type,
+                'initParams': init_params,
+                'forwardParams': {'input': '$OUTPUT$', 'target': '$TARGET$', 'parameters': '$PARAMETERS$'},
+                'datasetBandwidth': bandwidth,
+            },
+        },
+    })
+
+
+def make_batch(batch_size=200):
+
+    generator = torch.Generator().manual_seed(0)
+    flavours = torch.tensor([0., 4., 5.])[torch.randint(0, 3, (batch_size,), generator=generator)]
+    parameters = torch.cat((flavours.unsqueeze(1), torch.randn(batch_size, NUM_PARAMETERS - 1, generator=generator)), dim=1)
+    inputs = torch.cat((parameters, torch.randn(batch_size, NUM_VARIABLES, generator=generator)), dim=1)
+    targets = torch.randn(batch_size, NUM_VARIABLES, generator=generator)
+
+    return inputs, targets
+
+
+@pytest.mark.parametrize("loss_type, init_params, kernel_dim", [
+    ('grouped_mmd', {}, NUM_VARIABLES),
+    ('grouped_mmd', {'include_parameters': True}, NUM_VARIABLES + NUM_PARAMETERS),
+    ('mmd', {}, NUM_VARIABLES + NUM_PARAMETERS),
+])
+@pytest.mark.parametrize("per_dimension", [False, True])
+def test_dataset_bandwidth_in_kernel_space(loss_type, init_params, kernel_dim, per_dimension):
+
+    losses = LossManager(make_config(loss_type, init_params, {'method': 'median', 'perDimension': per_dimension}))
+    inputs, targets = make_batch()
+
+    losses.init_bandwidths(inputs, targets)
+
+    loss_class = losses._loss_classes['mmd_output_target']
+    if per_dimension:
+        # one bandwidth per dimension of the space the kernel is evaluated in
+        assert loss_class._dimension_scales.numel() == kernel_dim
+
+    outputs = targets + 0.1
+    loss = losses.get_primary_loss_fn()(inputs, outputs, targets)
+    assert torch.isfinite(loss)
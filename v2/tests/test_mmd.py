@@ -0,0 +1,130 @@
+import math
+
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from modules import loss_modules
+from modules.loss_modules import DistanceCache, MMDLoss
+
+
+def dense_mmd(source, target, sigmas, unbiased):
+    # the full B x B kernel matrices, like MMDLoss before it was computed in blocks
+    def kernel_sum(x, y, exclude_diagonal):
+        dist_sq = torch.cdist(x, y).pow(2)
+        kernel = sum(torch.exp(-dist_sq / sigma) for sigma in sigmas)
+        return kernel.sum() - (kernel.diagonal().sum() if exclude_diagonal else 0.)
+
+    m, n = source.size(0), target.size(0)
+    if unbiased:
+        terms = kernel_sum(source, source, True) / (m * (m - 1)) + kernel_sum(target, target, True) / (n * (n - 1))
+    else:
+        terms = kernel_sum(source, source, False) / (m * m) + kernel_sum(target, target, False) / (n * n)
+
+    return (terms - 2 * kernel_sum(source, target, False) / (m * n)) / len(sigmas)
+
+
+def make_inputs(batch_size=100, num_features=4):
+    generator = torch.Generator().manual_seed(0)
+    source = torch.randn(batch_size, num_features, generator=generator, dtype=torch.float64) + 0.2
+    target = torch.randn(batch_size, num_features, generator=generator, dtype=torch.float64)
+    return source, target
+
+
+@pytest.mark.parametrize("unbiased", [False, True])
+@pytest.mark.parametrize("block_size", [7, 32, 1024])
+def test_blocked_mmd_matches_dense(unbiased, block_size):
+
+    sigmas = [1., 4., 16.]
+    source, target = make_inputs()
+
+    source_dense = source.clone().requires_grad_(True)
+    expected = dense_mmd(source_dense, target, sigmas, unbiased)
+    expected.backward()
+
+    source_blocked = source.clone().requires_grad_(True)
+    loss = MMDLoss(fix_sigma=sigmas, unbiased=unbiased, block_size=block_size)(source_blocked, target)
+    loss.backward()
+
+    assert torch.allclose(loss, expected, rtol=1e-9, atol=1e-12)
+    assert torch.allclose(source_blocked.grad, source_dense.grad, rtol=1e-7, atol=1e-12)
+
+
+def test_median_subsample_leaves_global_rng_alone():
+
+    source, target = make_inputs(batch_size=300)
+    loss_fn = MMDLoss(median_samples=64)
+
+    torch.manual_seed(1)
+    expected = torch.rand(5)
+
+    torch.manual_seed(1)
+    first = loss_fn(source, target)
+    second = loss_fn(source, target)
+
+    assert torch.equal(torch.rand(5), expected)
+    # and the median, hence the loss, is deterministic
+    assert torch.equal(first, second)
+
+
+def gaussian_mmd(shift, num_features, sigmas):
+    # MMD^2 of N(shift, 1) against N(0, 1) in every dimension with the kernel exp(-d^2 / sigma):
+    # x - y is Gaussian with variance 2, E exp(-|z|^2 / sigma) = (1 + 4 / sigma)^(-d/2) exp(-|mean|^2 / (sigma + 4))
+    values = [2 * (1 + 4 / sigma) ** (-num_features / 2) * (1 - math.exp(-num_features * shift ** 2 / (sigma + 4)))
+              for sigma in sigmas]
+    return sum(values) / len(sigmas)
+
+
+@pytest.mark.parametrize("loss_type, batch_size, init_params", [
+    ('mmd', 4000, {'unbiased': True}),
+    ('mmd_rff', 8000, {'num_features': 4096, 'seed': 42}),
+    ('mmd_linear', 100000, {}),
+])
+def test_approximate_mmd_matches_population_value(loss_type, batch_size, init_params):
+
+    num_features, shift, sigmas = 4, 1., [4., 16.]
+    generator = torch.Generator().manual_seed(0)
+    source = torch.randn(batch_size, num_features, generator=generator) + shift
+    target = torch.randn(batch_size, num_features, generator=generator)
+
+    with torch.no_grad():
+        value = loss_modules[loss_type](fix_sigma=sigmas, **init_params)(source, target).item()
+
+    assert value == pytest.approx(gaussian_mmd(shift, num_features, sigmas), abs=0.03)
+
+
+@pytest.mark.parametrize("max_elements", [0, 2**20])
+def test_distance_cache_matches_uncached(max_elements):
+
+    source, target = make_inputs()
+    distance_cache = DistanceCache(max_elements)
+
+    for sigmas in [[1., 4.], [16.]]:
+        expected = MMDLoss(fix_sigma=sigmas, block_size=32)(source, target)
+        cached = MMDLoss(fix_sigma=sigmas, block_size=32)(source, target, distance_cache=distance_cache)
+        assert torch.allclose(cached, expected, rtol=1e-9, atol=1e-12)
+
+    # only matrices within the budget are kept, the two losses share the source, target and cross distances
+    assert len(distance_cache._entries) == (3 if max_elements >= source.size(0) * target.size(0) else 0)
+
+
+def test_distance_cache_median_per_median_samples():
+
+    source, target = make_inputs(batch_size=300)
+    distance_cache = DistanceCache()
+
+    for median_samples in [64, 600]:
+        expected = MMDLoss(median_samples=median_samples)(source, target)
+        cached = MMDLoss(median_samples=median_samples)(source, target, distance_cache=distance_cache)
+        assert torch.allclose(cached, expected, rtol=1e-9, atol=1e-12)
+
+
+def test_linear_mmd_median_is_close_to_pdist_median():
+
+    source, target = make_inputs(batch_size=2000)
+
+    # the pairs of the linear estimator against all pairs
+    linear = loss_modules['mmd_linear']()._median_distance_sq(source, target)
+    full = MMDLoss(median_samples=4000)._median_distance_sq(source, target)
+
+    assert linear == pytest.approx(full, rel=0.1)
@@ -0,0 +1,117 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from config import Config
+from model import RefinementModelBuilder
+from scalers import Scalers
+
+
+def padded_forward(block, x):
+    # the skip connection before user-017: the identity padded with zeros and added to the residual
+    if block._in_features < block._out_features:
+        if block._isfirst:
+            identity = torch.index_select(x, 1, torch.tensor(block._skipindices, device=x.device))
+        else:
+            identity = torch.index_select(x, 1, torch.tensor([idx for idx in range(len(block._skipindices))], device=x.device))
+        identity = torch.cat((identity, torch.zeros((identity.size(dim=0), block._out_features - len(block._skipindices)), device=x.device, dtype=x.dtype)), dim=1)
+    elif block._out_features < block._in_features:
+        if block._islast and len(block._skipindices) > block._n_vars:
+            identity = x[:, block._n_params:block._n_params+block._out_features]
+        else:
+            identity = x[:, :block._out_features]
+    else:
+        identity = x
+
+    residual = x
+    for ilayer, linear in enumerate(block._linears):
+        residual = linear(residual)
+        if not (block._islast and ilayer == block._nskiplayers-1):
+            residual = block._leakyrelus[ilayer](residual)
+
+    return residual + identity
+
+
+def make_builder(config_path):
+
+    config = Config(config_path=config_path)
+    scalers = Scalers(config)
+
+    config.datasetInfo = {}
+    config.datasetInfo.inputDim = len(scalers.input_features_dict)
+    config.datasetInfo.targetDim = len(scalers.target_features_dict)
+    config.datasetInfo.train_numbatch = 0
+
+    return RefinementModelBuilder(config), config.datasetInfo.inputDim
+
+
+@pytest.fixture
+def model(config_path):
+
+    torch.manual_seed(0)
+    model = make_builder(config_path)[0].build()
+    # the deeper layers start with zero weights, which would hide differences in the residual path
+    with torch.no_grad():
+        for parameter in model.parameters():
+            parameter.normal_(std=0.1)
+    # dropout is random, the blocks are compared in eval mode
+    model.eval()
+
+    return model
+
+
+def test_skip_blocks_match_padded(model):
+
+    for name, block in model.named_children():
+        if not hasattr(block, '_skipindices'):
+            continue
+
+        x = torch.randn(64, block._in_features, requires_grad=True)
+
+        out_padded = padded_forward(block, x)
+        grad_padded, = torch.autograd.grad(out_padded.sum(), x)
+        out = block(x)
+        grad, = torch.autograd.grad(out.sum(), x)
+
+        assert torch.equal(out, out_padded), name
+        assert torch.equal(grad, grad_padded), name
+
+
+def test_ensemble_matches_separate_members(config_path):
+
+    builder, input_dim = make_builder(config_path)
+    ensemble = builder.build_ensemble([1, 2]).double()
+    with torch.no_grad():
+        for stacked in ensemble._stacked:
+            stacked.normal_(std=0.1)
+    ensemble.eval()
+
+    # the members hold views of the stacked parameters, also after the cast
+    for name, stacked in zip(ensemble._names, ensemble._stacked):
+        for imember, member in enumerate(ensemble.members):
+            assert member.get_parameter(name).data_ptr() == stacked[imember].data_ptr()
+
+    separate = [ensemble.member(imember) for imember in range(len(ensemble))]
+    learning_rates = [0.1, 0.01]
+    optimizers = [torch.optim.SGD(member.parameters(), lr=lr) for member, lr in zip(ensemble.members, learning_rates)]
+    separate_optimizers = [torch.optim.SGD(member.parameters(), lr=lr) for member, lr in zip(separate, learning_rates)]
+
+    x = torch.randn(64, input_dim, dtype=torch.float64)
+
+    for _ in range(2):
+
+        ensemble.zero_grad(set_to_none=True)
+        ensemble(x).pow(2).sum().backward()
+        ensemble.share_grads()
+        for optimizer in optimizers:
+            optimizer.step()
+
+        for member, optimizer in zip(separate, separate_optimizers):
+            optimizer.zero_grad(set_to_none=True)
+            member(x).pow(2).sum().backward()
+            optimizer.step()
+
+    with torch.no_grad():
+        out = ensemble(x)
+        for imember, member in enumerate(separate):
+            assert torch.allclose(out[imember], member(x), rtol=1e-10, atol=1e-12)
@@ -0,0 +1,66 @@
+import os
+import socket
+import time
+
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("numpy")
+
+from tensor_cache import TensorCache
+
+
+def test_round_trip(tmp_path):
+
+    cache = TensorCache(str(tmp_path))
+    tensors = {'input': torch.randn(10, 3), 'target': torch.randn(10, 2)}
+    key = cache.make_key({'files': ['a.root']})
+
+    assert cache.load(key) is None
+    cache.save(key, tensors, {'files': ['a.root']})
+
+    loaded = cache.load(key)
+    for name, tensor in tensors.items():
+        assert torch.equal(loaded[name], tensor)
+
+
+def test_evict_keeps_entries_in_progress(tmp_path):
+
+    cache = TensorCache(str(tmp_path), max_bytes=0)
+
+    # an entry a running process is writing: its meta.json is there, the rename isn't done yet
+    tmp_entry = tmp_path / f"{'0' * 32}{TensorCache.tmp_suffix}{os.getpid()}@{socket.gethostname()}"
+    tmp_entry.mkdir()
+    (tmp_entry / "meta.json").write_text('{"settings": {}, "tensors": []}')
+
+    first_key = cache.make_key({'files': ['a.root']})
+    cache.save(first_key, {'input': torch.randn(10, 3)}, {'files': ['a.root']})
+    last_key = cache.make_key({'files': ['b.root']})
+    cache.save(last_key, {'input': torch.randn(10, 3)}, {'files': ['b.root']})
+
+    assert tmp_entry.exists()
+    # over the budget, everything but the entry that was just written is removed
+    assert not os.path.exists(tmp_path / first_key)
+    assert os.path.exists(tmp_path / last_key)
+
+
+@pytest.mark.parametrize("writer, age, removed", [
+    # a process id that doesn't exist on this host
+    (f"{2**31 - 1}@{socket.gethostname()}", 0, True),
+    # a process on another host that can't be checked, only removed once it is old
+    ("12345@other-host", 0, False),
+    ("12345@other-host", 2 * TensorCache.stale_seconds, True),
+])
+def test_evict_removes_crashed_writers(tmp_path, writer, age, removed):
+
+    cache = TensorCache(str(tmp_path))
+
+    tmp_entry = tmp_path / f"{'0' * 32}{TensorCache.tmp_suffix}{writer}"
+    tmp_entry.mkdir()
+    (tmp_entry / "input.npy").write_bytes(b'')
+    mtime = time.time() - age
+    os.utime(tmp_entry, (mtime, mtime))
+
+    cache.evict()
+
+    assert tmp_entry.exists() != removed
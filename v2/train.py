@@ -1,5 +1,9 @@
 import torch
 import torch.nn as nn
+import numpy as np
+import json
+import os
+import random
 from typing import TYPE_CHECKING
 
 if TYPE_CHECKING:
@@ -9,8 +13,63 @@ if TYPE_CHECKING:
     from model import RefinementModelBuilder
     from scalers import Scalers
 
+from checkpoint import CheckpointManager, config_hash
 from plotting import PlotterManager
 
+class EarlyStopping:
+    """Stops the training when the validation value of a loss hasn't improved by more than min_delta for patience epochs
+
+    mode is 'min' or 'max', the state of the model at the best epoch is kept in memory so it can be restored at the end
+    """
+
+    def __init__(self, metric: str, mode: str = 'min', patience: int = 10, min_delta: float = 0., restore_best: bool = True):
+
+        if mode not in ['min', 'max']:
+            raise ValueError(f"Unknown early stopping mode: {mode}. Use 'min' or 'max'.")
+
+        self.metric = metric
+        self.mode = mode
+        self.patience = patience
+        self.min_delta = min_delta
+        self.restore_best = restore_best
+
+        self.counter = 0
+        self.best_value = None
+        self.best_epoch = None
+        self.best_state = None
+
+    def is_improvement(self, value: float) -> bool:
+
+        if self.best_value is None:
+            return True
+        if self.mode == 'min':
+            return value < self.best_value - self.min_delta
+        return value > self.best_value + self.min_delta
+
+    def step(self, value: float, epoch: int, model: nn.Module) -> bool:
+        """Updates the state with the value of an epoch, returns True if the training should stop"""
+
+        if self.is_improvement(value):
+            self.counter = 0
+            self.best_value = value
+            self.best_epoch = epoch
+            if self.restore_best:
+                self.best_state = {name: tensor.detach().clone() for name, tensor in model.state_dict().items()}
+        else:
+            self.counter += 1
+
+        return self.counter >= self.patience
+
+    def state_dict(self) -> dict:
+        return {'counter': self.counter, 'best_value': self.best_value, 'best_epoch': self.best_epoch, 'best_state': self.best_state}
+
+    def load_state_dict(self, state: dict):
+        self.counter = state['counter']
+        self.best_value = state['best_value']
+        self.best_epoch = state['best_epoch']
+        self.best_state = state['best_state']
+
+
 class Trainer:
     def __init__(self, 
     config: "Config", 
@@ -34,34 +93,255 @@ class Trainer:
             self.device = torch.device(config_device)
         
         optimizer_name = config.trainingSettings.optimizerName
+
+        # forward pass and losses run under autocast, the scalers stay outside of it in float32
+        precision = config.trainingSettings.precision or 'fp32'
+        autocast_dtypes = {'fp32': None, 'bf16': torch.bfloat16, 'fp16': torch.float16}
+        if precision not in autocast_dtypes:
+            raise ValueError(f"Unknown precision: {precision}. Use one of {list(autocast_dtypes)}.")
+        self.precision = precision
+        self.autocast_dtype = autocast_dtypes[precision]
+        # fp16 gradients need loss scaling, bf16 has the range of fp32
+        self.grad_scaler = torch.amp.GradScaler(self.device.type, enabled=precision == 'fp16')
+        self.parity_report = None
+
+        early_stopping = config.trainingSettings.earlyStopping
+        self.early_stopping = None
+        if early_stopping and early_stopping.get('enabled', True):
+            metric = early_stopping.get('metric', losses.primary_loss)
+            if metric not in losses.loss_funcs:
+                raise ValueError(f"Early stopping metric {metric} is not one of the configured losses: {list(losses.loss_funcs)}")
+            self.early_stopping = EarlyStopping(metric=metric,
+                                                mode=early_stopping.get('mode', 'min'),
+                                                patience=early_stopping.get('patience', 10),
+                                                min_delta=early_stopping.get('minDelta', 0.),
+                                                restore_best=early_stopping.get('restoreBest', True))
+
+        # called after every epoch with (epoch, validation loss), returning True stops the training (e.g. a pruner of sweep.py)
+        self.pruner = None
+        self.pruned = False
+
+        self.checkpoints = None
+        self.start_epoch = 0
+        self.stopped = False
         
         self.model = None
         self.optimizer = None
 
-        self.preprocessor = scalers.get_input_scalers()
+        self.preprocessor = scalers.get_input_scalers().to(self.device)
         self.refinement_model_builder = refinement_model_builder
-        self.postprocessor = scalers.get_target_inverse_scalers()
-        self.postprocessor_inverse = scalers.get_target_scalers()
+        self.postprocessor = scalers.get_target_inverse_scalers().to(self.device)
+        self.postprocessor_inverse = scalers.get_target_scalers().to(self.device)
+
+        if config.trainingSettings.prescaleData:
+            self.dataset.prescale(self.preprocessor, self.postprocessor_inverse, self.device)
         
-        model = refinement_model_builder.build()
+        model = self.build_model(refinement_model_builder)
         self.model = model.to(self.device)
         self.prepare_optimizer(optimizer_name)
 
+        # the eager model is what gets saved, the loops go through forward_model (the compiled one if
+        # modelSettings.compile is set, see compile_model, which is called after init_loss_statistics)
+        self.forward_model = self.model
+        self._train_step = None
+
+    def init_checkpoints(self, output_path: str) -> bool:
+        """Sets up the checkpoints of trainingSettings.checkpoint in output_path/checkpoints/
+        and resumes from the newest one, returns True if a checkpoint was loaded
+
+        a checkpoint is only resumed with the settings it was written with (see config_hash), otherwise
+        the training would silently continue (or be skipped as already finished) with the old settings
+        """
+
+        checkpoint_config = self.config.trainingSettings.checkpoint
+        if not checkpoint_config or not checkpoint_config.get('enabled', True):
+            return False
+
+        self.checkpoints = CheckpointManager(output_path,
+                                             every_epochs=checkpoint_config.get('everyEpochs', 10),
+                                             every_minutes=checkpoint_config.get('everyMinutes'),
+                                             keep=checkpoint_config.get('keep', 2))
+
+        state = self.checkpoints.load_latest(map_location=self.device)
+        if state is None:
+            return False
+
+        if state.get('config_hash') != self.config_hash():
+            raise ValueError(f"The checkpoints in {self.checkpoints.directory} were written with different model, loss or training settings, "
+                             "use another trainingId or remove the checkpoints to start over")
+
+        self.load_state_dict(state)
+        print(f"Resuming the training after epoch {self.start_epoch}")
+        return True
+
+    def config_hash(self) -> str:
+        return config_hash(self.config.config_dict)
+
+    def state_dict(self) -> dict:
+        """Everything needed to continue the training after the current epoch"""
+
+        train_generator = getattr(self.dataset.train, 'generator', None)
+
+        return {
+            'config_hash': self.config_hash(),
+            'epoch': self.epoch,
+            'stopped': self.stopped,
+            'pruned': self.pruned,
+            'model': self.model.state_dict(),
+            'optimizer': self.optimizer.state_dict(),
+            'grad_scaler': self.grad_scaler.state_dict(),
+            'early_stopping': self.early_stopping.state_dict() if self.early_stopping is not None else None,
+            'pruner': self.pruner.state_dict() if hasattr(self.pruner, 'state_dict') else None,
+            'loss_log': self.losses.state_dict(),
+            'rng': {
+                'torch': torch.get_rng_state(),
+                'cuda': torch.cuda.get_rng_state_all() if torch.cuda.is_available() else None,
+                'numpy': np.random.get_state(),
+                'python': random.getstate(),
+                'train_loader': train_generator.get_state() if train_generator is not None else None,
+            },
+        }
+
+    def load_state_dict(self, state: dict):
+
+        self.model.load_state_dict(state['model'])
+        self.optimizer.load_state_dict(state['optimizer'])
+        self.grad_scaler.load_state_dict(state['grad_scaler'])
+        if self.early_stopping is not None and state['early_stopping'] is not None:
+            self.early_stopping.load_state_dict(state['early_stopping'])
+        if hasattr(self.pruner, 'load_state_dict') and state['pruner'] is not None:
+            self.pruner.load_state_dict(state['pruner'])
+        self.losses.load_state_dict(state['loss_log'])
+
+        rng = state['rng']
+        torch.set_rng_state(rng['torch'].cpu())
+        if rng['cuda'] is not None and torch.cuda.is_available():
+            torch.cuda.set_rng_state_all([rng_state.cpu() for rng_state in rng['cuda']])
+        np.random.set_state(rng['numpy'])
+        random.setstate(rng['python'])
+        train_generator = getattr(self.dataset.train, 'generator', None)
+        if train_generator is not None and rng['train_loader'] is not None:
+            train_generator.set_state(rng['train_loader'].cpu())
+
+        self.epoch = state['epoch']
+        self.start_epoch = state['epoch'] + 1
+        self.stopped = state['stopped']
+        self.pruned = state['pruned']
+
+    def init_loss_statistics(self, output_path: str = None):
+        """Estimates the MMD bandwidths and the group fractions of the losses once on a sample of the scaled training data"""
+
+        num_samples = self.losses.dataset_sample_size()
+        if num_samples == 0:
+            return
+
+        inp, target = self.dataset.sample_train(num_samples)
+        with torch.no_grad():
+            inputs = self.preprocessor(inp.to(self.device))
+            targets = self.postprocessor_inverse(target.to(self.device))
+
+        self.losses.init_bandwidths(inputs, targets, output_path)
+        self.losses.init_group_fractions(inputs, targets)
+
+    def build_model(self, refinement_model_builder: "RefinementModelBuilder"):
+        return refinement_model_builder.build()
+
     def prepare_optimizer(self, optimizer_name: str):
+        self.optimizer = self.make_optimizer(optimizer_name, self.model.parameters(), self.learning_rate)
+
+    @staticmethod
+    def make_optimizer(optimizer_name: str, parameters, learning_rate: float):
         if optimizer_name.lower() == "adam":
-            self.optimizer = torch.optim.Adam(self.model.parameters(), lr=self.learning_rate)
+            return torch.optim.Adam(parameters, lr=learning_rate)
         elif optimizer_name.lower() == "sgd":
-            self.optimizer = torch.optim.SGD(self.model.parameters(), lr=self.learning_rate)
+            return torch.optim.SGD(parameters, lr=learning_rate)
         else:
             raise ValueError(f"Unknown optimizer name: {optimizer_name}")
 
 
+    def compile_model(self, mode: str = 'default', training_step: bool = False):
+        """Compiles the model, and optionally the training step up to the primary loss, with torch.compile
+
+        each compiled function is tried once on a training batch (forward and backward), if that fails the
+        eager version is used instead. Call it after init_loss_statistics, so the losses are traced with their
+        final bandwidths. The dry runs don't touch the random state, so runs with and without compile
+        see the same dropout masks and batches.
+
+        The last batch of a split is usually smaller, the first batch with another number of rows recompiles
+        once with a dynamic batch dimension (automatic dynamic shapes), which is then shared by all batch sizes.
+        """
+
+        cuda_devices = [self.device.index if self.device.index is not None else torch.cuda.current_device()] if self.device.type == 'cuda' else []
+
+        with torch.random.fork_rng(devices=cuda_devices):
+
+            inp, target = self.dataset.sample_train(self.batch_size)
+            inp, target = inp.to(self.device), target.to(self.device)
+            with torch.no_grad():
+                inputs, targets = self.preprocessor(inp), self.postprocessor_inverse(target)
+
+            compiled_model = self._compile(self.model, mode, 'model', lambda fn: fn(inputs).float().sum())
+            if compiled_model is not None:
+                self.forward_model = compiled_model
+
+            # without a compiled training step the loop goes through forward_model
+            if training_step:
+                # the training step gets the batches like the training loop, scaled only if the dataset is prescaled
+                step_inp, step_target = (inputs, targets) if self.dataset.prescaled else (inp, target)
+                self._train_step = self._compile(self.training_step, mode, 'training step', lambda fn: fn(step_inp, step_target)[-1])
+
+        self.model.zero_grad(set_to_none=True)
+
+    def _compile(self, fn, mode: str, name: str, dry_run):
+        """torch.compile of fn, or None if compiling or running dry_run(compiled) fails"""
+
+        try:
+            compiled = torch.compile(fn, mode=mode, dynamic=None)
+            with self.autocast():
+                loss = dry_run(compiled)
+            loss.backward()
+        except Exception as e:
+            print(f"Compilation of the {name} failed, falling back to eager mode: {e}")
+            return None
+
+        print(f"Compiled the {name} with torch.compile (mode={mode})")
+        return compiled
+
+    def training_step(self, inp, target):
+        """Scaling, forward pass and primary loss of one training batch, as one function for torch.compile"""
+
+        if not self.dataset.prescaled:
+            inp, target = self.preprocessor(inp), self.postprocessor_inverse(target)
+
+        with self.autocast():
+            outputs = self.model(inp)
+            primary_loss = self.losses.get_primary_loss_fn()(inp, outputs, target)
+
+        return inp, outputs, target, primary_loss
+
+    def autocast(self, enabled: bool = True):
+        return torch.autocast(device_type=self.device.type, dtype=self.autocast_dtype,
+                              enabled=enabled and self.autocast_dtype is not None)
+
+    def prepare_batch(self, inp, target):
+
+        inp = inp.to(self.device, non_blocking=True)
+        target = target.to(self.device, non_blocking=True)
+
+        if self.dataset.prescaled:
+            return inp, target
+
+        return self.preprocessor(inp), self.postprocessor_inverse(target)
+
     def train(self):
                 
         print(f"Starting training for {self.epochs} epochs on {self.device}")
         print("-" * 60)
+
+        # a resumed training that had already stopped only restores the best model
+        start_epoch = self.epochs if self.stopped else self.start_epoch
         
-        for epoch in range(self.epochs):
+        for epoch in range(start_epoch, self.epochs):
             self.epoch = epoch
             self.model.train()
             train_loss = 0.0
@@ -69,36 +349,108 @@ class Trainer:
             
             for batch_idx, (inp, target, spectators) in enumerate(self.dataset.train):
                 
-                inp = inp.to(self.device)
-                target = target.to(self.device)
-
-                inputs = self.preprocessor(inp)
-                targets = self.postprocessor_inverse(target)
-                
                 self.optimizer.zero_grad()
-                outputs = self.model(inputs)
-                
-                self.losses.calculate(inputs, outputs, targets, self.epoch, batch_idx, mode='train')
-                primary_loss = self.losses.get_primary_loss_fn()(inputs, outputs, targets)
+
+                if self._train_step is not None:
+                    inputs, outputs, targets, primary_loss = self._train_step(inp.to(self.device, non_blocking=True),
+                                                                              target.to(self.device, non_blocking=True))
+                    with self.autocast():
+                        self.losses.calculate(inputs, outputs, targets, self.epoch, batch_idx, mode='train',
+                                              precomputed={self.losses.primary_loss: primary_loss})
+                else:
+                    inputs, targets = self.prepare_batch(inp, target)
+
+                    with self.autocast():
+                        outputs = self.forward_model(inputs)
+
+                        loss_values = self.losses.calculate(inputs, outputs, targets, self.epoch, batch_idx, mode='train')
+                        primary_loss = loss_values[self.losses.primary_loss]
                 
-                primary_loss.backward()
-                self.optimizer.step()
+                self.grad_scaler.scale(primary_loss).backward()
+                self.grad_scaler.step(self.optimizer)
+                self.grad_scaler.update()
                 
-                train_loss += primary_loss.item() * inputs.size(0)
+                # accumulated on the device, synchronized once per epoch
+                train_loss += primary_loss.detach().float() * inputs.size(0)
                 train_samples += inputs.size(0)
             
-            avg_train_loss = train_loss / train_samples
+            avg_train_loss = float(train_loss) / train_samples
             
             val_loss = self.evaluate()
+
+            self.losses.sync_log()
             
             print(f"Epoch {epoch+1:4d}/{self.epochs} | "
                   f"Train Loss: {avg_train_loss:.6f} | "
                   f"Val Loss: {val_loss:.6f}")
+
+            if self.pruner is not None and self.pruner(epoch, val_loss):
+                print(f"Training pruned after epoch {epoch+1}")
+                self.pruned = True
+                self.stopped = True
+
+            if self.early_stopping is not None and not self.stopped:
+                metric_value = self.losses.get_epoch_average(self.early_stopping.metric, epoch, is_val=True)
+                if self.early_stopping.step(metric_value, epoch, self.model):
+                    print(f"Early stopping after epoch {epoch+1}, "
+                          f"no improvement of {self.early_stopping.metric} for {self.early_stopping.patience} epochs")
+                    self.stopped = True
+
+            if self.checkpoints is not None and (self.stopped or epoch == self.epochs - 1 or self.checkpoints.is_due(epoch)):
+                self.checkpoints.save(self.state_dict(), epoch)
+
+            if self.stopped:
+                break
         
         print("-" * 60)
         print("Training completed!")
+
+        if self.early_stopping is not None and self.early_stopping.best_state is not None:
+            self.model.load_state_dict(self.early_stopping.best_state)
+            print(f"Restored the model of epoch {self.early_stopping.best_epoch+1} "
+                  f"({self.early_stopping.metric}: {self.early_stopping.best_value:.6f})")
+
+        if self.autocast_dtype is not None:
+            self.parity_report = self.precision_parity_report()
         
         return self.model
+
+    def _validation_averages(self, use_autocast: bool):
+        """Sample-weighted averages of all the losses on the validation set, without logging them"""
+
+        self.model.eval()
+        sums = {name: 0. for name in self.losses.loss_funcs}
+        num_samples = 0
+
+        with torch.no_grad():
+            for inp, target, spectators in self.dataset.validation:
+
+                inputs, targets = self.prepare_batch(inp, target)
+
+                with self.autocast(enabled=use_autocast):
+                    outputs = self.forward_model(inputs)
+                    context = self.losses.step_context(inputs, outputs, targets)
+                    for name, loss_fn in self.losses.loss_funcs.items():
+                        sums[name] += loss_fn(inputs, outputs, targets, context).float() * inputs.size(0)
+
+                num_samples += inputs.size(0)
+
+        return {name: float(value) / num_samples for name, value in sums.items()}
+
+    def precision_parity_report(self):
+        """Validation losses of the trained model with the training precision against float32"""
+
+        reduced = self._validation_averages(use_autocast=True)
+        full = self._validation_averages(use_autocast=False)
+
+        report = {}
+        print(f"Validation losses {self.precision} vs fp32:")
+        for name in full:
+            relative = abs(reduced[name] - full[name]) / max(abs(full[name]), 1e-12)
+            report[name] = {self.precision: reduced[name], 'fp32': full[name], 'relativeDifference': relative}
+            print(f"  {name}: {reduced[name]:.6f} vs {full[name]:.6f} (relative difference {relative:.2e})")
+
+        return report
     
     def evaluate(self):
         
@@ -109,21 +461,18 @@ class Trainer:
         with torch.no_grad():
             for batch_idx, (inp, target, spectators) in enumerate(self.dataset.validation):
                 
-                inp = inp.to(self.device)
-                target = target.to(self.device)
-
-                inputs = self.preprocessor(inp)
-                targets = self.postprocessor_inverse(target)
-                
-                outputs = self.model(inputs)
+                inputs, targets = self.prepare_batch(inp, target)
                 
-                self.losses.calculate(inputs, outputs, targets, self.epoch, batch_idx, mode='validation')
-                primary_loss = self.losses.get_primary_loss_fn()(inputs, outputs, targets)
+                with self.autocast():
+                    outputs = self.forward_model(inputs)
+                    
+                    loss_values = self.losses.calculate(inputs, outputs, targets, self.epoch, batch_idx, mode='validation')
+                    primary_loss = loss_values[self.losses.primary_loss]
                 
-                val_loss += primary_loss.item() * inputs.size(0)
+                val_loss += primary_loss.detach().float() * inputs.size(0)
                 val_samples += inputs.size(0)
         
-        return val_loss / val_samples
+        return float(val_loss) / val_samples
     
     def test(self):
         
@@ -136,21 +485,19 @@ class Trainer:
         with torch.no_grad():
             for batch_idx, (inp, target, spectators) in enumerate(self.dataset.test):
                 
-                inp = inp.to(self.device)
-                target = target.to(self.device)
-
-                inputs = self.preprocessor(inp)
-                targets = self.postprocessor_inverse(target)
-                
-                outputs = self.model(inputs)
+                inputs, targets = self.prepare_batch(inp, target)
                 
-                self.losses.calculate(inputs, outputs, targets, 0, batch_idx, mode='test')
-                primary_loss = self.losses.get_primary_loss_fn()(inputs, outputs, targets)
+                with self.autocast():
+                    outputs = self.forward_model(inputs)
+                    
+                    loss_values = self.losses.calculate(inputs, outputs, targets, 0, batch_idx, mode='test')
+                    primary_loss = loss_values[self.losses.primary_loss]
                 
-                test_loss += primary_loss.item() * inputs.size(0)
+                test_loss += primary_loss.detach().float() * inputs.size(0)
                 test_samples += inputs.size(0)
         
-        avg_test_loss = test_loss / test_samples
+        avg_test_loss = float(test_loss) / test_samples
+        self.losses.sync_log()
         print(f"Test Loss: {avg_test_loss:.6f}")
         
         return avg_test_loss
@@ -162,6 +509,10 @@ class Trainer:
         torch.jit.save(m, output_path + "model.pt")
         print(f"Model saved to {output_path + 'model.pt'}")
         
+        if self.parity_report is not None:
+            with open(output_path + "precision_parity.json", 'w') as f:
+                json.dump(self.parity_report, f, indent=4)
+
         # Save data
         root_file_path = output_path + "data.root"
         self.dataset.save_root(self.model, "tJet", root_file_path)
@@ -171,4 +522,194 @@ class Trainer:
         if generate_plots:
             training_id = self.config.generalSettings.trainingId
             plotter = PlotterManager(self.config, output_path, training_id)
-            plotter.plot_all(root_file_path, self.losses)
\ No newline at end of file
+            plotter.plot_all(root_file_path, self.losses)
+
+
+class EnsembleTrainer(Trainer):
+    """Trains modelSettings.ensembleSize models of the same architecture on the same batches
+
+    the members are evaluated together in one vectorized forward pass (ModelEnsemble), every member has its own
+    seed (trainingSettings.ensembleSeeds), learning rate (trainingSettings.ensembleLearningRates), optimizer,
+    LossManager and output folder. A pruner gets the mean validation loss of the members. Checkpoints and
+    early stopping are not supported, Config rejects them together with an ensembleSize > 1.
+    """
+
+    def __init__(self,
+    config: "Config",
+    dataset: "Dataset",
+    losses: "list[LossManager]",
+    refinement_model_builder: "RefinementModelBuilder",
+    scalers: "Scalers",
+    ):
+        self.ensemble_size = len(losses)
+
+        base_seed = config.trainingSettings.randomSeed or 0
+        seeds = config.trainingSettings.ensembleSeeds or [base_seed + imember for imember in range(self.ensemble_size)]
+        learning_rates = config.trainingSettings.ensembleLearningRates or [config.trainingSettings.learningRate] * self.ensemble_size
+        if len(seeds) != self.ensemble_size or len(learning_rates) != self.ensemble_size:
+            raise ValueError(f"ensembleSeeds and ensembleLearningRates need one entry per ensemble member ({self.ensemble_size})")
+        self.seeds = seeds
+        self.learning_rates = learning_rates
+
+        super(EnsembleTrainer, self).__init__(config, dataset, losses, refinement_model_builder, scalers)
+
+    @staticmethod
+    def member_paths(output_path: str, ensemble_size: int):
+        return [f"{output_path}member_{imember}/" for imember in range(ensemble_size)]
+
+    def build_model(self, refinement_model_builder: "RefinementModelBuilder"):
+        return refinement_model_builder.build_ensemble(self.seeds)
+
+    def prepare_optimizer(self, optimizer_name: str):
+        self.optimizer = None
+        self.optimizers = [self.make_optimizer(optimizer_name, member.parameters(), learning_rate)
+                           for member, learning_rate in zip(self.model.members, self.learning_rates)]
+
+    def compile_model(self, mode: str = 'default', training_step: bool = False):
+
+        if training_step:
+            print("compileTrainingStep is not supported for ensembles, only the model is compiled")
+
+        super(EnsembleTrainer, self).compile_model(mode, training_step=False)
+
+    def init_checkpoints(self, output_path: str) -> bool:
+        # disabled for ensembles, see Config.check_ensemble
+        return False
+
+    def init_loss_statistics(self, output_path: str = None):
+
+        num_samples = max(losses.dataset_sample_size() for losses in self.losses)
+        if num_samples == 0:
+            return
+
+        inp, target = self.dataset.sample_train(num_samples)
+        with torch.no_grad():
+            inputs = self.preprocessor(inp.to(self.device))
+            targets = self.postprocessor_inverse(target.to(self.device))
+
+        member_paths = self.member_paths(output_path, self.ensemble_size) if output_path else [None] * self.ensemble_size
+        for losses, member_path in zip(self.losses, member_paths):
+            losses.init_bandwidths(inputs, targets, member_path)
+            losses.init_group_fractions(inputs, targets)
+
+    def calculate(self, inputs, outputs, targets, epoch: int, batch: int, mode: str):
+        """Primary losses of all members as one float32 tensor, the other losses are only logged"""
+
+        return torch.stack([
+            losses.calculate(inputs, outputs[imember], targets, epoch, batch, mode=mode)[losses.primary_loss].float()
+            for imember, losses in enumerate(self.losses)
+        ])
+
+    @staticmethod
+    def format_losses(values):
+        return " ".join(f"{value:.6f}" for value in values)
+
+    def train(self):
+
+        print(f"Starting training of {self.ensemble_size} ensemble members for {self.epochs} epochs on {self.device}")
+        print("-" * 60)
+
+        for epoch in range(self.epochs):
+            self.epoch = epoch
+            self.model.train()
+            train_loss = torch.zeros(self.ensemble_size, device=self.device)
+            train_samples = 0
+
+            for batch_idx, (inp, target, spectators) in enumerate(self.dataset.train):
+
+                inputs, targets = self.prepare_batch(inp, target)
+
+                # also the gradients of the stacked parameters, the members only hold views of them
+                self.model.zero_grad(set_to_none=True)
+
+                with self.autocast():
+                    outputs = self.forward_model(inputs)
+                    primary_losses = self.calculate(inputs, outputs, targets, self.epoch, batch_idx, mode='train')
+
+                # the members don't share parameters, so the gradients of the sum are the gradients of each member's loss
+                self.grad_scaler.scale(primary_losses.sum()).backward()
+                self.model.share_grads()
+                for optimizer in self.optimizers:
+                    self.grad_scaler.step(optimizer)
+                self.grad_scaler.update()
+
+                train_loss += primary_losses.detach() * inputs.size(0)
+                train_samples += inputs.size(0)
+
+            avg_train_loss = (train_loss / train_samples).tolist()
+
+            val_loss = self.evaluate()
+
+            for losses in self.losses:
+                losses.sync_log()
+
+            print(f"Epoch {epoch+1:4d}/{self.epochs} | "
+                  f"Train Loss: {self.format_losses(avg_train_loss)} | "
+                  f"Val Loss: {self.format_losses(val_loss)}")
+
+            # the members are trained together, so they are pruned together
+            if self.pruner is not None and self.pruner(epoch, sum(val_loss) / len(val_loss)):
+                print(f"Training pruned after epoch {epoch+1}")
+                self.pruned = True
+                self.stopped = True
+                break
+
+        print("-" * 60)
+        print("Training completed!")
+
+        return self.model
+
+    def _evaluate(self, loader, epoch: int, mode: str):
+
+        self.model.eval()
+        total_loss = torch.zeros(self.ensemble_size, device=self.device)
+        total_samples = 0
+
+        with torch.no_grad():
+            for batch_idx, (inp, target, spectators) in enumerate(loader):
+
+                inputs, targets = self.prepare_batch(inp, target)
+
+                with self.autocast():
+                    outputs = self.forward_model(inputs)
+                    primary_losses = self.calculate(inputs, outputs, targets, epoch, batch_idx, mode=mode)
+
+                total_loss += primary_losses * inputs.size(0)
+                total_samples += inputs.size(0)
+
+        return (total_loss / total_samples).tolist()
+
+    def evaluate(self):
+        return self._evaluate(self.dataset.validation, self.epoch, 'validation')
+
+    def test(self):
+
+        print("Running test evaluation...")
+
+        avg_test_loss = self._evaluate(self.dataset.test, 0, 'test')
+        for losses in self.losses:
+            losses.sync_log()
+        print(f"Test Loss: {self.format_losses(avg_test_loss)}")
+
+        return avg_test_loss
+
+    def save_results(self, output_path: str, generate_plots: bool = True):
+
+        training_id = self.config.generalSettings.trainingId
+
+        for imember, (losses, member_path) in enumerate(zip(self.losses, self.member_paths(output_path, self.ensemble_size))):
+
+            os.makedirs(member_path, exist_ok=True)
+            member = self.model.member(imember)
+
+            m = torch.jit.script(member)
+            torch.jit.save(m, member_path + "model.pt")
+            print(f"Model saved to {member_path + 'model.pt'}")
+
+            root_file_path = member_path + "data.root"
+            self.dataset.save_root(member, "tJet", root_file_path)
+            print(f"Data saved to {root_file_path}")
+
+            if generate_plots:
+                plotter = PlotterManager(self.config, member_path, training_id)
+                plotter.plot_all(root_file_path, losses)